@@ -6,7 +6,7 @@ from pathlib import Path
 
 import numpy as np
 
-from pffdtd.absorption.admittance import fit_to_Sabs_oct_11
+from pffdtd.absorption.admittance import fit_to_Sabs_oct_11_batch
 from pffdtd.sim3d.setup import Setup3D
 
 
@@ -55,13 +55,15 @@ class CTK_Church(Setup3D):
         window          = np.array([0.35 ,  0.35  , 0.35  , 0.35  , 0.25  , 0.18  , 0.12  , 0.07  , 0.04  , 0.04  , 0.04])
 
         folder = Path(self.mat_folder)
-        fit_to_Sabs_oct_11(acoustic_panel , filename=folder / 'acoustic_panel.h5')
-        fit_to_Sabs_oct_11(altar          , filename=folder / 'altar.h5')
-        fit_to_Sabs_oct_11(audience       , filename=folder / 'audience.h5')
-        fit_to_Sabs_oct_11(carpet         , filename=folder / 'carpet.h5')
-        fit_to_Sabs_oct_11(ceiling        , filename=folder / 'ceiling.h5')
-        fit_to_Sabs_oct_11(chair          , filename=folder / 'chair.h5')
-        fit_to_Sabs_oct_11(tile           , filename=folder / 'tile.h5')
-        fit_to_Sabs_oct_11(walls          , filename=folder / 'walls.h5')
-        fit_to_Sabs_oct_11(window         , filename=folder / 'window.h5')
+        fit_to_Sabs_oct_11_batch({
+            folder / 'acoustic_panel.h5': acoustic_panel,
+            folder / 'altar.h5': altar,
+            folder / 'audience.h5': audience,
+            folder / 'carpet.h5': carpet,
+            folder / 'ceiling.h5': ceiling,
+            folder / 'chair.h5': chair,
+            folder / 'tile.h5': tile,
+            folder / 'walls.h5': walls,
+            folder / 'window.h5': window,
+        })
         # autopep8: on
@@ -4,7 +4,7 @@ from pathlib import Path
 
 import numpy as np
 
-from pffdtd.absorption.admittance import fit_to_Sabs_oct_11
+from pffdtd.absorption.admittance import fit_to_Sabs_oct_11_batch
 from pffdtd.absorption.porous import porous_absorber
 from pffdtd.sim3d.model_builder import MeshModelBuilder
 from pffdtd.sim3d.setup import Setup3D
@@ -59,11 +59,13 @@ class LivingRoom(Setup3D):
         wood                = np.array([0.10, 0.11, 0.13, 0.15, 0.11, 0.10, 0.07, 0.06, 0.07, 0.07, 0.07])
 
         folder = Path(self.mat_folder)
-        fit_to_Sabs_oct_11(absorber_8000_100mm , filename=folder / 'absorber_8000_100mm.h5')
-        fit_to_Sabs_oct_11(concrete_painted    , filename=folder / 'concrete_painted.h5'   )
-        fit_to_Sabs_oct_11(glas_thick          , filename=folder / 'glas_thick.h5'         )
-        fit_to_Sabs_oct_11(metal_iron          , filename=folder / 'metal_iron.h5'         )
-        fit_to_Sabs_oct_11(wood                , filename=folder / 'wood.h5'               )
+        fit_to_Sabs_oct_11_batch({
+            folder / 'absorber_8000_100mm.h5': absorber_8000_100mm,
+            folder / 'concrete_painted.h5'   : concrete_painted,
+            folder / 'glas_thick.h5'         : glas_thick,
+            folder / 'metal_iron.h5'         : metal_iron,
+            folder / 'wood.h5'               : wood,
+        })
         # autopep8: on
 
     def generate_model(self, constants):
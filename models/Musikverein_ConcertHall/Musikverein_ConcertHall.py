@@ -6,7 +6,7 @@ from pathlib import Path
 
 import numpy as np
 
-from pffdtd.absorption.admittance import fit_to_Sabs_oct_11
+from pffdtd.absorption.admittance import fit_to_Sabs_oct_11_batch
 from pffdtd.sim3d.setup import Setup3D
 
 
@@ -45,9 +45,11 @@ class Musikverein_ConcertHall(Setup3D):
         plasterboard = np.array([0.15, 0.15, 0.15, 0.15, 0.1 , 0.06, 0.04, 0.04, 0.05, 0.05, 0.05])
         window       = np.array([0.35, 0.35, 0.35, 0.35, 0.25, 0.18, 0.12, 0.07, 0.04, 0.04, 0.04])
         wood         = np.array([0.25, 0.25, 0.25, 0.25, 0.15, 0.1 , 0.09, 0.08, 0.07, 0.07, 0.07])
-        fit_to_Sabs_oct_11(chairs       , filename=folder / 'chairs.h5')
-        fit_to_Sabs_oct_11(floor        , filename=folder / 'floor.h5')
-        fit_to_Sabs_oct_11(plasterboard , filename=folder / 'plasterboard.h5')
-        fit_to_Sabs_oct_11(window       , filename=folder / 'window.h5')
-        fit_to_Sabs_oct_11(wood         , filename=folder / 'wood.h5')
+        fit_to_Sabs_oct_11_batch({
+            folder / 'chairs.h5': chairs,
+            folder / 'floor.h5': floor,
+            folder / 'plasterboard.h5': plasterboard,
+            folder / 'window.h5': window,
+            folder / 'wood.h5': wood,
+        })
         # autopep8: on
@@ -4,7 +4,7 @@ from pathlib import Path
 
 import numpy as np
 
-from pffdtd.absorption.admittance import fit_to_Sabs_oct_11
+from pffdtd.absorption.admittance import fit_to_Sabs_oct_11_batch
 from pffdtd.absorption.porous import porous_absorber
 from pffdtd.geometry.math import find_third_vertex, point_along_line
 from pffdtd.sim3d.model_builder import MeshModelBuilder
@@ -61,14 +61,16 @@ class ProStudio(Setup3D):
         wood                          = np.array([0.10, 0.11, 0.13, 0.15, 0.11, 0.10, 0.07, 0.06, 0.07, 0.07, 0.07])
         wood_on_concrete              = np.array([0.01, 0.01, 0.01, 0.04, 0.04, 0.07, 0.06, 0.06, 0.07, 0.06, 0.06])
 
-        fit_to_Sabs_oct_11(absorber_8000_50mm            , filename=folder / 'absorber_8000_50mm.h5'           )
-        fit_to_Sabs_oct_11(absorber_8000_200mm_gap_100mm , filename=folder / 'absorber_8000_200mm_gap_100mm.h5')
-        fit_to_Sabs_oct_11(absorber_8000_200mm_gap_200mm , filename=folder / 'absorber_8000_200mm_gap_200mm.h5')
-        fit_to_Sabs_oct_11(glas_thick                    , filename=folder / 'glas_thick.h5'                   )
-        fit_to_Sabs_oct_11(leather_arm_chair             , filename=folder / 'leather_arm_chair.h5'            )
-        fit_to_Sabs_oct_11(metal_iron                    , filename=folder / 'metal_iron.h5'                   )
-        fit_to_Sabs_oct_11(wood                          , filename=folder / 'wood.h5'                         )
-        fit_to_Sabs_oct_11(wood_on_concrete              , filename=folder / 'wood_on_concrete.h5'             )
+        fit_to_Sabs_oct_11_batch({
+            folder / 'absorber_8000_50mm.h5'           : absorber_8000_50mm,
+            folder / 'absorber_8000_200mm_gap_100mm.h5': absorber_8000_200mm_gap_100mm,
+            folder / 'absorber_8000_200mm_gap_200mm.h5': absorber_8000_200mm_gap_200mm,
+            folder / 'glas_thick.h5'                   : glas_thick,
+            folder / 'leather_arm_chair.h5'            : leather_arm_chair,
+            folder / 'metal_iron.h5'                   : metal_iron,
+            folder / 'wood.h5'                         : wood,
+            folder / 'wood_on_concrete.h5'             : wood_on_concrete,
+        })
         # autopep8: on
 
     def generate_model(self, constants):
@@ -4,7 +4,7 @@ from pathlib import Path
 
 import numpy as np
 
-from pffdtd.absorption.admittance import fit_to_Sabs_oct_11
+from pffdtd.absorption.admittance import fit_to_Sabs_oct_11_batch
 from pffdtd.absorption.porous import porous_absorber
 from pffdtd.geometry.math import find_third_vertex
 from pffdtd.sim3d.model_builder import RoomModelBuilder
@@ -53,11 +53,13 @@ class Studio(Setup3D):
         wood                          = np.array([0.10, 0.11, 0.13, 0.15, 0.11, 0.10, 0.07, 0.06, 0.07, 0.07, 0.07])
         wood_on_concrete              = np.array([0.01, 0.01, 0.01, 0.04, 0.04, 0.07, 0.06, 0.06, 0.07, 0.06, 0.06])
 
-        fit_to_Sabs_oct_11(absorber_8000_100mm , filename=folder / 'absorber_8000_100mm.h5')
-        fit_to_Sabs_oct_11(absorber_8000_200mm , filename=folder / 'absorber_8000_200mm.h5')
-        fit_to_Sabs_oct_11(concrete_painted    , filename=folder / 'concrete_painted.h5'   )
-        fit_to_Sabs_oct_11(wood                , filename=folder / 'wood.h5'               )
-        fit_to_Sabs_oct_11(wood_on_concrete    , filename=folder / 'wood_on_concrete.h5'   )
+        fit_to_Sabs_oct_11_batch({
+            folder / 'absorber_8000_100mm.h5': absorber_8000_100mm,
+            folder / 'absorber_8000_200mm.h5': absorber_8000_200mm,
+            folder / 'concrete_painted.h5'   : concrete_painted,
+            folder / 'wood.h5'               : wood,
+            folder / 'wood_on_concrete.h5'   : wood_on_concrete,
+        })
         # autopep8: on
 
     def generate_model(self, constants):
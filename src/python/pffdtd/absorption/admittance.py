@@ -4,13 +4,17 @@
 """Miscellaneous functions for dealing with wall admittances (materials)
 DEF is normalised RLC triplet (i.e., for specific admittance)
 """
+import hashlib
+import os
 from pathlib import Path
 
 import click
 import numpy as np
 import h5py
 import matplotlib.pyplot as plt
-import scipy.optimize as scpo
+
+FIT_CACHE_VERSION = 1
+OCT_11_FREQS = 1000*(2.0**np.arange(-6, 5))  # octave bands 16Hz to 16KHz
 
 
 def convert_nabs_to_R(nabs):
@@ -48,6 +52,8 @@ def convert_R_to_Zn(R):
 
 def convert_Sabs_to_Yn(Sabs, max_iter=100):
     """sabine absorption to specific admittance, Paris formula inversion with Newton method
+
+    Sabs may be an array (Newton iterations run for all values at once)
     """
     def _print(fstring):
         print(f'--MATERIALS: {fstring}')
@@ -58,25 +64,23 @@ def convert_Sabs_to_Yn(Sabs, max_iter=100):
     def fgd(g):
         return -8.0*(-4*g**2 - 6*g + 4 * (1+g)**2*g*np.log((g+1)/g)-1)/(1+g)**2
 
-    if Sabs > 0.9512:
+    Sabs = np.array(Sabs, dtype=np.float64)
+    if np.any(Sabs > 0.9512):
         _print('warning, Sabs>0.9512 -- not possible for locally-reactive model')
-        Sabs = 0.9512
-
-    if Sabs == 0:
-        g = 0
-    else:  # newton solve
-        x_old = Sabs/8.0  # starting guess
-        x_new = 0
-        err = np.inf
-        niter = 0
-        while (niter < max_iter) and (err > 1e-6):
-            x_new = x_old - (fg(x_old)-Sabs)/fgd(x_old)
-            niter += 1
-            err = np.abs(1-x_new/x_old)
-            # _print(f'Iteration {niter}: {x_new=}, {err=}')
-            x_old = x_new
-        g = x_new
-    return g
+        Sabs = np.minimum(Sabs, 0.9512)
+
+    # newton solve, each value until converged
+    Sabs_flat = Sabs.ravel()
+    g = Sabs_flat/8.0  # starting guess (0 for Sabs=0)
+    active = Sabs_flat != 0
+    niter = 0
+    while (niter < max_iter) and np.any(active):
+        x_old = g[active]
+        x_new = x_old - (fg(x_old)-Sabs_flat[active])/fgd(x_old)
+        g[active] = x_new
+        niter += 1
+        active[active] = np.abs(1-x_new/x_old) > 1e-6
+    return g.reshape(Sabs.shape)[()]
 
 
 def write_freq_ind_mat_from_Zn(Zn, filename):
@@ -255,96 +259,141 @@ def _from_DEF(D, E, F):
     return Ynm, dw, w0
 
 
-def fit_to_Sabs_oct_11(Sabs, filename, plot=False, verbose=False):
-    # fit Yn from 11 Sabine octave-band coefficients (16Hz to 16KHz)
-    # this is a simple fitting routine that is a starting point for octave-band input data
-    assert Sabs.size == 11
-    Noct = Sabs.size
-    # frequency vector to fit over
+def _oct_11_basis():
+    # frequency vector to fit over, octave band of each frequency and
+    # admittance of each resonant branch (half-octave bandwidth) for Ynm=1
     fv = np.logspace(np.log10(10), np.log10(20e3), 1000)
     jw = 1j*fv*2*np.pi
-    fcv = 1000*(2.0**np.arange(-6, 5))
-    ymv = np.zeros(Noct)
-    dwv = np.zeros(Noct)
-    w0v = np.zeros(Noct)
-    Y_target = np.zeros(fv.shape)
-    for j in range(Noct):
-        fc = fcv[j]
-        sa = Sabs[j]
-        Ynm = convert_Sabs_to_Yn(sa)
-        if j == 0:
-            i1 = 0
-        else:
-            i1 = np.flatnonzero(fv >= fc/np.sqrt(2))[0]
-        if j == Noct-1:
-            i2 = fv.size
+    fcv = OCT_11_FREQS
+    band = np.searchsorted(fcv*np.sqrt(2), fv, side='right').clip(max=fcv.size-1)
+    w0v = 2*np.pi*fcv
+    dwv = w0v/np.sqrt(2)
+    D, E, F = _to_DEF(np.ones(fcv.size), dwv, w0v)
+    Yb = 1.0/(jw[:, None]*D + E + F/jw[:, None])
+    return fv, band, dwv, w0v, Yb
+
+
+def _nabs_from_Yn(Yn):
+    # 1-|R|^2 for R=(1-Yn)/(1+Yn)
+    return 4.0*Yn.real/np.abs(1.0+Yn)**2
+
+
+def fit_Sabs_oct_11(Sabs, max_iter=60, ym_min=1e-8):
+    """fit admittance to 11 Sabine octave-band coefficients (16Hz to 16KHz), for many materials at once
+
+    Sabs has shape (..., 11), returns DEF of shape (..., 11, 3). One resonant
+    branch per octave with fixed half-octave bandwidth, only the branch
+    admittances are fitted, minimising sum(abs(abs_fit-abs_target)) over
+    frequency. The admittance is linear in the branch admittances, so this is
+    solved with Gauss-Newton steps for all materials at once (least-squares
+    first, then iteratively reweighted for the absolute error).
+    """
+    Sabs = np.asarray(Sabs, dtype=np.float64)
+    assert Sabs.shape[-1] == 11
+    batch_shape = Sabs.shape[:-1]
+    Sabs = Sabs.reshape(-1, 11)
+
+    fv, band, dwv, w0v, Yb = _oct_11_basis()
+    ymv = np.atleast_2d(convert_Sabs_to_Yn(Sabs))
+    abs_target = _nabs_from_Yn(ymv[:, band])
+
+    # einsum rather than matmul (BLAS), so fits don't depend on batch size
+    def cost_function(ym):
+        return np.sum(np.abs(_nabs_from_Yn(np.einsum('mi,fi->mf', ym, Yb))-abs_target), axis=-1)
+
+    ym = np.maximum(ymv, ym_min)
+    ym_opt = ym.copy()
+    cost_opt = cost_function(ym)
+    eye = np.eye(11)
+    for it in range(max_iter):
+        Yn = np.einsum('mi,fi->mf', ym, Yb)
+        den = np.abs(1.0+Yn)**2
+        res = _nabs_from_Yn(Yn)-abs_target
+        # d(abs)/d(ym), with d(Yn)/d(ym) = Yb
+        jac = 4.0*Yb.real/den[..., None] \
+            - 8.0*(Yn.real/den**2)[..., None]*(np.conj(1.0+Yn)[..., None]*Yb).real
+        weights = 1.0 if it < max_iter//3 else 1.0/np.maximum(np.abs(res), 1e-8)
+        jac_w = jac*np.broadcast_to(weights, res.shape)[..., None]
+        lhs = np.einsum('mfi,mfj->mij', jac_w, jac) + 1e-12*eye
+        rhs = np.einsum('mfi,mf->mi', jac_w, res)
+        ym = np.maximum(ym-np.linalg.solve(lhs, rhs[..., None])[..., 0], ym_min)
+
+        # keep best
+        cost = cost_function(ym)
+        better = cost < cost_opt
+        ym_opt[better] = ym[better]
+        cost_opt[better] = cost[better]
+
+    D, E, F = _to_DEF(ym_opt, dwv, w0v)
+    return np.stack([D, E, F], axis=-1).reshape(batch_shape+(11, 3))
+
+
+def material_cache_dir():
+    """folder of cached material fits (PFFDTD_MATERIAL_CACHE, default ~/.cache/pffdtd/materials)"""
+    default = Path.home() / '.cache' / 'pffdtd' / 'materials'
+    return Path(os.environ.get('PFFDTD_MATERIAL_CACHE', default))
+
+
+def _fit_cache_file(Sabs, cache_dir):
+    key = hashlib.blake2b(np.ascontiguousarray(Sabs, dtype='<f8').tobytes(), digest_size=10)
+    key.update(f'oct11-v{FIT_CACHE_VERSION}'.encode())
+    return Path(cache_dir) / f'{key.hexdigest()}.h5'
+
+
+def fit_to_Sabs_oct_11_batch(mats, plot=False, verbose=False, cache=True):
+    """fit and write many materials (dict filename -> 11 Sabine octave-band coefficients)
+
+    Fits are cached on disk, keyed by the coefficients, so unchanged materials
+    are only copied from the cache.
+    """
+    mats = {Path(filename): np.asarray(Sabs, dtype=np.float64) for filename, Sabs in mats.items()}
+    for Sabs in mats.values():
+        assert Sabs.size == 11
+
+    cache_dir = material_cache_dir() if cache else None
+    todo = list(mats.keys())
+    if cache_dir is not None:
+        todo = [filename for filename in todo if not _fit_cache_file(mats[filename], cache_dir).exists()]
+    DEFs = {}
+    if len(todo) > 0:
+        DEFs = dict(zip(todo, fit_Sabs_oct_11(np.stack([mats[filename].ravel() for filename in todo]))))
+
+    for filename, Sabs in mats.items():
+        if filename in DEFs:
+            DEF = DEFs[filename]
+            if cache_dir is not None:
+                # write then rename, other processes may fit the same material
+                cache_file = _fit_cache_file(Sabs, cache_dir)
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                _write_DEF(DEF, cache_file.with_suffix(f'.tmp{os.getpid()}'))
+                os.replace(cache_file.with_suffix(f'.tmp{os.getpid()}'), cache_file)
         else:
-            i2 = np.flatnonzero(fv >= fc*np.sqrt(2))[0]
-
-        Y_target[i1:i2] = Ynm
-        w0 = 2*np.pi*fc
-        dw = w0/np.sqrt(2)  # using resonance with half-octave bandwidth
-        ymv[j] = Ynm
-        dwv[j] = dw
-        w0v[j] = w0
-
-    R_target = (1.0-Y_target)/(1.0+Y_target)
-
-    def cost_function_3(x0):
-        if np.any(x0 < 0):
-            # something big to disallow neg values
-            return np.finfo(np.float64).max
-
-        x0 = x0.reshape((-1, 3))
-        ym = x0[:, 0]
-        dw = x0[:, 1]
-        w0 = x0[:, 2]
-
-        D, E, F = _to_DEF(ym, dw, w0)
-
-        Rf_opt, Yn_opt, _, _ = compute_Rf_from_DEF(jw, D, E, F)
-        assert Yn_opt.ndim == 1
-        assert Rf_opt.ndim == 1
-        abs_opt = 1-np.abs(Rf_opt)**2
-        abs_target = 1-np.abs(R_target)**2
-        # simply fit to absorption coefficients
-        cost = np.sum(np.abs(abs_opt-abs_target))
-        # other possible cost functions
-        # cost = np.sum(np.abs(np.abs(Y_target) - np.abs(Yn_opt)))
-        # cost = np.sum(np.abs(1-np.abs(Y_target)/np.abs(Yn_opt)))
-        # cost = np.sum(np.abs(Y_target - Yn_opt))
-        # cost = np.sum(np.abs(R_target - Rf_opt))
-        return cost
-
-    # limit optimisation to just Yabs (keep bandwidths fix and w0 fixed)
-    def cost_function(x0):
-        return cost_function_3(np.c_[x0, dwv, w0v].flat[:])
-
-    # run optimisation
-    x0 = ymv
-    initial_cost = cost_function(x0)
-    # 'Powell' works well too
-    res = scpo.minimize(cost_function, x0, method='Nelder-Mead')
-    final_cost = cost_function(res.x)
-    assert final_cost <= initial_cost
-    ymv_opt = res.x
-    dwv_opt = dwv
-    w0v_opt = w0v
-
-    D, E, F = _to_DEF(ymv_opt, dwv_opt, w0v_opt)
-    DEF = np.c_[D, E, F]
-
-    # now save
-    h5f = h5py.File(filename, 'w')
+            DEF = read_mat_DEF(_fit_cache_file(Sabs, cache_dir))
+        _write_DEF(DEF, filename)
+
+        print(f'--MATERIALS: Fit {filename.stem}{"" if filename in DEFs else " (cached)"}')
+        if verbose:
+            print(f'{DEF=}')
+        if plot:
+            fv, band, _, _, _ = _oct_11_basis()
+            Y_target = np.atleast_1d(convert_Sabs_to_Yn(Sabs.ravel()))[band]
+            plot_DEF_admittance(fv, DEF, model_Rf=(1.0-Y_target)/(1.0+Y_target))
+
+
+def _write_DEF(DEF, filename):
     assert np.all(np.sum(DEF > 0, axis=-1))  # at least one non-zero
+    h5f = h5py.File(filename, 'w')
     h5f.create_dataset('DEF', data=np.atleast_2d(DEF))
     h5f.close()
 
-    print(f'--MATERIALS: Fit {Path(filename).stem}')
-    if verbose:
-        print(f'{DEF=}')
-    if plot:
-        plot_DEF_admittance(fv, np.c_[D, E, F], model_Rf=R_target)
+
+def fit_to_Sabs_oct_11(Sabs, filename, plot=False, verbose=False, cache=None):
+    # fit Yn from 11 Sabine octave-band coefficients (16Hz to 16KHz)
+    # this is a simple fitting routine that is a starting point for octave-band input data
+    # on-disk cache only if asked for, or PFFDTD_MATERIAL_CACHE is set (cache=None)
+    if cache is None:
+        cache = 'PFFDTD_MATERIAL_CACHE' in os.environ
+    fit_to_Sabs_oct_11_batch({filename: Sabs}, plot=plot, verbose=verbose, cache=cache)
 
 
 @click.command(name='admittance', help='Plot admittance from material file.')
@@ -8,7 +8,7 @@ from numpy import exp, pi, cos, sqrt, log
 from numpy.typing import ArrayLike
 from scipy.fft import dct, idct  # default type2
 from scipy.fft import rfft, irfft
-from tqdm import tqdm
+from scipy import signal
 
 from pffdtd.geometry.math import iceil, iround
 
@@ -183,7 +183,7 @@ def air_absorption(
     )
 
 
-def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0):
+def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0, Nmodes=None):
     """
     This is an implementation of an air absorption filter based on a modal approach.
     It solves a system of 1-d dissipative wave equations tune to air attenuation
@@ -192,6 +192,11 @@ def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0):
     See paper for details:
     Hamilton, B. "Adding air attenuation to simulated room impulse responses: A
     modal approach", to be presented at I3DA 2021 conference in Bologna Italy.
+
+    With Nmodes=None, there are as many modes as samples (cost O(Nt^2) per
+    channel). With fewer modes, the signal is processed in overlapping blocks
+    on a decimated modal basis: the modal filter runs over each block, and the
+    distance travelled before the block is applied as per-mode damping.
     """
 
     # apply filter, x is (Nchannel,Nsamples) array
@@ -202,15 +207,21 @@ def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0):
     Ts = 1/Fs
 
     x = np.atleast_2d(x)
+    Nch = x.shape[0]
     Nt0 = x.shape[-1]
     Nt = iceil(pad_t/Ts)+Nt0
-    xp = np.zeros((x.shape[0], Nt))
+    xp = np.zeros((Nch, Nt))
     xp[:, :Nt0] = x
     del x
 
-    y = np.zeros(xp.shape)
+    # blocks of Nb samples, with margins for spreading of kernel (before and after)
+    Nx = Nt if Nmodes is None else min(Nmodes, Nt)
+    Nmargin = 0 if Nx == Nt else Nx//8
+    Nb = Nx-2*Nmargin
+    assert Nb > 0
+    k0 = np.arange(0, Nt, Nb)  # block starts
+    Nfront = np.minimum(k0, Nmargin)
 
-    Nx = Nt
     wqTs = pi*(np.arange(Nx)/Nx)
     wq = wqTs/Ts
 
@@ -218,12 +229,9 @@ def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0):
     alphaq = rd.absfull_Np
     c = rd.c
 
-    P0 = np.zeros(xp.shape)
-    P1 = np.zeros(xp.shape)
-
-    fx = np.zeros(xp.shape)
-    fx[:, 0] = 1
-    Fm = dct(fx, type=2, norm='ortho', axis=-1)
+    fx = np.zeros(Nx)
+    fx[0] = 1
+    Fm = dct(fx, type=2, norm='ortho')
 
     sigqTs = c*alphaq*Ts
     a1 = 2*exp(-sigqTs)*cos(wqTs)
@@ -231,27 +239,45 @@ def apply_modal_filter(x, Fs, Tc, rh, pad_t=0.0):
     Fmsig1 = Fm*(1+sigqTs/2)/(1+sigqTs)
     Fmsig2 = Fm*(1-sigqTs/2)/(1+sigqTs)
 
-    u = np.zeros((xp.shape[0], Nt+1))
-    u[:, 1:] = xp[:, ::-1]  # flip
+    # flipped input segments, one per channel and block (block starts at Nfront[j] in segment)
+    u = np.zeros((Nch, k0.size, Nx+1))
+    for j in range(k0.size):
+        seg = xp[:, k0[j]:k0[j]+Nb]
+        u[:, j, Nx+1-Nfront[j]-seg.shape[-1]:Nx+1-Nfront[j]] = seg[:, ::-1]  # flip
 
-    pbar = tqdm(total=Nt, desc='modal filter', ascii=True)
+    P = np.zeros((Nch*k0.size, Nx))
+    nb_modal_filter(u.reshape(Nch*k0.size, Nx+1), a1, a2, Fmsig1, Fmsig2, P)
+    P = P.reshape(Nch, k0.size, Nx)
 
-    @nb.jit(nopython=True, parallel=True)
-    def _run_step(P0, P1, a1, a2, Fmsig1, Fmsig2, un1, un0):
-        P0[:] = a1*P1 + a2*P0 + Fmsig1*un1 - Fmsig2*un0
+    # block samples have travelled j steps, not k0+j
+    extra = (k0-Nfront).astype(np.float64)
+    if np.any(extra > 0):
+        P *= exp(-sigqTs[None, :]*extra[:, None])[None, :, :]
 
-    for n in range(Nt):
-        # P0 = a1*P1 + a2*P0 + Fmsig1*u[:,n+1] - Fmsig2*u[:,n]
-        for i in range(P0.shape[0]):
-            _run_step(P0[i], P1[i], a1, a2, Fmsig1[i],
-                      Fmsig2[i], u[i, n+1], u[i, n])
-        if n < Nt-1:  # dont swap on last sample
-            P1, P0 = P0, P1
-        pbar.update(1)
-    pbar.close()
+    yb = idct(P, type=2, norm='ortho', axis=-1)
+    y = np.zeros((Nch, Nt+Nx))
+    for j in range(k0.size):
+        y[:, k0[j]-Nfront[j]:k0[j]-Nfront[j]+Nx] += yb[:, j]
+    return np.squeeze(y[:, :Nt])  # squeeze to 1d in case
 
-    y = idct(P0, type=2, norm='ortho', axis=-1)
-    return np.squeeze(y)  # squeeze to 1d in case
+
+@nb.jit(nopython=True, parallel=True)
+def nb_modal_filter(u, a1, a2, Fmsig1, Fmsig2, P):
+    """Final modal states P (Nsig,Nx) after running all of u (Nsig,Nx+1) through the modal recursion
+    """
+    Nsig, Nx = P.shape
+    Nt = u.shape[-1]-1
+    for i in nb.prange(Nsig*Nx):
+        s = i // Nx
+        q = i % Nx
+        p0 = 0.0
+        p1 = 0.0
+        for n in range(Nt):
+            # P0 = a1*P1 + a2*P0 + Fmsig1*u[:,n+1] - Fmsig2*u[:,n]
+            p = a1[q]*p1 + a2[q]*p0 + Fmsig1[q]*u[s, n+1] - Fmsig2[q]*u[s, n]
+            p0 = p1
+            p1 = p
+        P[s, q] = p1
 
 
 def apply_ola_filter(x, Fs, Tc, rh, Nw=1024):
@@ -283,7 +309,6 @@ def apply_ola_filter(x, Fs, Tc, rh, Nw=1024):
 
     xp = np.zeros((x.shape[0], Nw+Nt0+Np))
     xp[:, Nw:Nw+Nt0] = x
-    y = np.zeros((x.shape[0], Nt0+Np))
     del x
 
     wa = 0.5*(1-np.cos(2*np.pi*np.arange(Nw)/Nw))  # hann window
@@ -294,28 +319,34 @@ def apply_ola_filter(x, Fs, Tc, rh, Nw=1024):
     c = rd.c
     absNp = rd.absfull_Np
 
-    for i in range(xp.shape[0]):
-        pbar = tqdm(total=NF, desc=f'OLA filter channel {i}', ascii=True)
-        yp = np.zeros((xp.shape[-1],))
-        for m in range(NF):
-            na0 = m*Ha
-            assert na0+Nw <= Nw+Nt0+Np
-            dist = c*Ts*(na0-Nw/2)
-            xf = xp[i, na0:na0+Nw]
-            if dist < 0:  # dont apply gain (negative times - pre-padding)
-                yp[na0:na0+Nw] += ws*xf
-            else:
-                Yf = rfft(wa*xf, Nfft)*np.exp(-absNp*dist)
-                yf = irfft(Yf, Nfft)[:Nw]
-                yp[na0:na0+Nw] += ws*yf
-
-            pbar.update(1)
-        y[i] = yp[Nw:]
-        pbar.close()
+    # all frames (channels, frames, Nw) as strided view, distance of each frame
+    na0 = np.arange(NF)*Ha
+    assert na0[-1]+Nw <= Nw+Nt0+Np
+    frames = np.lib.stride_tricks.sliding_window_view(xp, Nw, axis=-1)[:, ::Ha][:, :NF]
+    dist = c*Ts*(na0-Nw/2)
+    m0 = np.count_nonzero(dist < 0)  # dont apply gain (negative times - pre-padding)
+
+    # one batched STFT (threads over channels and frames), gains per frame and bin
+    gains = np.exp(-absNp[None, :]*dist[m0:, None])
+    Yf = rfft(wa*frames[:, m0:], Nfft, axis=-1, workers=-1)
+    Yf *= gains
+    yf = np.empty(frames.shape)
+    yf[:, :m0] = frames[:, :m0]
+    yf[:, m0:] = irfft(Yf, Nfft, axis=-1, workers=-1)[..., :Nw]
+    yf *= ws
+
+    # overlap-add: hop-sized pieces r of all frames are contiguous in output
+    R = iceil(Nw/Ha)
+    yf_pad = np.zeros(yf.shape[:-1]+(R*Ha,))
+    yf_pad[..., :Nw] = yf
+    yp = np.zeros((xp.shape[0], (NF+R)*Ha))
+    for r in reversed(range(R)):  # frames added in order, as frame by frame
+        yp[:, r*Ha:(r+NF)*Ha] += yf_pad[..., r*Ha:(r+1)*Ha].reshape(xp.shape[0], NF*Ha)
+    y = yp[:, Nw:Nw+Nt0+Np]
     return np.squeeze(y)  # squeeze to 1d in case
 
 
-def apply_visco_filter(x, Fs, Tc, rh, NdB=120, t_start=None):
+def apply_visco_filter(x, Fs, Tc, rh, NdB=120, t_start=None, rtol=1e-3, return_error=False):
     """
     This is an implementation of an air absorption filter based on approximate
     Green's function Stoke's equation (viscothermal wave equation)
@@ -324,6 +355,14 @@ def apply_visco_filter(x, Fs, Tc, rh, NdB=120, t_start=None):
     enter temperature (Tc) and relative humidity (rh)
     NdB should be above 60dB, that is for truncation of Gaussian kernel
 
+    Each sample n gets spread by a Gaussian kernel with width growing with
+    sqrt(n). Samples are processed in blocks within which the width changes by
+    at most a factor 1+rtol, with one kernel per block (convolution of the
+    whole block, all channels). The largest L1 difference between a block
+    kernel and the exact kernel of one of its samples is printed (and returned
+    with return_error=True): the output error is at most that times the L1
+    norm of the input. rtol=0 gives the exact per-sample kernels.
+
     See paper for details:
     Hamilton, B. "Air absorption filtering method based on approximate Green's
     function for Stokes' equation", to be presented at the DAFx2021 e-conference.
@@ -352,18 +391,49 @@ def apply_visco_filter(x, Fs, Tc, rh, NdB=120, t_start=None):
     Tsg2pi = 2*Ts*g*pi
     gTs = g*Ts
     dt_fac = 0.1*log(10)*NdB*gTs
-    pbar = tqdm(total=Nt, desc='visco filter', ascii=True)
-    for n in range(n_start, Nt0):
-        dt = sqrt(dt_fac*n)/Ts
-        dt_int = iceil(dt)
-        nv = np.arange(n-dt_int, n+dt_int+1)
-        assert n >= dt_int
-        y[:, nv] += (Ts/sqrt(n*Tsg2pi))*x[:, n][:, None] * \
-            exp(-((n-nv)*Ts)**2/(n*Tsg2))[None, :]
-        pbar.update(1)
-    pbar.close()
 
-    return np.squeeze(y)  # squeeze to 1d in case
+    def kernel(n, dt_int):
+        nv = np.arange(-dt_int, dt_int+1)
+        return (Ts/sqrt(n*Tsg2pi))*exp(-(nv*Ts)**2/(n*Tsg2))
+
+    if rtol == 0:
+        nb_visco_filter(np.ascontiguousarray(x, dtype=np.float64), y, n_start, Ts, Tsg2, Tsg2pi, dt_fac)
+        return (np.squeeze(y), 0.0) if return_error else np.squeeze(y)
+
+    error = 0.0
+    Nblocks = 0
+    n0 = n_start
+    while n0 < Nt0:
+        # width ~ sqrt(n), kernel of block for geometric mean of first and last sample
+        n1 = min(Nt0, max(n0+1, int(n0*(1+rtol)**2)))
+        n_block = sqrt(n0*(n1-1))
+        dt_int = iceil(sqrt(dt_fac*(n1-1))/Ts)
+        assert n0 >= dt_int
+        h = kernel(n_block, dt_int)
+        y[:, n0-dt_int:n1+dt_int] += signal.convolve(x[:, n0:n1], h[None, :])
+
+        for n in (n0, n1-1):  # largest deviations at ends of block
+            dt_n = iceil(sqrt(dt_fac*n)/Ts)
+            h_n = np.zeros(h.shape)
+            h_n[dt_int-dt_n:dt_int+dt_n+1] = kernel(n, dt_n)
+            error = max(error, np.sum(np.abs(h-h_n)))
+        Nblocks += 1
+        n0 = n1
+
+    print(f'--AIR: visco filter, {Nblocks} blocks, kernel error {error:.3e} (L1)')
+    return (np.squeeze(y), error) if return_error else np.squeeze(y)
+
+
+@nb.jit(nopython=True, parallel=True)
+def nb_visco_filter(x, y, n_start, Ts, Tsg2, Tsg2pi, dt_fac):
+    """Exact per-sample Gaussian kernels (from n_start), parallel over channels
+    """
+    for i in nb.prange(x.shape[0]):
+        for n in range(n_start, x.shape[1]):
+            dt_int = int(np.ceil(np.sqrt(dt_fac*n)/Ts))
+            a = (Ts/np.sqrt(n*Tsg2pi))*x[i, n]
+            for nv in range(n-dt_int, n+dt_int+1):
+                y[i, nv] += a*np.exp(-((n-nv)*Ts)**2/(n*Tsg2))
 
 
 def main():
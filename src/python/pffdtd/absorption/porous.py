@@ -10,7 +10,7 @@ from matplotlib.axes import Axes
 from matplotlib.ticker import ScalarFormatter
 import pandas as pd
 
-from pffdtd.absorption.admittance import convert_nabs_to_R
+from pffdtd.absorption.admittance import OCT_11_FREQS, convert_nabs_to_R
 from pffdtd.absorption.air import Air, air_density, sound_velocity, wave_number_in_air
 from pffdtd.common.plot import plot_styles
 from pffdtd.geometry.math import difference_over_sum
@@ -52,19 +52,10 @@ def reflectivity_as_alpha(refl):
     return alpha
 
 
-def porous_absorber(
-    thickness: float,
-    flow_resistivity: float,
-    frequency: ArrayLike,
-    air_gap: float | None = None,
-    angle=0.0,
-    temperature=20.0,
-    pressure=1.0,
-    offset_zeros=False,
-) -> np.ndarray:
+def _air(temperature, pressure):
     density = air_density(pressure, temperature)
     velocity = sound_velocity(temperature)
-    air = Air(
+    return Air(
         temperature=temperature,
         pressure=pressure,
         density=density,
@@ -73,6 +64,9 @@ def porous_absorber(
         tau_over_c=(2.0*np.pi)/velocity
     )
 
+
+def _porous_alpha(air: Air, thickness, flow_resistivity, frequency, air_gap, angle):
+    # arguments broadcast against each other, air_gap None for no air gap
     minus_i = complex(0.0, -1.0)
     angle_rad = np.deg2rad(angle)
     sin_phi = np.sin(angle_rad)
@@ -96,10 +90,7 @@ def porous_absorber(
     abs_refl = difference_over_sum((z_abs_surface / air.impedance) * cos_phi, 1.0)
     abs_alpha = reflectivity_as_alpha(abs_refl)
 
-    if offset_zeros:
-        abs_alpha[abs_alpha == 0.0] = np.finfo(abs_alpha.dtype).eps
-
-    if not air_gap:
+    if air_gap is None:
         return abs_alpha
 
     # --- AIR GAP ---
@@ -121,20 +112,126 @@ def porous_absorber(
 
     # Absorption coefficient for porous absorber with air gap
     abs_air_refl = difference_over_sum((abs_air_z / air.impedance) * cos_phi, 1.0)
-    abs_air_alpha = reflectivity_as_alpha(abs_air_refl)
+    return reflectivity_as_alpha(abs_air_refl)
+
 
+def porous_absorber(
+    thickness: float,
+    flow_resistivity: float,
+    frequency: ArrayLike,
+    air_gap: float | None = None,
+    angle=0.0,
+    temperature=20.0,
+    pressure=1.0,
+    offset_zeros=False,
+) -> np.ndarray:
+    air = _air(temperature, pressure)
+    alpha = _porous_alpha(air, thickness, flow_resistivity, frequency, air_gap if air_gap else None, angle)
     if offset_zeros:
-        abs_air_alpha[abs_air_alpha == 0.0] = np.finfo(abs_air_alpha.dtype).eps
+        alpha[alpha == 0.0] = np.finfo(alpha.dtype).eps
+    return alpha
 
-    return abs_air_alpha
+
+def porous_absorption(
+    thickness: ArrayLike,
+    flow_resistivity: ArrayLike,
+    frequency: ArrayLike,
+    air_gap: ArrayLike | None = None,
+    angle: ArrayLike = 0.0,
+    temperature=20.0,
+    pressure=1.0,
+    offset_zeros=False,
+) -> np.ndarray:
+    """Absorption of many porous absorber designs at once
+
+    thickness, flow_resistivity, air_gap and angle broadcast against each other
+    (e.g. thickness[:, None] and flow_resistivity[None, :] for a grid), the
+    result has their broadcast shape plus a trailing frequency axis. An air
+    gap of 0 or nan means no air gap.
+    """
+    frequency = np.asarray(frequency, dtype=np.float64)
+    assert frequency.ndim == 1
+    thickness, flow_resistivity, air_gap, angle = (
+        np.asarray(x, dtype=np.float64)[..., None]
+        for x in np.broadcast_arrays(thickness, flow_resistivity, np.nan if air_gap is None else air_gap, angle)
+    )
+    air = _air(temperature, pressure)
+
+    has_gap = np.isfinite(air_gap) & (air_gap > 0)
+    if np.any(has_gap):
+        # evaluate designs without gap with some gap, replaced below
+        alpha_gap = _porous_alpha(air, thickness, flow_resistivity, frequency, np.where(has_gap, air_gap, 1.0), angle)
+        alpha = np.where(has_gap, alpha_gap, _porous_alpha(air, thickness, flow_resistivity, frequency, None, angle))
+    else:
+        alpha = _porous_alpha(air, thickness, flow_resistivity, frequency, None, angle)
+    alpha = np.broadcast_to(alpha, thickness.shape[:-1]+frequency.shape).copy()
+
+    if offset_zeros:
+        alpha[alpha == 0.0] = np.finfo(alpha.dtype).eps
+    return alpha
+
+
+def porous_absorption_random(
+    thickness: ArrayLike,
+    flow_resistivity: ArrayLike,
+    frequency: ArrayLike,
+    air_gap: ArrayLike | None = None,
+    max_angle=90.0,
+    Nangles=32,
+    temperature=20.0,
+    pressure=1.0,
+    offset_zeros=False,
+) -> np.ndarray:
+    """Random-incidence absorption (Paris formula) of many porous absorber designs at once
+
+    Averages porous_absorption over angles of incidence up to max_angle
+    (degrees, e.g. 78 for field incidence) weighted by sin(2*angle), with
+    Gauss-Legendre quadrature. Shapes as for porous_absorption.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(Nangles)
+    max_rad = np.deg2rad(max_angle)
+    theta = 0.5*max_rad*(nodes+1.0)
+    weights = 0.5*max_rad*weights*np.sin(2.0*theta)/np.sin(max_rad)**2
+
+    shape = np.broadcast_shapes(np.shape(thickness), np.shape(flow_resistivity), np.shape(air_gap))
+    angle = np.rad2deg(theta).reshape((Nangles,)+(1,)*len(shape))
+    alpha = porous_absorption(thickness, flow_resistivity, frequency, air_gap=air_gap, angle=angle,
+                              temperature=temperature, pressure=pressure)
+    alpha = np.tensordot(weights, alpha, axes=(0, 0))
+
+    if offset_zeros:
+        alpha[alpha == 0.0] = np.finfo(alpha.dtype).eps
+    return alpha
+
+
+def porous_absorption_oct_11(
+    thickness: ArrayLike,
+    flow_resistivity: ArrayLike,
+    air_gap: ArrayLike | None = None,
+    angle: ArrayLike | str = 0.0,
+    temperature=20.0,
+    pressure=1.0,
+) -> np.ndarray:
+    """Absorption at the 11 octave bands (16Hz to 16KHz), shape (..., 11)
+
+    Zeros are offset, so the result can go straight to fit_Sabs_oct_11 or
+    fit_to_Sabs_oct_11_batch. angle='random' gives random-incidence absorption.
+    """
+    if isinstance(angle, str):
+        assert angle == 'random'
+        return porous_absorption_random(thickness, flow_resistivity, OCT_11_FREQS, air_gap=air_gap,
+                                        temperature=temperature, pressure=pressure, offset_zeros=True)
+    return porous_absorption(thickness, flow_resistivity, OCT_11_FREQS, air_gap=air_gap, angle=angle,
+                             temperature=temperature, pressure=pressure, offset_zeros=True)
 
 
 @click.command(name='porous', help='Plot porous absorption properties.')
 @click.argument('csv_file', nargs=1, type=click.Path(exists=True))
 @click.option('--angle', default=0.0, type=float)
+@click.option('--random_incidence', is_flag=True, help='average over angles of incidence')
 @click.option('--reflection', is_flag=True)
 @click.option('--temperature', default=20, type=float)
-def main(csv_file, angle, reflection, temperature):
+def main(csv_file, angle, random_incidence, reflection, temperature):
     absorbers = pd.read_csv(csv_file)
     frequency = np.linspace(20, 20_000, 1024*16)
 
@@ -144,21 +241,20 @@ def main(csv_file, angle, reflection, temperature):
     plt.rcParams.update(plot_styles)
     ax.set_title(csv_file)
 
-    for _, spec in absorbers.iterrows():
-        flow_resistivity = spec['flow_resistivity']
-        thickness = spec['thickness']
-        air_gap = spec['air_gap']
+    # all layers at once
+    flow_resistivities = absorbers['flow_resistivity'].to_numpy(dtype=np.float64)
+    thicknesses = absorbers['thickness'].to_numpy(dtype=np.float64)
+    air_gaps = absorbers['air_gap'].to_numpy(dtype=np.float64)
+    if random_incidence:
+        alphas = porous_absorption_random(thicknesses, flow_resistivities, frequency, air_gap=air_gaps,
+                                          temperature=temperature)
+    else:
+        alphas = porous_absorption(thicknesses, flow_resistivities, frequency, air_gap=air_gaps, angle=angle,
+                                   temperature=temperature)
+
+    for flow_resistivity, thickness, air_gap, absorber in zip(flow_resistivities, thicknesses, air_gaps, alphas):
         air_gap = air_gap if not np.isnan(air_gap) else None
 
-        absorber = porous_absorber(
-            thickness=thickness,
-            flow_resistivity=flow_resistivity,
-            frequency=frequency,
-            air_gap=air_gap,
-            angle=angle,
-            temperature=temperature
-        )
-
         label = f"{flow_resistivity:.0f} Pa*s/m² {thickness*100:.0f}cm"
         if air_gap:
             label += f' with {air_gap*100:.0f}cm air gap'
@@ -3,6 +3,7 @@
 
 import click
 
+from pffdtd.analysis import metrics
 from pffdtd.analysis import response
 from pffdtd.analysis import room_modes
 from pffdtd.analysis import t60
@@ -14,6 +15,7 @@ def analysis():
     pass
 
 
+analysis.add_command(metrics.main)
 analysis.add_command(response.main)
 analysis.add_command(room_modes.main)
 analysis.add_command(t60.main)
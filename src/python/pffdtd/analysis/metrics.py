@@ -0,0 +1,212 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""ISO 3382-1 room acoustic parameters per frequency band, without plotting
+
+EDT, T20 and T30 are fitted (least squares) to decay curves from backward
+(Schroeder) integration of the band filtered impulse responses, C50, C80, D50
+and Ts are energy ratios from the onset of the direct sound. All bands and
+receivers are processed at once.
+
+If the end of a response is noise (the last 10% doesn't decay), the noise
+energy is subtracted and integration stops where the decay reaches the noise
+floor (ISO 3382-1, 5.3.3). Simulated responses usually still decay at the end
+and are integrated to the end.
+
+Input is a sim dir (sim_outs_processed.h5, else the receiver WAV files) or a
+WAV file. Sim dirs are processed in parallel, results go to JSON and CSV.
+"""
+
+import csv
+import json
+from pathlib import Path
+
+import click
+import h5py
+import numpy as np
+
+from pffdtd.common.filter import FilterBank, octave_bands, third_octave_bands
+from pffdtd.common.procs import run_task_queue
+from pffdtd.common.wavfile import collect_wav_files, load_wav_files, wavread
+
+METRICS = ('EDT', 'T20', 'T30', 'C50', 'C80', 'D50', 'Ts')
+DECAY_RANGES = {'EDT': (0.0, -10.0), 'T20': (-5.0, -25.0), 'T30': (-5.0, -35.0)}  # dB
+
+
+def _print(fstring):
+    print(f'--METRICS: {fstring}')
+
+
+def onset(ir, threshold_db=-20.0):
+    """First sample per channel within threshold_db of the peak (start of the direct sound)"""
+    energy = ir**2
+    return np.argmax(energy >= np.max(energy, axis=-1, keepdims=True)*10**(threshold_db/10), axis=-1)
+
+
+def noise_floor(energy, fs, tail=0.1, flat_db=3.0, margin_db=5.0, block_ms=10.0):
+    """Noise energy per sample and truncation index per curve (last axis is time)
+
+    The mean energy of the last tail fraction counts as noise if its two halves
+    are within flat_db of each other, otherwise noise is zero and there is no
+    truncation. Truncation is at the first block (of block_ms) after the peak
+    within margin_db of the noise.
+    """
+    N = energy.shape[-1]
+    Ntail = max(2, int(N*tail))
+    first = np.mean(energy[..., -Ntail:-Ntail//2], axis=-1)
+    second = np.mean(energy[..., -Ntail//2:], axis=-1)
+    is_noise = (second > 0) & (first <= second*10**(flat_db/10))
+    noise = np.where(is_noise, np.mean(energy[..., -Ntail:], axis=-1), 0.0)
+
+    block = max(1, int(fs*block_ms/1000))
+    Nblocks = N//block
+    envelope = np.mean(energy[..., :Nblocks*block].reshape(*energy.shape[:-1], Nblocks, block), axis=-1)
+    peak = np.argmax(envelope, axis=-1)
+    below = (envelope < noise[..., None]*10**(margin_db/10)) & (np.arange(Nblocks) > peak[..., None])
+    truncation = np.where(is_noise & np.any(below, axis=-1), np.argmax(below, axis=-1)*block, N)
+    return noise, truncation
+
+
+def schroeder_decay(energy):
+    """Backward integrated energy in dB re total (last axis is time), nan where not positive"""
+    edc = np.cumsum(energy[..., ::-1], axis=-1)[..., ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edc_db = 10*np.log10(edc/edc[..., :1])
+    return np.where(edc > 0, edc_db, np.nan)
+
+
+def decay_time(edc_db, fs, start_db, end_db):
+    """Decay time (60 dB) from a least squares fit of edc_db between start_db and end_db, nan if not reached"""
+    t = np.arange(edc_db.shape[-1])/fs
+    with np.errstate(invalid='ignore'):
+        mask = (edc_db <= start_db) & (edc_db >= end_db)
+        reached = np.any(edc_db <= end_db, axis=-1)
+    y = np.where(mask, edc_db, 0.0)
+    n = np.sum(mask, axis=-1)
+    sx = mask @ t
+    sy = np.sum(y, axis=-1)
+    sxx = mask @ t**2
+    sxy = y @ t
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n*sxy-sx*sy)/(n*sxx-sx**2)
+        return np.where(reached & (n >= 2) & (slope < 0), -60.0/slope, np.nan)
+
+
+def room_metrics(ir, fs, center_freqs, fraction=1, use_noise_floor=True):
+    """ISO 3382-1 parameters of impulse responses (channels, samples) in 1/fraction octave bands
+
+    Returns a dict of metric -> array (bands, channels), decay times and Ts in s,
+    C50 and C80 in dB.
+    """
+    ir = np.atleast_2d(np.asarray(ir, dtype=np.float64))
+    energy = FilterBank.fractional_octave(fs, center_freqs, fraction).filter(ir)**2
+    if use_noise_floor:
+        noise, truncation = noise_floor(energy, fs)
+        energy -= noise[..., None]
+        energy[np.arange(energy.shape[-1]) >= truncation[..., None]] = 0.0
+
+    metrics = {}
+    edc_db = schroeder_decay(energy)
+    for name, (start_db, end_db) in DECAY_RANGES.items():
+        metrics[name] = decay_time(edc_db, fs, start_db, end_db)
+
+    # energy parameters, from the onset of the (broadband) direct sound
+    t = (np.arange(ir.shape[-1])-onset(ir)[:, None])/fs
+    energy = np.where(t >= 0, energy, 0.0)
+    total = np.sum(energy, axis=-1)
+    early = {ms: np.sum(np.where(t < ms/1000, energy, 0.0), axis=-1) for ms in (50, 80)}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics['C50'] = 10*np.log10(early[50]/(total-early[50]))
+        metrics['C80'] = 10*np.log10(early[80]/(total-early[80]))
+        metrics['D50'] = early[50]/total
+        metrics['Ts'] = np.sum(energy*np.maximum(t, 0.0), axis=-1)/total
+    return metrics
+
+
+def load_impulse_responses(path):
+    """(receiver names, fs, responses (receivers, samples)) of a sim dir or WAV file"""
+    path = Path(path)
+    if path.is_dir():
+        if (path / 'sim_outs_processed.h5').exists():
+            with h5py.File(path / 'sim_outs_processed.h5', 'r') as h5f:
+                ir = np.atleast_2d(h5f['r_out_f'][...])
+                fs = float(h5f['Fs_f'][()])
+            return [f'R{i+1:03d}' for i in range(ir.shape[0])], fs, ir
+        files = collect_wav_files(path, '*_out_normalised.wav')
+        if len(files) == 0:
+            raise RuntimeError(f'no sim_outs_processed.h5 or receiver WAV files in {path}')
+        fs, ir = load_wav_files(files)
+        return [Path(file).stem.split('_')[0] for file in files], float(fs), ir
+    fs, ir = wavread(path)
+    ir = np.atleast_2d(ir)
+    names = [path.stem] if ir.shape[0] == 1 else [f'{path.stem}:{i+1}' for i in range(ir.shape[0])]
+    return names, float(fs), ir
+
+
+def analyze(path, fmin=63.0, fmax=8000.0, fraction=1, use_noise_floor=True):
+    """Metrics of all receivers of a sim dir (or channels of a WAV file), per receiver and band"""
+    names, fs, ir = load_impulse_responses(path)
+    center_freqs = octave_bands(fmin, fmax) if fraction == 1 else third_octave_bands(fmin, fmax)
+    center_freqs = center_freqs[center_freqs*2**(1/(2*fraction)) < fs/2]
+    metrics = room_metrics(ir, fs, center_freqs, fraction, use_noise_floor)
+    return {
+        'path': str(path),
+        'fs': fs,
+        'receivers': names,
+        'bands': center_freqs.tolist(),
+        **{name: metrics[name].T.tolist() for name in METRICS},  # receivers x bands
+    }
+
+
+def run(paths, fmin=63.0, fmax=8000.0, fraction=1, use_noise_floor=True, Nprocs=1):
+    """analyze() for each path, on Nprocs processes"""
+    args_list = [(path, fmin, fmax, fraction, use_noise_floor) for path in paths]
+    if Nprocs > 1 and len(paths) > 1:
+        results, _ = run_task_queue(analyze, args_list, min(Nprocs, len(paths)), desc='metrics')
+    else:
+        results = [analyze(*args) for args in args_list]
+    for result in results:
+        _print(f'{result["path"]}: {len(result["receivers"])} receivers, {len(result["bands"])} bands')
+    return results
+
+
+def _json_value(value):
+    if isinstance(value, list):
+        return [_json_value(v) for v in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def write_json(results, filename):
+    with open(filename, 'w') as f:
+        json.dump([{key: _json_value(value) for key, value in result.items()} for result in results], f, indent=2)
+
+
+def write_csv(results, filename):
+    # one row per path, receiver and band
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'receiver', 'band', *METRICS])
+        for result in results:
+            for i, receiver in enumerate(result['receivers']):
+                for j, band in enumerate(result['bands']):
+                    writer.writerow([result['path'], receiver, band, *(result[name][i][j] for name in METRICS)])
+
+
+@click.command(name='metrics', help='ISO 3382 room acoustic parameters of sim dirs or WAV files (no plots).')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--fmin', default=63.0)
+@click.option('--fmax', default=8000.0)
+@click.option('--fraction', default=1, type=click.Choice(['1', '3']), help='octave or 1/3 octave bands')
+@click.option('--noise_floor/--no_noise_floor', default=True, help='noise subtraction and truncation')
+@click.option('--nprocs', default=1, type=int)
+@click.option('--json_file', default='metrics.json', type=click.Path())
+@click.option('--csv_file', default=None, type=click.Path())
+def main(paths, fmin, fmax, fraction, noise_floor, nprocs, json_file, csv_file):
+    results = run(paths, fmin, fmax, int(fraction), noise_floor, nprocs)
+    write_json(results, json_file)
+    _print(f'wrote {json_file}')
+    if csv_file:
+        write_csv(results, csv_file)
+        _print(f'wrote {csv_file}')
@@ -6,37 +6,66 @@ import matplotlib.pyplot as plt
 from matplotlib.ticker import ScalarFormatter
 import numpy as np
 from scipy.io import wavfile
-from tqdm import tqdm
 
 from pffdtd.common.plot import plot_styles
 from pffdtd.geometry.math import iceil
 
 
-def fractional_octave_smoothing(magnitudes, fs, nfft, fraction=3):
+def fractional_octave_bins(frequencies, fraction=3):
+    """
+    Bin ranges of fractional octave bands centered on each frequency.
+
+    Parameters:
+    - frequencies: Sorted array of bin frequencies.
+    - fraction: Fraction of the octave (e.g., 3 for 1/3 octave).
+
+    Returns:
+    - lower, upper: Arrays of bin indices, band i covers bins lower[i]:upper[i].
+    """
+    frequencies = np.asarray(frequencies)
+    lower = np.searchsorted(frequencies, frequencies / 2**(1/(2*fraction)), side='left')
+    upper = np.searchsorted(frequencies, frequencies * 2**(1/(2*fraction)), side='right')
+    return lower, upper
+
+
+def fractional_octave_smoothing(magnitudes, fs, nfft, fraction=3, mode='mean'):
     """
     Apply fractional octave smoothing to FFT magnitudes.
 
+    Runs in linear time (cumulative sums over precomputed band edges),
+    spectra can be batched along leading axes.
+
     Parameters:
-    - magnitudes: Array of FFT magnitudes.
+    - magnitudes: Array of FFT magnitudes (or dB, complex spectra), frequency on the last axis.
     - fs: Sampling rate of the signal.
     - nfft: Size of the FFT.
     - fraction: Fraction of the octave for smoothing (e.g., 3 for 1/3 octave, 6 for 1/6 octave).
+    - mode: 'mean' averages the values as given, 'power' averages |x|^2 and returns
+      the magnitude, 'complex' averages complex values.
 
     Returns:
     - smoothed: Array of smoothed FFT magnitudes.
     """
 
     frequencies = np.fft.rfftfreq(nfft, 1/fs)
-    smoothed = np.zeros_like(magnitudes)
-
-    for i in tqdm(range(magnitudes.shape[-1])):
-        fc = frequencies[i]
-        fl = fc / 2**(1/(2*fraction))
-        fu = fc * 2**(1/(2*fraction))
-        indices = np.where((frequencies >= fl) & (frequencies <= fu))[0]
-        if len(indices) > 0:
-            smoothed[i] = np.mean(magnitudes[indices])
-
+    assert magnitudes.shape[-1] == frequencies.size
+    lower, upper = fractional_octave_bins(frequencies, fraction)
+
+    if mode == 'mean':
+        values = magnitudes
+    elif mode == 'power':
+        values = np.abs(magnitudes)**2
+    elif mode == 'complex':
+        values = np.asarray(magnitudes, dtype=np.complex128)
+    else:
+        raise ValueError(f'unknown smoothing mode {mode}')
+
+    csum = np.zeros((*values.shape[:-1], values.shape[-1]+1), dtype=np.result_type(values, np.float64))
+    np.cumsum(values, axis=-1, out=csum[..., 1:])
+    smoothed = (csum[..., upper]-csum[..., lower]) / (upper-lower)
+
+    if mode == 'power':
+        return np.sqrt(smoothed)
     return smoothed
 
 
@@ -75,8 +104,7 @@ def main(filename, fmin, fmax, label_a, label_b, smoothing, target):
     dB_b += 75.0
 
     if smoothing > 0.0:
-        dB_a = fractional_octave_smoothing(dB_a, fs_a, nfft, smoothing)
-        dB_b = fractional_octave_smoothing(dB_b, fs_b, nfft, smoothing)
+        dB_a, dB_b = fractional_octave_smoothing(np.stack([dB_a, dB_b]), fs_a, nfft, smoothing)
 
     difference = dB_b-dB_a
 
@@ -10,19 +10,15 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.axes import Axes
 from matplotlib.ticker import ScalarFormatter
-from scipy import signal
 from scipy.io import wavfile
 
+from pffdtd.common.filter import FilterBank, third_octave_bands
 from pffdtd.common.plot import plot_styles
 from pffdtd.common.wavfile import collect_wav_files
 
 
 def third_octave_filter(sig, fs, center):
-    factor = 2 ** (1/6)  # One-third octave factor
-    low = center / factor
-    high = center * factor
-    sos = signal.butter(2, [low, high], btype='band', fs=fs, output='sos')
-    return signal.sosfilt(sos, sig)
+    return FilterBank.fractional_octave(fs, [center], 3).filter(sig)[0]
 
 
 def energy_decay_curve(ir):
@@ -34,23 +30,20 @@ def energy_decay_curve(ir):
 def calculate_t60(edc_db, fs):
     t = np.arange(len(edc_db)) / fs
     edc_db -= np.max(edc_db)  # Normalize to 0 dB at the start
+    if not np.any(edc_db <= -35):
+        return np.nan  # doesn't decay far enough
     start_idx = np.where(edc_db <= -5)[0][0]
     end_idx = np.where(edc_db <= -35)[0][0]
     t60 = 2 * (t[end_idx] - t[start_idx])
     return t60
 
 
-def run(files, fmin, fmax, show_all=False, show_tolerance=True, target=None):
-    # ISO 1/3 octaves
-    center_freqs = np.array([
-        20, 25, 31.5, 40, 50, 63, 80, 100, 125, 160,
-        200, 250, 315, 400, 500, 630, 800, 1000, 1250, 1600,
-        2000, 2500, 3150, 4000, 5000, 6300, 8000, 10000, 12500, 16000,
-        20000
-    ])
+def run(files, fmin, fmax, show_all=False, show_tolerance=True, target=None, plot=True):
+    """T60 in ISO 1/3 octave bands between fmin and fmax for each file, plots unless plot=False
 
-    center_freqs = center_freqs[np.where(center_freqs >= fmin)]
-    center_freqs = center_freqs[np.where(center_freqs <= fmax)]
+    Returns band center frequencies and T60 per file (files x bands).
+    """
+    center_freqs = third_octave_bands(fmin, fmax)
 
     file_times = []
     file_names = []
@@ -59,8 +52,8 @@ def run(files, fmin, fmax, show_all=False, show_tolerance=True, target=None):
         fs, ir = wavfile.read(file)
         t60_times = []
         print(f"---- {file.stem} ----")
-        for center_freq in center_freqs:
-            filtered_ir = third_octave_filter(ir, fs, center_freq)
+        filtered_irs = FilterBank.fractional_octave(fs, center_freqs, 3).filter(ir)
+        for center_freq, filtered_ir in zip(center_freqs, filtered_irs):
             edc_db = energy_decay_curve(filtered_ir)
             t60 = calculate_t60(edc_db, fs)
             t60_times.append(round(t60, 3))
@@ -69,6 +62,9 @@ def run(files, fmin, fmax, show_all=False, show_tolerance=True, target=None):
         file_times.append(np.array(t60_times))
         file_names.append(file.stem[:4])
 
+    if not plot:
+        return center_freqs, np.array(file_times)
+
     plt.rcParams.update(plot_styles)
 
     _, axs = plt.subplots(2, 1)
@@ -151,6 +147,7 @@ def run(files, fmin, fmax, show_all=False, show_tolerance=True, target=None):
         ax.legend(loc='upper right')
 
     plt.show()
+    return center_freqs, np.array(file_times)
 
 
 @click.command(name='t60', help='Plot RT60 decay times.')
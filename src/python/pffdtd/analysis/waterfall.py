@@ -8,14 +8,35 @@ import plotly.graph_objects as go
 from scipy.signal import stft
 from scipy.io import wavfile
 
+from pffdtd.common.filter import FilterBank, third_octave_bands
+
+
+def band_waterfall(rir, fs, fraction=3, nperseg=1024, fmin=20.0):
+    """Energy (dB) per fractional octave band and frame (hop of nperseg/2), like the STFT waterfall"""
+    if fraction == 3:
+        center_freqs = third_octave_bands(fmin, fs/2/2**(1/6))
+    else:
+        center_freqs = 1000.0*2**(np.arange(np.ceil(fraction*np.log2(fmin/1000)), fraction*np.log2(fs/2/1000)-0.5)/fraction)
+    bands = FilterBank.fractional_octave(fs, center_freqs, fraction).filter(rir)
+    hop = nperseg//2
+    Nframes = bands.shape[-1]//hop
+    energy = np.mean(bands[:, :Nframes*hop].reshape(len(center_freqs), Nframes, hop)**2, axis=-1)
+    times = (np.arange(Nframes)+0.5)*hop/fs
+    return center_freqs, times, 10*np.log10(energy+np.spacing(1))
+
 
 @click.command(name='waterfall', help='Plot waterfall decay plot.')
 @click.argument('filename', nargs=1, type=click.Path(exists=True))
-def main(filename):
+@click.option('--fraction', default=0, help='1/N octave bands instead of STFT bins (0 for STFT)')
+def main(filename, fraction):
     fs, rir = wavfile.read(filename)
     rir = rir / np.max(np.abs(rir))  # Normalize
     nfft = 1024
-    frequencies, times, Zxx = stft(rir, fs=fs, nperseg=nfft)
+    if fraction > 0:
+        frequencies, times, Z = band_waterfall(rir, fs, fraction, nfft)
+        Zxx = 10**(Z/20)*nfft  # magnitude, same scale as below
+    else:
+        frequencies, times, Zxx = stft(rir, fs=fs, nperseg=nfft)
 
     decay_time = np.zeros(frequencies.shape)
     for i, _ in enumerate(frequencies):
@@ -63,5 +84,5 @@ def main(filename):
     plt.xlabel('Time [s]')
     plt.ylabel('Frequency [Hz]')
     plt.yscale('log')
-    plt.ylim([frequencies[1], fs / 2])
+    plt.ylim([frequencies[1 if fraction <= 0 else 0], fs / 2])
     plt.show()
@@ -8,6 +8,8 @@ from pffdtd.analysis.cli import analysis
 from pffdtd.diffusor.cli import diffusor
 from pffdtd.sim2d.cli import sim2d
 from pffdtd.sim3d.cli import sim3d
+from pffdtd.sim3d.optimize_materials import main as optimize_materials
+from pffdtd.sim3d.sweep import main as sweep
 
 
 @click.group()
@@ -23,3 +25,5 @@ main.add_command(analysis)
 main.add_command(diffusor)
 main.add_command(sim2d)
 main.add_command(sim3d)
+main.add_command(optimize_materials)
+main.add_command(sweep)
@@ -1,27 +1,45 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2021 Brian Hamilton
 
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numba as nb
 import numpy as np
 from scipy.signal import butter, bilinear_zpk, zpk2sos, sosfilt, lfilter
 
 
+def lowcut_sos(fs, fcut, order, apply_int):
+    # lowcut design (for fcut>0), optionally combined with integrator
+    dt = 1/fs
+    assert fcut > 0
+    if apply_int:
+        # design combined butter filter with integrator
+        Wn = fcut*2*np.pi
+        z, p, k = butter(order, Wn, btype='high',
+                         analog=True, output='zpk')
+        assert np.all(z == 0.0)
+        z = z[1:]  # remove one zero
+        zd, pd, kd = bilinear_zpk(z, p, k, 1/dt)
+        return zpk2sos(zd, pd, kd)
+    # design digital high-pass
+    return butter(order, 2*dt*fcut, btype='high', output='sos')
+
+
+def lowpass_sos(fs, fcut, order=8, symmetric=True):
+    # lowpass design, half the order if run twice (symmetric)
+    dt = 1/fs
+    if symmetric:  # will be run twice
+        assert order % 2 == 0
+        order = int(order//2)
+    return butter(order, 2*dt*fcut, btype='low', output='sos')
+
+
 def apply_lowcut(y, fs, fcut, order, apply_int):
     dt = 1/fs
 
     if fcut > 0:
-        if apply_int:
-            # design combined butter filter with integrator
-            Wn = fcut*2*np.pi
-            z, p, k = butter(order, Wn, btype='high',
-                             analog=True, output='zpk')
-            assert np.all(z == 0.0)
-            z = z[1:]  # remove one zero
-            zd, pd, kd = bilinear_zpk(z, p, k, 1/dt)
-            sos = zpk2sos(zd, pd, kd)
-        else:
-            # design digital high-pass
-            sos = butter(order, 2*dt*fcut, btype='high', output='sos')
-        return sosfilt(sos, y)
+        return sosfilt(lowcut_sos(fs, fcut, order, apply_int), y)
 
     if apply_int:
         # shouldn't really use this without lowcut, but here in case
@@ -34,17 +52,111 @@ def apply_lowcut(y, fs, fcut, order, apply_int):
 
 def apply_lowpass(y, fs, fcut, order=8, symmetric=True):
     # lowpass filter for fmax (to remove freqs with too much numerical dispersion)
-    dt = 1/fs
-    y_out = np.copy(y)
-
-    if symmetric:  # will be run twice
-        assert order % 2 == 0
-        order = int(order//2)
-
-    # design digital high-pass
-    sos = butter(order, 2*dt*fcut, btype='low', output='sos')
-    y_out = sosfilt(sos, y_out)
+    sos = lowpass_sos(fs, fcut, order, symmetric)
+    y_out = sosfilt(sos, y)
     if symmetric:  # runs again, time reversed
         y_out = sosfilt(sos, y_out[:, ::-1])[:, ::-1]
 
     return y_out
+
+
+def sosfilt_inplace(sos, y, reverse=False):
+    """scipy.signal.sosfilt along last axis of y (ndim<=2), in place
+
+    reverse=True runs the filter backwards in time (no reversed copies)
+    """
+    sos = np.ascontiguousarray(sos, dtype=np.float64)
+    assert np.all(sos[:, 3] == 1.0)
+    assert y.dtype == np.float64
+    nb_sosfilt(sos, y.reshape(-1, y.shape[-1]), reverse)
+    return y
+
+
+def third_octave_bands(fmin, fmax):
+    """ISO 1/3 octave center frequencies between fmin and fmax"""
+    center_freqs = np.array([
+        20, 25, 31.5, 40, 50, 63, 80, 100, 125, 160,
+        200, 250, 315, 400, 500, 630, 800, 1000, 1250, 1600,
+        2000, 2500, 3150, 4000, 5000, 6300, 8000, 10000, 12500, 16000,
+        20000
+    ])
+    return center_freqs[(center_freqs >= fmin) & (center_freqs <= fmax)]
+
+
+def octave_bands(fmin, fmax):
+    """ISO octave center frequencies between fmin and fmax"""
+    center_freqs = np.array([31.5, 63, 125, 250, 500, 1000, 2000, 4000, 8000, 16000])
+    return center_freqs[(center_freqs >= fmin) & (center_freqs <= fmax)]
+
+
+class FilterBank:
+    """Bandpass filterbank (Butterworth SOS), filters (channels, samples) into (bands, channels, samples)
+
+    Coefficients are designed once per (fs, bands, order) and shared between instances.
+    """
+    _sos_cache = {}
+
+    def __init__(self, fs, bands, order=2):
+        self.fs = float(fs)
+        self.bands = tuple((float(low), float(high)) for low, high in bands)
+        self.order = int(order)
+        key = (self.fs, self.bands, self.order)
+        if key not in FilterBank._sos_cache:
+            sos = np.stack([butter(self.order, band, btype='band', fs=self.fs, output='sos') for band in self.bands])
+            sos.flags.writeable = False
+            FilterBank._sos_cache[key] = sos
+        self.sos = FilterBank._sos_cache[key]
+
+    @classmethod
+    def fractional_octave(cls, fs, center_freqs, fraction=3, order=2):
+        # bands from center/2^(1/2N) to center*2^(1/2N) for 1/N octave
+        factor = 2**(1/(2*fraction))
+        return cls(fs, [(fc/factor, fc*factor) for fc in center_freqs], order)
+
+    def filter(self, x, nthreads=None):
+        # same result as scipy.signal.sosfilt per band, bands in parallel on threads
+        # (nogil kernel, TBB threading layer is not fork-safe, so no numba parallel here)
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        Nb = len(self.bands)
+        y = np.empty((Nb, *x.shape))
+        x_2d = x.reshape(-1, x.shape[-1])
+        y_3d = y.reshape(Nb, -1, x.shape[-1])
+        nthreads = min(nthreads or os.cpu_count() or 1, Nb)
+        if nthreads == 1:
+            nb_filterbank(self.sos, x_2d, y_3d)
+            return y
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            for _ in pool.map(lambda b: nb_filterbank(self.sos[b:b+1], x_2d, y_3d[b:b+1]), range(Nb)):
+                pass
+        return y
+
+
+@nb.jit(nopython=True, parallel=False, nogil=True)
+def nb_sosfilt_row(sos, y, reverse):
+    # direct form II transposed, same operations as scipy's sosfilt
+    Ns = sos.shape[0]
+    Nt = y.shape[0]
+    zi = np.zeros((Ns, 2))
+    for m in range(Nt):
+        n = Nt-1-m if reverse else m
+        x_cur = y[n]
+        for s in range(Ns):
+            x_new = sos[s, 0]*x_cur + zi[s, 0]
+            zi[s, 0] = sos[s, 1]*x_cur - sos[s, 4]*x_new + zi[s, 1]
+            zi[s, 1] = sos[s, 2]*x_cur - sos[s, 5]*x_new
+            x_cur = x_new
+        y[n] = x_cur
+
+
+@nb.jit(nopython=True, parallel=False, nogil=True)
+def nb_sosfilt(sos, y, reverse):
+    for i in range(y.shape[0]):
+        nb_sosfilt_row(sos, y[i], reverse)
+
+
+@nb.jit(nopython=True, parallel=False, nogil=True)
+def nb_filterbank(sos, x, y):
+    for b in range(y.shape[0]):
+        for c in range(y.shape[1]):
+            y[b, c, :] = x[c]
+            nb_sosfilt_row(sos[b], y[b, c], False)
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2021 Brian Hamilton
 
+import hashlib
 import multiprocessing as mp
 from pathlib import Path
 
@@ -9,6 +10,12 @@ def get_default_nprocs():
     return max(1, int(0.8*mp.cpu_count()))
 
 
+def file_hash(file):
+    # content hash (hex), for caches keyed on input files
+    with open(file, 'rb') as f:
+        return hashlib.file_digest(f, 'blake2b').hexdigest()
+
+
 def ensure_folder_exists(folder):
     folder = Path(folder)
     if not folder.exists():
@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Helpers for multiprocessing workers that pass results back to the parent.
+
+Workers are forked (closures over large read-only data are fine) and send
+their result through a queue (pipe) instead of intermediate files, so
+several setups can run in the same directory without clobbering each other.
+
+Tasks are pulled by workers from a shared queue (largest estimated cost
+first), so tasks of very different sizes still balance across workers.
+"""
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+
+def run_task_queue(target, args_list, Nprocs, costs=None, desc=None, poll_interval=1.0, on_result=None):
+    """Run target(*args) for each entry of args_list on Nprocs worker processes.
+
+    Workers pull task indices from a shared queue, in order of decreasing cost
+    (if costs given). Returns the list of return values (in order of args_list)
+    and per-worker stats (dicts with 'tasks', 'busy' and 'wall' times in s).
+    Progress (tasks done) shown in parent if desc given. Raises if a worker dies
+    without finishing. If on_result given, it is called in the parent as
+    on_result(task_idx, result) as results arrive, and results are not kept.
+    """
+    Ntasks = len(args_list)
+    if costs is None:
+        order = np.arange(Ntasks)
+    else:
+        order = np.argsort(-np.asarray(costs, dtype=np.float64), kind='stable')
+
+    task_queue = mp.Queue()
+    for task_idx in order:
+        task_queue.put(int(task_idx))
+    for _ in range(Nprocs):
+        task_queue.put(None)  # one stop sentinel per worker
+    result_queue = mp.Queue()
+
+    def _worker(proc_idx):
+        t_start = time.perf_counter()
+        busy = 0.0
+        Ndone = 0
+        while (task_idx := task_queue.get()) is not None:
+            t0 = time.perf_counter()
+            result = target(*args_list[task_idx])
+            busy += time.perf_counter() - t0
+            Ndone += 1
+            result_queue.put((task_idx, result))
+        result_queue.put((None, (proc_idx, {'tasks': Ndone, 'busy': busy, 'wall': time.perf_counter()-t_start})))
+
+    procs = [mp.Process(target=_worker, args=(proc_idx,)) for proc_idx in range(Nprocs)]
+    for proc in procs:
+        proc.start()
+
+    # drain queue before joining (large results would otherwise block the feeder)
+    results = [None]*Ntasks
+    stats = [None]*Nprocs
+    pbar = tqdm(total=Ntasks, desc=desc, ascii=True, leave=False, position=0, disable=desc is None)
+    Nreceived = 0
+    while Nreceived < Ntasks + Nprocs:
+        try:
+            task_idx, result = result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            for proc_idx, proc in enumerate(procs):
+                if stats[proc_idx] is None and proc.exitcode not in (None, 0):
+                    for other in procs:
+                        other.terminate()
+                    raise RuntimeError(f'worker process {proc_idx} failed with exit code {proc.exitcode}')
+            continue
+        if task_idx is None:
+            proc_idx, stats[proc_idx] = result
+        else:
+            if on_result is None:
+                results[task_idx] = result
+            else:
+                on_result(task_idx, result)
+            pbar.update(1)
+        Nreceived += 1
+    pbar.close()
+
+    for proc in procs:
+        proc.join()
+
+    return results, stats
+
+
+def worker_utilisation(stats):
+    """Lines reporting tasks and busy time per worker (as % of the longest-running worker)."""
+    elapsed = max(max(s['wall'] for s in stats), 1e-12)
+    return [f'worker {proc_idx:02d}: {s["tasks"]} tasks, busy {s["busy"]:.2f} s ({100.0*s["busy"]/elapsed:.1f} %)'
+            for proc_idx, s in enumerate(stats)]
+
+
+def cost_chunks(costs, Nchunks):
+    """Group tasks (sorted by decreasing cost) into about Nchunks chunks of similar total cost.
+
+    Tasks costing more than a chunk's share get a chunk of their own. Returns a
+    list of index arrays and the cost of each chunk.
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    order = np.argsort(-costs, kind='stable')
+    target = max(np.sum(costs)/max(Nchunks, 1), 1e-300)
+    chunks = []
+    chunk_costs = []
+    start = 0
+    acc = 0.0
+    for i, idx in enumerate(order):
+        acc += costs[idx]
+        if acc >= target or i == order.size-1:
+            chunks.append(order[start:i+1])
+            chunk_costs.append(acc)
+            start = i+1
+            acc = 0.0
+    return chunks, chunk_costs
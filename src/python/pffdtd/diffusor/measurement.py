@@ -3,20 +3,16 @@
 from pathlib import Path
 
 import click
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy import signal
 
+from pffdtd.common.filter import FilterBank
 from pffdtd.common.wavfile import collect_wav_files, load_wav_files
+from pffdtd.sim3d.container import SimData
 
 
 def bandpass_filter(y, lowcut, highcut, fs, order=8):
-    nyquist = 0.5 * fs
-    low = lowcut / nyquist
-    high = highcut / nyquist
-    sos = signal.butter(order, [low, high], btype='band', output='sos')
-    return signal.sosfilt(sos, y, axis=-1)
+    return FilterBank(fs, [(lowcut, highcut)], order).filter(y)[0]
 
 
 def polar_response(y: np.array, fs: float, min_angle=0, max_angle=180, trim_angle=5):
@@ -37,8 +33,8 @@ def polar_response(y: np.array, fs: float, min_angle=0, max_angle=180, trim_angl
     impulse = y[trim_angle:-trim_angle, :]
 
     bands = []
-    for lowcut, highcut in octave_bands:
-        band = bandpass_filter(impulse, lowcut, highcut, fs)
+    filtered = FilterBank(fs, octave_bands, order=8).filter(impulse)
+    for (lowcut, highcut), band in zip(octave_bands, filtered):
         label = f'{lowcut}-{highcut} Hz'
         bands.append((np.sqrt(np.mean(band**2, axis=1)), label))
 
@@ -57,8 +53,8 @@ def main(sim_dir):
     files = collect_wav_files(sim_dir, '*_out_normalised.wav')
     fs, out = load_wav_files(files)
 
-    constants = h5py.File(sim_dir / 'constants.h5', 'r')
-    fmax = float(constants['fmax'][...])
+    with SimData(sim_dir) as sim_data:
+        fmax = float(sim_data.read('constants', 'fmax'))
     trim_ms = 20
     trim_samples = int(fs/1000*trim_ms)
 
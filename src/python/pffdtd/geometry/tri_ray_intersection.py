@@ -4,6 +4,7 @@
 """Triangle-ray intersection routines.
 
 One single ray / triangle, and one vectorised for one-ray-many-tri or one-tri-many-ray
+A scalar numba version (same floating-point ops as vectorised) for compiled loops
 some tests (__main__ entry)
 
 returns boolean for hit. distance is Inf when no hit
@@ -13,6 +14,7 @@ you may need to tailor for other uses (e..g, may fail for degenerate
 triangles, pruned first here)
 """
 
+import numba as nb
 import numpy as np
 from numpy import array as npa
 from pffdtd.geometry.math import dotv, normalise, vecnorm
@@ -116,6 +118,45 @@ def tri_ray_intersection_vec(ray_o, ray_d, tris_pre, d_eps=1e-6, cp_eps=1e-6):
     return ~fail, t_ret
 
 
+@nb.jit(nopython=True)
+def nb_tri_ray_intersection(ox, oy, oz, rdx, rdy, rdz, tri_v, tri_unor, tri_cent,
+                            tri_eab_unor, tri_ebc_unor, tri_eca_unor, d_eps, cp_eps):
+    # one ray (normalised direction) / one tri, returns distance or np.inf if no hit
+    # same ops in same order as tri_ray_intersection_vec (bit-identical distances)
+    ux, uy, uz = tri_unor[0], tri_unor[1], tri_unor[2]
+
+    # check if coplanar
+    beta = rdx*ux + rdy*uy + rdz*uz
+    if np.abs(beta) < cp_eps:
+        return np.inf
+
+    # get distance to plane
+    t = (ux*(tri_cent[0]-ox) + uy*(tri_cent[1]-oy) + uz*(tri_cent[2]-oz))/beta
+    if t < 0:
+        return np.inf
+
+    # get point on plane
+    px = ox + rdx*t
+    py = oy + rdy*t
+    pz = oz + rdz*t
+
+    # check inside edge vectors with distance epsilon
+    if ((px-0.5*(tri_v[0, 0]+tri_v[1, 0]))*tri_eab_unor[0]
+            + (py-0.5*(tri_v[0, 1]+tri_v[1, 1]))*tri_eab_unor[1]
+            + (pz-0.5*(tri_v[0, 2]+tri_v[1, 2]))*tri_eab_unor[2]) > d_eps:
+        return np.inf
+    if ((px-0.5*(tri_v[1, 0]+tri_v[2, 0]))*tri_ebc_unor[0]
+            + (py-0.5*(tri_v[1, 1]+tri_v[2, 1]))*tri_ebc_unor[1]
+            + (pz-0.5*(tri_v[1, 2]+tri_v[2, 2]))*tri_ebc_unor[2]) > d_eps:
+        return np.inf
+    if ((px-0.5*(tri_v[2, 0]+tri_v[0, 0]))*tri_eca_unor[0]
+            + (py-0.5*(tri_v[2, 1]+tri_v[0, 1]))*tri_eca_unor[1]
+            + (pz-0.5*(tri_v[2, 2]+tri_v[0, 2]))*tri_eca_unor[2]) > d_eps:
+        return np.inf
+
+    return t
+
+
 def main():
     # some randomized tests
     import numpy.random as npr
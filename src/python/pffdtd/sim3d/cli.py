@@ -3,6 +3,7 @@
 
 import click
 
+from pffdtd.sim3d import container
 from pffdtd.sim3d import engine
 from pffdtd.sim3d import process_outputs
 from pffdtd.sim3d import room_geometry
@@ -14,6 +15,8 @@ def sim3d():
     pass
 
 
+sim3d.add_command(container.pack)
+sim3d.add_command(container.unpack)
 sim3d.add_command(engine.main)
 sim3d.add_command(process_outputs.main)
 sim3d.add_command(room_geometry.main)
@@ -0,0 +1,192 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Consolidated simulation container (optional alternative to separate .h5 files)
+
+A sim dir normally holds five HDF5 files (constants, cart_grid, signals,
+materials, vox_out). The container stores the same datasets as groups of one
+file (sim_data.h5), in a more compact form:
+  - bool matrices (adj_bn) bit-packed along rows
+  - integer arrays stored with the narrowest integer type that fits
+  - sorted integer arrays (e.g. gpu-sorted bn_ixyz) delta-encoded
+  - arrays chunked with shuffle+LZF compression (fast to decode)
+
+Encoded datasets keep their original dtype and shape as attributes, so
+reading through SimData gives back exactly what was packed. SimData reads
+from either layout (the compatibility shim for Python readers), and
+unpack_sim_dir writes the separate files back for the C++ engine.
+"""
+
+from pathlib import Path
+
+import click
+import h5py
+import numpy as np
+
+SIM_CONTAINER_VERSION = 1
+SIM_CONTAINER_FILE = 'sim_data.h5'
+SIM_GROUPS = ('constants', 'cart_grid', 'signals', 'materials', 'vox_out')
+
+
+class SimData:
+    """Read-only access to sim data, from the container or the separate files
+
+    Use as context manager. read(group, name) returns a (decoded) dataset,
+    read(group, name, out=arr) decodes straight into a preallocated array.
+    """
+
+    def __init__(self, sim_dir):
+        self.sim_dir = Path(sim_dir)
+        self.is_container = (self.sim_dir / SIM_CONTAINER_FILE).exists()
+        self._files = {}
+        if self.is_container:
+            h5f = h5py.File(self.sim_dir / SIM_CONTAINER_FILE, 'r')
+            version = h5f.attrs.get('version', -1)
+            if not 1 <= version <= SIM_CONTAINER_VERSION:
+                h5f.close()
+                raise ValueError(f'unsupported sim container version {version} in {self.sim_dir}')
+            self._files[None] = h5f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for h5f in self._files.values():
+            h5f.close()
+        self._files = {}
+
+    def group(self, group):
+        if self.is_container:
+            return self._files[None][group]
+        if group not in self._files:
+            self._files[group] = h5py.File(self.sim_dir / f'{group}.h5', 'r')
+        return self._files[group]
+
+    def keys(self, group):
+        return list(self.group(group).keys())
+
+    def shape(self, group, name):
+        ds = self.group(group)[name]
+        return tuple(ds.attrs['shape']) if 'encoding' in ds.attrs else ds.shape
+
+    def read(self, group, name, out=None, mmap=False):
+        """Dataset as array (or into out). With mmap=True, datasets stored
+        contiguously (uncompressed, separate files) are memory-mapped
+        read-only instead of read."""
+        ds = self.group(group)[name]
+        encoding = ds.attrs.get('encoding', None)
+        if encoding is None:
+            if mmap and out is None and (offset := _contiguous_offset(ds)) is not None:
+                return np.memmap(ds.file.filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+            if out is None:
+                return ds[()]
+            assert out.shape == ds.shape
+            if out.size > 0:
+                ds.read_direct(out)
+            return out
+
+        shape = tuple(ds.attrs['shape'])
+        if out is None:
+            out = np.empty(shape, dtype=np.dtype(ds.attrs['dtype']))
+        assert out.shape == shape
+        if encoding == 'int':
+            if out.size > 0:
+                ds.read_direct(out)
+        elif encoding == 'delta':
+            out[0] = ds.attrs['start']
+            np.cumsum(ds[()], dtype=out.dtype, out=out[1:])
+            out[1:] += out[0]
+        elif encoding == 'bits':
+            out[...] = np.unpackbits(ds[()], axis=-1, count=shape[-1], bitorder='little').view(bool)
+        else:
+            raise ValueError(f'unknown encoding {encoding} for {group}/{name}')
+        return out
+
+
+def _contiguous_offset(ds):
+    # byte offset of dataset in file if it can be memory-mapped, else None
+    if ds.ndim == 0 or ds.size == 0 or ds.chunks is not None or ds.dtype.kind not in 'biuf':
+        return None
+    return ds.id.get_offset()
+
+
+def _narrowest_int(vmin, vmax):
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= vmin and vmax <= info.max:
+            return dtype
+    return np.int64
+
+
+def _write_dataset(group, name, data, compress):
+    data = np.asarray(data)
+    if data.ndim == 0 or data.size == 0 or data.dtype.kind not in 'biuf':
+        group.create_dataset(name, data=data)
+        return
+
+    attrs = {'dtype': data.dtype.str, 'shape': data.shape}
+    if data.dtype == np.bool_ and data.ndim == 2:
+        attrs['encoding'] = 'bits'
+        data = np.packbits(data, axis=-1, bitorder='little')
+    elif np.issubdtype(data.dtype, np.integer):
+        if data.ndim == 1 and data.size > 1 and np.all(data[1:] >= data[:-1]):
+            attrs['encoding'] = 'delta'
+            attrs['start'] = data[0]
+            data = np.diff(data)
+        else:
+            attrs['encoding'] = 'int'
+        data = data.astype(_narrowest_int(data.min(), data.max()), copy=False)
+    else:
+        attrs = {}
+    ds = group.create_dataset(name, data=data, chunks=True, shuffle=True, compression=compress)
+    ds.attrs.update(attrs)
+
+
+def pack_sim_dir(sim_dir, remove=False, compress='lzf'):
+    """Pack the separate .h5 files of a sim dir into one container (optionally removing them)"""
+    sim_dir = Path(sim_dir)
+    files = [sim_dir / f'{group}.h5' for group in SIM_GROUPS]
+    size_in = sum(file.stat().st_size for file in files)
+    with h5py.File(sim_dir / SIM_CONTAINER_FILE, 'w') as h5c:
+        h5c.attrs['version'] = SIM_CONTAINER_VERSION
+        for group, file in zip(SIM_GROUPS, files):
+            grp = h5c.create_group(group)
+            with h5py.File(file, 'r') as h5f:
+                for name in h5f.keys():
+                    _write_dataset(grp, name, h5f[name][()], compress)
+    size_out = (sim_dir / SIM_CONTAINER_FILE).stat().st_size
+    print(f'--CONTAINER: packed {sim_dir}: {size_in/2**20:.3f} MiB -> {size_out/2**20:.3f} MiB')
+    if remove:
+        for file in files:
+            file.unlink()
+
+
+def unpack_sim_dir(sim_dir, remove=False):
+    """Write the separate .h5 files of a sim dir back from its container (for the C++ engine)"""
+    sim_dir = Path(sim_dir)
+    with SimData(sim_dir) as sim_data:
+        assert sim_data.is_container
+        for group in SIM_GROUPS:
+            with h5py.File(sim_dir / f'{group}.h5', 'w') as h5f:
+                for name in sim_data.keys(group):
+                    h5f.create_dataset(name, data=sim_data.read(group, name))
+    print(f'--CONTAINER: unpacked {sim_dir}')
+    if remove:
+        (sim_dir / SIM_CONTAINER_FILE).unlink()
+
+
+@click.command(name='pack', help='Pack sim data into one container file.')
+@click.argument('sim_dir', nargs=1, type=click.Path(exists=True))
+@click.option('--remove', is_flag=True, help='remove separate .h5 files')
+def pack(sim_dir, remove):
+    pack_sim_dir(sim_dir, remove=remove)
+
+
+@click.command(name='unpack', help='Unpack sim data container into separate files.')
+@click.argument('sim_dir', nargs=1, type=click.Path(exists=True))
+@click.option('--remove', is_flag=True, help='remove container file')
+def unpack(sim_dir, remove):
+    unpack_sim_dir(sim_dir, remove=remove)
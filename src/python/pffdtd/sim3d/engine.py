@@ -27,6 +27,7 @@ from tqdm import tqdm
 from pffdtd.common.timerdict import TimerDict
 from pffdtd.common.misc import get_default_nprocs
 from pffdtd.geometry.math import ind2sub3d, rel_diff
+from pffdtd.sim3d.container import SimData
 
 MMb = 12  # max allowed number of branches
 
@@ -40,11 +41,15 @@ class EnginePython3D:
         self.print(f'numba set for {nthreads=}')
         nb.set_num_threads(nthreads)
 
+        timer = TimerDict()
+        timer.tic('load')
         self.load_h5_data()
         self.setup_mask()
         self.allocate_mem()
         self.set_coeffs()
         self.checks()
+        self.t_load = timer.toc('load', print_elapsed=False)
+        self.print(f'Load time: {self.t_load:.6f}')
 
     def print(self, fstring):
         print(f'--ENGINE: {fstring}')
@@ -58,43 +63,44 @@ class EnginePython3D:
         # bnl: bn-lossy (fd updates)
         # bnl ∩ bnr = ø , bnl ∪ bnr = bn
 
-        h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r')
-        self.adj_bn = h5f['adj_bn'][...]  # full
-        self.bn_ixyz = h5f['bn_ixyz'][...]  # full
-        self.Nx = h5f['Nx'][()]
-        self.Ny = h5f['Ny'][()]
-        self.Nz = h5f['Nz'][()]
-        self.xv = h5f['xv'][()]  # for plotting
-        self.yv = h5f['yv'][()]  # for plotting
-        self.zv = h5f['zv'][()]  # for plotting
-        mat_bn = h5f['mat_bn'][...]
-        saf_bn = h5f['saf_bn'][...]
-        h5f.close()
-
-        ii = mat_bn > -1
-        self.saf_bnl = saf_bn[ii]
-        self.mat_bnl = mat_bn[ii]
-        self.bnl_ixyz = self.bn_ixyz[ii]
-
-        h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
-        self.in_ixyz = h5f['in_ixyz'][...]
-        self.out_ixyz = h5f['out_ixyz'][...]
-        self.out_alpha = h5f['out_alpha'][...]
-        self.out_reorder = h5f['out_reorder'][...]
-        self.in_sigs = h5f['in_sigs'][...]
-        self.Ns = h5f['Ns'][()]
-        self.Nr = h5f['Nr'][()]
-        self.Nt = h5f['Nt'][()]
-        h5f.close()
-
-        h5f = h5py.File(sim_dir / Path('constants.h5'), 'r')
-        self.c = h5f['c'][()]
-        self.h = h5f['h'][()]
-        self.Ts = h5f['Ts'][()]
-        self.l = h5f['l'][()]
-        self.l2 = h5f['l2'][()]
-        self.fcc_flag = h5f['fcc_flag'][()]
-        h5f.close()
+        # reads separate .h5 files or the consolidated container
+        # bn data stored contiguously is memory-mapped (paged in on first use)
+        with SimData(sim_dir) as sim_data:
+            self.c = sim_data.read('constants', 'c')
+            self.h = sim_data.read('constants', 'h')
+            self.Ts = sim_data.read('constants', 'Ts')
+            self.l = sim_data.read('constants', 'l')
+            self.l2 = sim_data.read('constants', 'l2')
+            self.fcc_flag = sim_data.read('constants', 'fcc_flag')
+
+            self.Nx = sim_data.read('vox_out', 'Nx')
+            self.Ny = sim_data.read('vox_out', 'Ny')
+            self.Nz = sim_data.read('vox_out', 'Nz')
+            self.xv = sim_data.read('vox_out', 'xv')  # for plotting
+            self.yv = sim_data.read('vox_out', 'yv')  # for plotting
+            self.zv = sim_data.read('vox_out', 'zv')  # for plotting
+            self.adj_bn = sim_data.read('vox_out', 'adj_bn', mmap=True)  # full
+            self.bn_ixyz = sim_data.read('vox_out', 'bn_ixyz', mmap=True)  # full
+            mat_bn = sim_data.read('vox_out', 'mat_bn', mmap=True)
+            saf_bn = sim_data.read('vox_out', 'saf_bn', mmap=True)
+
+            self.in_ixyz = sim_data.read('signals', 'in_ixyz')
+            self.out_ixyz = sim_data.read('signals', 'out_ixyz')
+            self.out_alpha = sim_data.read('signals', 'out_alpha')
+            self.out_reorder = sim_data.read('signals', 'out_reorder')
+            self.in_sigs = sim_data.read('signals', 'in_sigs', mmap=True)
+            self.Ns = sim_data.read('signals', 'Ns')
+            self.Nr = sim_data.read('signals', 'Nr')
+            self.Nt = sim_data.read('signals', 'Nt')
+
+            Nmat = sim_data.read('materials', 'Nmat')
+            Mb = sim_data.read('materials', 'Mb')
+            DEF = np.zeros((Nmat, MMb, 3))
+            for i in range(Nmat):
+                assert Mb[i] <= MMb
+                assert sim_data.shape('materials', f'mat_{i:02d}_DEF') == (Mb[i], 3)
+                sim_data.read('materials', f'mat_{i:02d}_DEF', out=DEF[i, :Mb[i]])
+                self.print(f'mat {i}, Mb={Mb[i]}, DEF={DEF[i, :Mb[i]]}')
 
         self.fcc = self.fcc_flag > 0
         if self.fcc:
@@ -111,27 +117,21 @@ class EnginePython3D:
             assert self.Nz % 2 == 0
             self.print('On FCC subgrid')
             assert self.adj_bn.shape[1] == 12
-        if self.fcc:
-            self.ssaf_bnl = self.saf_bnl*0.5/np.sqrt(2.0)  # rescaled by S*h/V
             assert self.l <= 1.0
             assert self.l2 <= 1.0
         else:
-            self.ssaf_bnl = self.saf_bnl
             assert self.l <= np.sqrt(1/3)
             assert self.l2 <= 1/3
 
-        h5f = h5py.File(Path(sim_dir / Path('materials.h5')), 'r')
-        Nmat = h5f['Nmat'][()]
-        DEF = np.zeros((Nmat, MMb, 3))
-        Mb = h5f['Mb'][...]
-        for i in range(Nmat):
-            dataset = h5f[f'mat_{i:02d}_DEF'][...]
-            assert Mb[i] == dataset.shape[0]
-            assert Mb[i] <= MMb
-            assert dataset.shape[1] == 3
-            DEF[i, :Mb[i]] = dataset
-            self.print(f'mat {i}, Mb={Mb[i]}, DEF={DEF[i, :Mb[i]]}')
-        h5f.close()
+        # non-rigid (bnl) arrays filled in a pass over bn data, without masked temporaries
+        # saf rescaled by S*h/V for FCC, max of unscaled saf kept for checks
+        Nbl = nb_count_bnl(mat_bn)
+        self.bnl_ixyz = np.empty((Nbl,), dtype=np.int64)
+        self.mat_bnl = np.empty((Nbl,), dtype=np.int8)
+        self.ssaf_bnl = np.empty((Nbl,), dtype=np.float64)
+        self.saf_bnl_max = nb_gather_bnl(self.bn_ixyz, mat_bn, saf_bn, self.fcc,
+                                         self.bnl_ixyz, self.mat_bnl, self.ssaf_bnl)
+        del mat_bn, saf_bn
 
         self.DEF = DEF
         self.Nm = Nmat
@@ -283,11 +283,10 @@ class EnginePython3D:
         self.mat_coeffs_struct = mat_coeffs_struct
 
     def checks(self):
-        saf_bnl = self.saf_bnl
         if self.fcc:
-            assert np.all(saf_bnl <= 12)  # unscaled
+            assert self.saf_bnl_max <= 12  # unscaled
         else:
-            assert np.all(saf_bnl <= 6)
+            assert self.saf_bnl_max <= 6
 
     def run_all(self, nsteps=1):
         self.print('running..')
@@ -315,6 +314,7 @@ class EnginePython3D:
         pbar['vox'].close()
         pbar['samples'].close()
 
+        self.print(f'Load time: {self.t_load:.6f}')
         self.print(f'Run-time loop: {t_elapsed:.6f}, {Nt*Npts/1e6/t_elapsed:.2f} MVox/s')
 
     def run_plot(self, nsteps=1, draw_backend='mayavi', json_model=None):
@@ -705,6 +705,32 @@ class EnginePython3D:
         self.print('saved outputs in {sim_dir}')
 
 
+@nb.jit(nopython=True, parallel=False)
+def nb_count_bnl(mat_bn):
+    Nbl = 0
+    for i in range(mat_bn.size):
+        if mat_bn[i] > -1:
+            Nbl += 1
+    return Nbl
+
+
+@nb.jit(nopython=True, parallel=False)
+def nb_gather_bnl(bn_ixyz, mat_bn, saf_bn, fcc, bnl_ixyz, mat_bnl, ssaf_bnl):
+    saf_max = 0.0
+    j = 0
+    for i in range(mat_bn.size):
+        if mat_bn[i] > -1:
+            bnl_ixyz[j] = bn_ixyz[i]
+            mat_bnl[j] = mat_bn[i]
+            if fcc:
+                ssaf_bnl[j] = saf_bn[i]*0.5/np.sqrt(2.0)
+            else:
+                ssaf_bnl[j] = saf_bn[i]
+            saf_max = max(saf_max, saf_bn[i])
+            j += 1
+    return saf_max
+
+
 @nb.jit(nopython=True, parallel=True)
 def nb_stencil_air_cart(Lu1, u1, bn_mask):
     Nx, Ny, Nz = u1.shape
@@ -0,0 +1,237 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Search material assignments and porous absorber parameters for a target T60
+
+Trials (optuna, TPE sampler) choose for each of the given surfaces one of the
+materials already used by the Setup3D class, or a porous absorber with
+thickness and flow resistivity as further parameters. Trials are evaluated in
+batches with pffdtd.sim3d.sweep, so they run in parallel and share cached
+stages:
+  1. materials and geometry only, then a Sabine estimate of T60 from surface
+     areas and absorption of the fitted materials (reported as step 0, bad
+     trials are pruned against the median of earlier trials)
+  2. simulation on a coarse surrogate grid (lower fmax), where all trials
+     reuse one voxelization, and T60 from analysis/t60.py (step 1)
+The best trials are then confirmed at the class' full resolution. The cost is
+the RMS deviation from the target over 1/3 octave bands in [fmin, fmax].
+"""
+
+import inspect
+import json
+from pathlib import Path
+import shutil
+
+import click
+import numpy as np
+import optuna
+
+from pffdtd.absorption.admittance import compute_Rf_from_DEF, fit_to_Sabs_oct_11, read_mat_DEF
+from pffdtd.absorption.porous import porous_absorption_oct_11
+from pffdtd.analysis.t60 import run as t60_run
+from pffdtd.common.filter import third_octave_bands
+from pffdtd.common.misc import file_hash
+from pffdtd.common.wavfile import collect_wav_files
+from pffdtd.sim3d.room_geometry import RoomGeometry
+from pffdtd.sim3d.setup import load_setup3d_classes
+from pffdtd.sim3d.sweep import Sweep
+
+POROUS = 'porous'
+THICKNESS_RANGE = (0.025, 0.3)  # m
+FLOW_RESISTIVITY_RANGE = (2000.0, 50000.0)  # Pa s/m^2
+
+
+def _print(fstring):
+    print(f'--OPTIMIZE: {fstring}')
+
+
+def _porous_file(surface):
+    return f'porous_{surface.replace(" ", "_")}.h5'
+
+
+def trial_class(sim_class):
+    """Setup3D subclass with porous absorbers written next to the class' materials and T60 analysis"""
+    base_generate_materials = getattr(sim_class, 'generate_materials', None)
+    if base_generate_materials is not None:
+        base_source = inspect.getsource(base_generate_materials)
+    else:
+        base_source = {file: file_hash(Path(sim_class.mat_folder) / file) for file in set(sim_class.materials.values())}
+
+    class Trial(sim_class):
+        opt_porous = {}  # surface -> [thickness, flow resistivity]
+        opt_fmin = 63.0
+        opt_fmax = 1000.0
+        opt_base_mat_folder = str(Path(sim_class.mat_folder or '.').absolute())
+        opt_base_source = base_source  # materials stage key
+        sweep_params = {**getattr(sim_class, 'sweep_params', {}),
+                        'opt_porous': 'materials', 'opt_base_mat_folder': 'materials', 'opt_base_source': 'materials',
+                        'opt_fmin': 'analysis', 'opt_fmax': 'analysis'}
+
+        def generate_materials(self):
+            if base_generate_materials is not None:
+                base_generate_materials(self)
+            else:
+                for file in set(sim_class.materials.values()):
+                    shutil.copy(Path(self.opt_base_mat_folder) / file, Path(self.mat_folder) / file)
+            for surface, (thickness, flow_resistivity) in self.opt_porous.items():
+                Sabs = porous_absorption_oct_11(thickness, flow_resistivity)
+                fit_to_Sabs_oct_11(Sabs, filename=Path(self.mat_folder) / _porous_file(surface))
+
+        def analyze(self, sim_dir):
+            files = collect_wav_files(sim_dir, '*_out_normalised.wav')
+            freqs, t60 = t60_run(files, self.opt_fmin, self.opt_fmax, plot=False)
+            return {'freqs': freqs.tolist(), 't60': np.mean(t60, axis=0).tolist()}
+
+    Trial.__name__ = sim_class.__name__
+    Trial.__qualname__ = sim_class.__qualname__
+    return Trial
+
+
+def sabine_t60(geometry_dir, materials_dir, materials, freqs):
+    """Sabine T60 per frequency, normal-incidence absorption of the fitted (DEF) materials"""
+    room_geo = RoomGeometry(Path(geometry_dir) / 'model.json')
+    room_geo.calc_areas()
+    jw = 2j*np.pi*np.asarray(freqs, dtype=np.float64)
+    absorption = np.zeros(jw.shape)
+    for mat, area in zip(room_geo.mat_str, room_geo.mat_area):
+        D, E, F = read_mat_DEF(Path(materials_dir) / materials[mat]).T
+        Rf = compute_Rf_from_DEF(jw, D, E, F)[0]
+        absorption += area*(1.0-np.abs(Rf)**2)
+    return 0.161*room_geo.vol/np.maximum(absorption, 1e-12)
+
+
+def t60_cost(t60, target, max_t60):
+    # bands that don't decay far enough count as max_t60
+    t60 = np.where(np.isfinite(t60), t60, max_t60)
+    return float(np.sqrt(np.mean((np.asarray(t60)-target)**2)))
+
+
+class MaterialOptimizer:
+    """Optuna study over materials of some surfaces, trials evaluated through sweep stages
+    """
+
+    def __init__(self, sim_class, surfaces, target, cache_dir, fmin=63.0, fmax=None, surrogate_fmax=None,
+                 Nprocs=1, seed=None):
+        assert len(surfaces) > 0
+        self.sim_class = trial_class(sim_class)
+        self.surfaces = list(surfaces)
+        self.choices = sorted(set(sim_class.materials.values())) + [POROUS]
+        self.target = target
+        self.cache_dir = Path(cache_dir)
+        self.surrogate_fmax = surrogate_fmax if surrogate_fmax is not None else sim_class.fmax/2
+        self.fmin = fmin
+        self.fmax = fmax if fmax is not None else self.surrogate_fmax
+        self.Nprocs = Nprocs
+        for surface in self.surfaces:
+            assert surface in sim_class.materials, f'{surface} not in materials of {sim_class.__name__}'
+
+        self.study = optuna.create_study(
+            direction='minimize',
+            sampler=optuna.samplers.TPESampler(seed=seed),
+            pruner=optuna.pruners.MedianPruner(n_startup_trials=2, n_warmup_steps=0),
+        )
+
+    def _suggest(self, trial):
+        materials = dict(self.sim_class.materials)
+        porous = {}
+        for surface in self.surfaces:
+            choice = trial.suggest_categorical(f'{surface}:material', self.choices)
+            if choice == POROUS:
+                porous[surface] = [
+                    trial.suggest_float(f'{surface}:thickness', *THICKNESS_RANGE),
+                    trial.suggest_float(f'{surface}:flow_resistivity', *FLOW_RESISTIVITY_RANGE, log=True),
+                ]
+                materials[surface] = _porous_file(surface)
+            else:
+                materials[surface] = choice
+        return {'materials': materials, 'opt_porous': porous, 'opt_fmin': self.fmin, 'opt_fmax': self.fmax}
+
+    def _sweep(self, variants, until):
+        return Sweep(self.sim_class, variants, self.cache_dir, until=until, Nprocs=self.Nprocs).run()
+
+    def _cost(self, result):
+        with open(Path(result['analysis']) / 'analysis.json') as f:
+            t60 = np.array(json.load(f)['t60'], dtype=np.float64)
+        return t60_cost(t60, self.target, self.sim_class.duration), t60
+
+    def optimize(self, Ntrials, batch_size=None):
+        """Run Ntrials trials, in batches (default one trial per process)"""
+        batch_size = batch_size or self.Nprocs
+        surrogate = {'fmax': self.surrogate_fmax}
+        freqs = third_octave_bands(self.fmin, self.fmax)
+        Ndone = 0
+        while Ndone < Ntrials:
+            trials = [self.study.ask() for _ in range(min(batch_size, Ntrials-Ndone))]
+            variants = [{**surrogate, **self._suggest(trial)} for trial in trials]
+            Ndone += len(trials)
+
+            # step 0: Sabine estimate from fitted materials (prune hopeless trials)
+            keep = []
+            for trial, variant, result in zip(trials, variants, self._sweep(variants, 'geometry')):
+                t60 = sabine_t60(result['geometry'], result['materials'], variant['materials'], freqs)
+                trial.report(t60_cost(t60, self.target, self.sim_class.duration), 0)
+                if trial.should_prune():
+                    self.study.tell(trial, state=optuna.trial.TrialState.PRUNED)
+                    _print(f'trial {trial.number} pruned (Sabine)')
+                else:
+                    keep.append((trial, variant))
+            if len(keep) == 0:
+                continue
+
+            # step 1: surrogate simulation
+            results = self._sweep([variant for _, variant in keep], 'analysis')
+            for (trial, _), result in zip(keep, results):
+                cost, _ = self._cost(result)
+                trial.report(cost, 1)
+                self.study.tell(trial, cost)
+                _print(f'trial {trial.number}: cost={cost:.4f} s {trial.params}')
+
+    def confirm(self, Nbest):
+        """Rerun best surrogate trials at full resolution, sorted by confirmed cost"""
+        completed = [trial for trial in self.study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+        best = sorted(completed, key=lambda trial: trial.value)[:Nbest]
+        variants = [self._suggest(optuna.trial.FixedTrial(trial.params)) for trial in best]
+        confirmed = []
+        for trial, variant, result in zip(best, variants, self._sweep(variants, 'analysis')):
+            cost, t60 = self._cost(result)
+            confirmed.append({'trial': trial.number, 'params': trial.params, 'materials': variant['materials'],
+                              'porous': variant['opt_porous'], 'surrogate_cost': trial.value, 'cost': cost,
+                              't60': t60.tolist(), 'sim_dir': result['process']})
+            _print(f'trial {trial.number}: surrogate cost={trial.value:.4f} s, full cost={cost:.4f} s')
+        return sorted(confirmed, key=lambda c: c['cost'])
+
+
+def optimize_materials(sim_class, surfaces, target, cache_dir, Ntrials=20, Nconfirm=3, fmin=63.0, fmax=None,
+                       surrogate_fmax=None, Nprocs=1, seed=None, out_file=None):
+    """Optimize materials of surfaces of a Setup3D class for a target T60, returns confirmed candidates (best first)"""
+    optimizer = MaterialOptimizer(sim_class, surfaces, target, cache_dir, fmin=fmin, fmax=fmax,
+                                  surrogate_fmax=surrogate_fmax, Nprocs=Nprocs, seed=seed)
+    optimizer.optimize(Ntrials)
+    confirmed = optimizer.confirm(Nconfirm)
+    Npruned = sum(trial.state == optuna.trial.TrialState.PRUNED for trial in optimizer.study.trials)
+    _print(f'{Ntrials} trials ({Npruned} pruned), best: {confirmed[0]["materials"] if confirmed else None}')
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump({'target': target, 'fmin': optimizer.fmin, 'fmax': optimizer.fmax, 'candidates': confirmed},
+                      f, indent=2)
+    return confirmed
+
+
+@click.command(name='optimize-materials', help='Optimize surface materials for a target T60.')
+@click.argument('sim_file', nargs=1, type=click.Path(exists=True))
+@click.option('--surface', 'surfaces', multiple=True, required=True, help='material (surface) to optimize')
+@click.option('--target', type=float, required=True, help='target T60 in s')
+@click.option('--fmin', default=63.0)
+@click.option('--fmax', default=None, type=float, help='defaults to surrogate fmax')
+@click.option('--surrogate_fmax', default=None, type=float, help='defaults to half of fmax of class')
+@click.option('--trials', default=20)
+@click.option('--confirm', default=3, help='best trials to rerun at full resolution')
+@click.option('--nprocs', default=1, type=int)
+@click.option('--seed', default=None, type=int)
+@click.option('--cache_dir', default='optimize_cache', type=click.Path())
+def main(sim_file, surfaces, target, fmin, fmax, surrogate_fmax, trials, confirm, nprocs, seed, cache_dir):
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    for sim_class in load_setup3d_classes(sim_file):
+        optimize_materials(sim_class, surfaces, target, cache_dir, Ntrials=trials, Nconfirm=confirm, fmin=fmin,
+                           fmax=fmax, surrogate_fmax=surrogate_fmax, Nprocs=nprocs, seed=seed,
+                           out_file=Path(cache_dir) / f'optimize_{sim_class.__name__}.json')
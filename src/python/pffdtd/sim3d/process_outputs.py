@@ -5,55 +5,62 @@
 This gets called from command line with cmdline arguments (run after simulation)
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import os
 from pathlib import Path
+import threading
 
 import click
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 from resampy import resample
+from scipy.signal import resample_poly
 
 from pffdtd.absorption.air import apply_visco_filter
 from pffdtd.absorption.air import apply_modal_filter
 from pffdtd.absorption.air import apply_ola_filter
-from pffdtd.common.filter import apply_lowcut, apply_lowpass
+from pffdtd.common.filter import apply_lowcut, lowcut_sos, lowpass_sos, sosfilt_inplace
 from pffdtd.common.plot import plot_styles
 from pffdtd.common.wavfile import save_as_wav_files
 from pffdtd.geometry.math import iceil
+from pffdtd.sim3d.container import SimData
+
+RESAMPY_FILTERS = ('kaiser_best', 'kaiser_fast')
+RESAMPLERS = (*RESAMPY_FILTERS, 'polyphase')
 
 
 class ProcessOutputs:
     # class to process sim_outs.h5 file
-    def __init__(self, sim_dir):
+    # receivers are processed in groups of Nchunk on a pool of nthreads threads,
+    # so only the group's raw outputs are in memory at any time (not all of u_out)
+    def __init__(self, sim_dir, Nchunk=16, nthreads=None):
         self.print('loading...')
 
         # get some integers from signals
         self.sim_dir = sim_dir
-        h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
-        out_alpha = h5f['out_alpha'][...]
-        Nr = h5f['Nr'][()]
-        Nt = h5f['Nt'][()]
-        diff = h5f['diff'][()]
-        h5f.close()
-
-        # get some sim constants (floats) from constants
-        h5f = h5py.File(sim_dir / Path('constants.h5'), 'r')
-        Ts = h5f['Ts'][()]
-        Tc = h5f['Tc'][()]
-        rh = h5f['rh'][()]
-        h5f.close()
-
-        # read the raw outputs from sim_outs
-        h5f = h5py.File(sim_dir / Path('sim_outs.h5'), 'r')
-        u_out = h5f['u_out'][...]
-        h5f.close()
+        with SimData(sim_dir) as sim_data:
+            out_alpha = sim_data.read('signals', 'out_alpha')
+            Nr = sim_data.read('signals', 'Nr')
+            Nt = sim_data.read('signals', 'Nt')
+            diff = sim_data.read('signals', 'diff')
+
+            # get some sim constants (floats) from constants
+            Ts = sim_data.read('constants', 'Ts')
+            Tc = sim_data.read('constants', 'Tc')
+            rh = sim_data.read('constants', 'rh')
+
+        # only check the raw outputs in sim_outs, read per group later
+        with h5py.File(sim_dir / Path('sim_outs.h5'), 'r') as h5f:
+            u_shape = h5f['u_out'].shape
         self.print('loading done...')
 
         assert out_alpha.size == Nr
-        assert u_out.size == Nr*Nt
+        assert np.prod(u_shape) == Nr*Nt
         assert out_alpha.ndim == 2
 
-        self.r_out = None  # for recombined raw outputs (corresponding to Rxyz)
+        self.r_out = None  # for recombined raw outputs (corresponding to Rxyz), read back for plots
         self.r_out_f = None  # r_out filtered (and diffed)
 
         self.Ts = Ts
@@ -63,8 +70,7 @@ class ProcessOutputs:
         self.Fs_f = 1/Ts
         self.Nt_f = Nt
         self.Nr = Nr
-        # self.Nmic = out_alpha.shape[0]
-        self.u_out = u_out
+        self.Nmic = out_alpha.shape[0]
         self.diff = diff
         self.out_alpha = out_alpha
         self.sim_dir = sim_dir
@@ -72,55 +78,140 @@ class ProcessOutputs:
         self.Tc = Tc
         self.rh = rh
 
+        self.Nchunk = max(1, int(Nchunk))
+        self.groups = [slice(i, min(i+self.Nchunk, self.Nmic)) for i in range(0, self.Nmic, self.Nchunk)]
+        self.nthreads = min(nthreads or os.cpu_count() or 1, len(self.groups))
+        self.h5_lock = threading.Lock()
+
     def print(self, fstring):
         print(f'--PROCESS_OUTPUTS: {fstring}')
 
-    def initial_process(self, fcut=10.0, N_order=4):
-        # initial process: consolidate receivers with linterp weights, and integrate/low-cut
-        self.print('initial process...')
-        u_out = self.u_out
-        out_alpha = self.out_alpha
-        sim_dir = self.sim_dir
-        apply_int = self.diff
-        Ts = self.Ts
-
-        # just recombine outputs (from trilinear interpolation)
-        r_out = np.sum(
-            (u_out*out_alpha.flat[:][:, None]).reshape((*out_alpha.shape, -1)), axis=1)
+    def _map_groups(self, func):
+        # func(group) for each receiver group, threads only help where the work releases the GIL
+        if self.nthreads == 1:
+            for group in self.groups:
+                func(group)
+            return
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            for _ in pool.map(func, self.groups):
+                pass
 
-        h5f = h5py.File(sim_dir / Path('sim_outs.h5'), 'r+')
+    def _create_r_out(self, h5f):
         try:
             del h5f['r_out']
             self.print('overwrite r_out dataset (native sample rate)')
         except:
             pass
-        h5f.create_dataset('r_out', data=r_out)
-        h5f.close()
+        dtype = np.result_type(h5f['u_out'].dtype, self.out_alpha.dtype)
+        h5f.create_dataset('r_out', shape=(self.Nmic, self.Nt), dtype=dtype)
+
+    def _recombine(self, h5f, group):
+        # recombine outputs of a receiver group (from trilinear interpolation), also stored as r_out
+        Na = self.out_alpha.shape[1]
+        with self.h5_lock:
+            u_out = h5f['u_out'][group.start*Na:group.stop*Na].reshape(-1, self.Nt)
+        alpha = self.out_alpha[group]
+        r_out = np.sum((u_out*alpha.flat[:][:, None]).reshape((*alpha.shape, -1)), axis=1)
+        with self.h5_lock:
+            h5f['r_out'][group] = r_out
+        return r_out
+
+    def _lowcut(self, y, fcut, N_order):
+        # integrate/low-cut (in place where possible)
+        if fcut > 0:
+            return sosfilt_inplace(lowcut_sos(self.Fs, fcut, N_order, self.diff), np.asarray(y, dtype=np.float64))
+        return apply_lowcut(y, self.Fs, fcut, N_order, self.diff)
+
+    def _lowpass(self, y, sos, symmetric):
+        sosfilt_inplace(sos, y)
+        if symmetric:  # runs again, time reversed
+            sosfilt_inplace(sos, y, reverse=True)
+        return y
+
+    def _resampler(self, Fs_f, method, max_denominator):
+        # returns (function resampling a group, output length)
+        Fs = self.Fs
+        if method == 'polyphase':
+            ratio = Fraction(Fs_f/Fs).limit_denominator(max_denominator)
+            up, down = ratio.numerator, ratio.denominator
+            self.print(f'polyphase resampling {up}/{down}, rate error {abs(Fs*up/down/Fs_f-1):.2e}')
+            Nt_f = -(-self.Nt*up//down)
+            return lambda y: resample_poly(y, up, down, axis=-1), Nt_f
+        if method in RESAMPY_FILTERS:
+            Nt_f = int(self.Nt*float(Fs_f)/float(Fs))
+            return lambda y: resample(y, Fs, Fs_f, filter=method, axis=-1), Nt_f
+        raise ValueError(f'unknown resampler {method}')
+
+    def initial_process(self, fcut=10.0, N_order=4):
+        # initial process: consolidate receivers with linterp weights, and integrate/low-cut
+        self.print('initial process...')
+        self.r_out_f = np.empty((self.Nmic, self.Nt))
+        with h5py.File(self.sim_dir / Path('sim_outs.h5'), 'r+') as h5f:
+            self._create_r_out(h5f)
 
-        r_out_f = apply_lowcut(r_out, 1/Ts, fcut, N_order, apply_int)
+            def process(group):
+                self.r_out_f[group] = self._lowcut(self._recombine(h5f, group), fcut, N_order)
+
+            self._map_groups(process)
         self.print('initial process done')
 
-        self.r_out = r_out
-        self.r_out_f = r_out_f
+    def process(self, fcut_lowcut=10.0, order_lowcut=4, resample_fs=None, resampler='kaiser_best',
+                fcut_lowpass=0.0, order_lowpass=8, symmetric_lowpass=True, max_denominator=1000):
+        # initial process, resample and lowpass in one pass over receiver groups
+        # (same result as the separate steps, without full-length intermediates at the raw rate)
+        self.print('processing...')
+        resample_fs = resample_fs if resample_fs and resample_fs != self.Fs else None
+        if resample_fs:
+            resample_group, Nt_f = self._resampler(resample_fs, resampler, max_denominator)
+            Fs_f = resample_fs
+        else:
+            Nt_f, Fs_f = self.Nt, self.Fs
+        if fcut_lowpass > 0:
+            sos_lowpass = lowpass_sos(Fs_f, fcut_lowpass, order_lowpass, symmetric_lowpass)
+
+        self.r_out_f = np.empty((self.Nmic, Nt_f))
+        with h5py.File(self.sim_dir / Path('sim_outs.h5'), 'r+') as h5f:
+            self._create_r_out(h5f)
+
+            def process(group):
+                y = self._lowcut(self._recombine(h5f, group), fcut_lowcut, order_lowcut)
+                if resample_fs:
+                    y = resample_group(y)
+                    assert y.shape[-1] == Nt_f
+                if fcut_lowpass > 0:
+                    y = self._lowpass(np.ascontiguousarray(y, dtype=np.float64), sos_lowpass, symmetric_lowpass)
+                self.r_out_f[group] = y
+
+            self._map_groups(process)
+
+        self.Fs_f = Fs_f
+        self.Ts_f = 1/Fs_f
+        self.Nt_f = Nt_f
+        self.print(f'processing done ({len(self.groups)} groups, {self.nthreads} threads)')
 
     def apply_lowpass(self, fcut, N_order=8, symmetric=True):
         # lowpass filter for fmax (to remove freqs with too much numerical dispersion)
-        self.r_out_f = apply_lowpass(
-            self.r_out_f, self.Fs_f, fcut, N_order, symmetric)
+        sos = lowpass_sos(self.Fs_f, fcut, N_order, symmetric)
+        self.r_out_f = np.ascontiguousarray(self.r_out_f, dtype=np.float64)
+        self._map_groups(lambda group: self._lowpass(self.r_out_f[group], sos, symmetric))
 
-    def resample(self, Fs_f=48e3):
-        # resample with resampy, 48kHz default
+    def resample(self, Fs_f=48e3, method='kaiser_best', max_denominator=1000):
+        # resample with resampy (kaiser_best default) or polyphase (rational ratio), 48kHz default
         Fs = self.Fs  # raw Fs
         if Fs == Fs_f:
             return
-        r_out_f = self.r_out_f
-
         self.print('resampling')
-        r_out_f = resample(r_out_f, Fs, Fs_f, filter='kaiser_best')
+        resample_group, Nt_f = self._resampler(Fs_f, method, max_denominator)
+        r_out_f = np.empty((self.Nmic, Nt_f))
+
+        def process(group):
+            r_out_f[group] = resample_group(self.r_out_f[group])
+
+        self._map_groups(process)
 
         self.Fs_f = Fs_f
         self.Ts_f = 1/Fs_f
-        self.Nt_f = r_out_f.shape[-1]
+        self.Nt_f = Nt_f
         self.r_out_f = r_out_f
 
     # to apply Stokes' filter (see DAFx2021 paper)
@@ -137,14 +228,15 @@ class ProcessOutputs:
         self.r_out_f = r_out_f
 
     # to apply Stokes' filter (see I3DA 2021 paper)
-    def apply_modal_filter(self):
+    # Nmodes=None for as many modes as samples (exact, but O(Nt^2)), else decimated modal basis (approximate)
+    def apply_modal_filter(self, Nmodes=None):
         Fs_f = self.Fs_f
         Tc = self.Tc
         rh = self.rh
         r_out_f = self.r_out_f
 
         self.print('applying modal air absorption filter')
-        r_out_f = apply_modal_filter(r_out_f, Fs_f, Tc=Tc, rh=rh)
+        r_out_f = apply_modal_filter(r_out_f, Fs_f, Tc=Tc, rh=rh, Nmodes=Nmodes)
 
         self.Nt_f = r_out_f.shape[-1]  # gets lengthened by filter
         self.r_out_f = r_out_f
@@ -167,6 +259,9 @@ class ProcessOutputs:
         Nt = self.Nt
         Ts = self.Ts
         tv = np.arange(Nt)*Ts
+        if self.r_out is None:
+            with h5py.File(self.sim_dir / Path('sim_outs.h5'), 'r') as h5f:
+                self.r_out = h5f['r_out'][...]
         r_out = self.r_out
 
         # fig = plt.figure()
@@ -262,21 +357,26 @@ def process_outputs(
     save_wav=None,
     plot_raw=None,
     plot=None,
+    resampler='kaiser_best',
+    Nchunk=16,
+    nthreads=None,
+    modal_nmodes=None,
 ):
-    po = ProcessOutputs(sim_dir)
+    po = ProcessOutputs(sim_dir, Nchunk=Nchunk, nthreads=nthreads)
 
-    po.initial_process(fcut=fcut_lowcut, N_order=order_lowcut)
-
-    if resample_fs:
-        po.resample(resample_fs)
-
-    if fcut_lowpass > 0:
-        po.apply_lowpass(fcut=fcut_lowpass, N_order=order_lowpass,
-                         symmetric=symmetric_lowpass)
+    po.process(
+        fcut_lowcut=fcut_lowcut,
+        order_lowcut=order_lowcut,
+        resample_fs=resample_fs,
+        resampler=resampler,
+        fcut_lowpass=fcut_lowpass,
+        order_lowpass=order_lowpass,
+        symmetric_lowpass=symmetric_lowpass,
+    )
 
     # these are only needed if you're simulating with fmax >1kHz, but generally fine to use
     if air_abs_filter.lower() == 'modal':  # best, but slowest
-        po.apply_modal_filter()
+        po.apply_modal_filter(Nmodes=modal_nmodes)
     elif air_abs_filter.lower() == 'stokes':  # generally fine for indoor air
         po.apply_stokes_filter()
     elif air_abs_filter.lower() == 'ola':  # fastest, but not as recommended
@@ -303,22 +403,30 @@ def process_outputs(
 @click.option('--plot_raw', is_flag=True)
 @click.option('--save_wav', is_flag=True)
 @click.option('--resample_fs', default=48_000.0)
+@click.option('--resampler', default='kaiser_best', type=click.Choice(RESAMPLERS))
 @click.option('--fcut_lowcut', default=10.0)
 @click.option('--fcut_lowpass', default=0.0)
 @click.option('--order_lowcut', default=8)
 @click.option('--order_lowpass', default=8)
 @click.option('--symmetric_lowpass', is_flag=True)
 @click.option('--air_abs_filter', default='none')
-def main(sim_dir, plot, plot_raw, save_wav, resample_fs, fcut_lowcut, fcut_lowpass, order_lowcut, order_lowpass, symmetric_lowpass, air_abs_filter):
+@click.option('--nchunk', default=16, help='receivers per group')
+@click.option('--nthreads', default=None, type=int, help='defaults to number of CPUs')
+@click.option('--modal_nmodes', default=None, type=int, help='modes for modal air absorption filter (faster, approximate), defaults to exact')
+def main(sim_dir, plot, plot_raw, save_wav, resample_fs, resampler, fcut_lowcut, fcut_lowpass, order_lowcut, order_lowpass, symmetric_lowpass, air_abs_filter, nchunk, nthreads, modal_nmodes):
     process_outputs(
         sim_dir=sim_dir,
         resample_fs=resample_fs,
+        resampler=resampler,
+        Nchunk=nchunk,
+        nthreads=nthreads,
         fcut_lowcut=fcut_lowcut,
         order_lowcut=order_lowcut,
         fcut_lowpass=fcut_lowpass,
         order_lowpass=order_lowpass,
         symmetric_lowpass=symmetric_lowpass,
         air_abs_filter=air_abs_filter,
+        modal_nmodes=modal_nmodes,
         save_wav=save_wav,
         plot_raw=plot_raw,
         plot=plot,
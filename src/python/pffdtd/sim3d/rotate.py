@@ -6,20 +6,54 @@ For multi-GPU execution:
     - best to permute dimensions for descending order (last dim continguous)
     - indices all need to be sorted (and corresponding data reordered)
     - fold FCC subgrid onto itself here (fills half Cartesian grid)
+
+save_gpu_sim_data does all of this in one in-memory pass (from voxelizer
+results) and writes the GPU folder once. The separate steps below work on
+files in place, with boundary-node data processed in chunks of rows (external
+merge sort if it doesn't fit in one chunk), so memory use is bounded for very
+large grids (streamed voxelizer output).
 """
 
 from pathlib import Path
 import shutil
 
 import h5py
+import numba as nb
 import numpy as np
 from numpy import array as npa
 
 from pffdtd.common.timerdict import TimerDict
 from pffdtd.geometry.math import ind2sub3d
 
+CHUNK_SIZE = 2**24  # rows of boundary-node data held in memory at once
+BN_DATASETS = ('bn_ixyz', 'adj_bn', 'mat_bn', 'saf_bn')
+
+
+def _row_chunks(N, chunk_size):
+    return [slice(i, min(i+chunk_size, N)) for i in range(0, N, chunk_size)]
+
+
+def _swap3(a, b, c, tr):
+    abcl = [a, b, c]
+    return [abcl[i] for i in tr]  # swap with order
+
 
-def rotate(sim_dir, tr=None, compress=False):
+def _default_tr(Nx, Ny, Nz):
+    return np.argsort(npa([Nx, Ny, Nz]))[::-1]  # descending (Nx is non-contiguous -- want Ny*Nz min)
+
+
+def _adj_column_order(tr, NN):
+    # adj_bn columns for neighbour directions after permuting dimensions
+    if NN == 6:
+        iVV = npa([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]])
+    else:
+        iVV = npa([[+1, +1, 0], [-1, -1, 0], [0, +1, +1], [0, -1, -1], [+1, 0, +1], [-1, 0, -1],
+                   [+1, -1, 0], [-1, +1, 0], [0, +1, -1], [0, -1, +1], [+1, 0, -1], [-1, 0, +1]])
+    jj = npa([np.flatnonzero(np.all(ivv[tr] == iVV, axis=-1))[0] for ivv in iVV])
+    return np.argsort(jj)
+
+
+def rotate(sim_dir, tr=None, compress=False, chunk_size=CHUNK_SIZE):
     # NB: we keep cart_grid.h5 untouched and that has original Nx,Ny,Nz if needed
     def _print(fstring):
         print(f'--ROTATE_DATA: {fstring}')
@@ -33,7 +67,7 @@ def rotate(sim_dir, tr=None, compress=False):
     Nz = h5f['Nz'][()]
     h5f.close()
     if tr is None:
-        tr = np.argsort(npa([Nx, Ny, Nz]))[::-1]  # descending (Nx is non-contiguous -- want Ny*Nz min)
+        tr = _default_tr(Nx, Ny, Nz)
     else:
         assert np.all(np.sort(tr) == npa([0, 1, 2]))
     _print(f'{tr=}')
@@ -47,17 +81,9 @@ def rotate(sim_dir, tr=None, compress=False):
     xv = h5f['xv'][()]
     yv = h5f['yv'][()]
     zv = h5f['zv'][()]
-    adj_bn = h5f['adj_bn'][...]
-    bn_ixyz = h5f['bn_ixyz'][...]
+    Nb, NN = h5f['adj_bn'].shape
     h5f.close()
 
-    NN = adj_bn.shape[1]
-    if NN == 6:
-        iVV = npa([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]])
-    else:
-        iVV = npa([[+1, +1, 0], [-1, -1, 0], [0, +1, +1], [0, -1, -1], [+1, 0, +1], [-1, 0, -1],
-                   [+1, -1, 0], [-1, +1, 0], [0, +1, -1], [0, -1, +1], [+1, 0, -1], [-1, 0, +1]])
-
     h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
     in_ixyz = h5f['in_ixyz'][...]
     out_ixyz = h5f['out_ixyz'][...]
@@ -72,13 +98,7 @@ def rotate(sim_dir, tr=None, compress=False):
 
     timer.tic('transpose')
     # swap and reorder
-
-    def _swap3(a, b, c, tr):
-        abcl = [a, b, c]
-        return [abcl[i] for i in tr]  # swap with order
-
     Nxt, Nyt, Nzt = _swap3(Nx, Ny, Nz, tr)
-    bn_ixyzt = npa(_swap3(*ind2sub3d(bn_ixyz, Nx, Ny, Nz), tr)).T @ npa([Nzt*Nyt, Nzt, 1])
     in_ixyzt = npa(_swap3(*ind2sub3d(in_ixyz, Nx, Ny, Nz), tr)).T @ npa([Nzt*Nyt, Nzt, 1])
     out_ixyzt = npa(_swap3(*ind2sub3d(out_ixyz, Nx, Ny, Nz), tr)).T @ npa([Nzt*Nyt, Nzt, 1])
     xvt, yvt, zvt = _swap3(xv, yv, zv, tr)
@@ -89,11 +109,8 @@ def rotate(sim_dir, tr=None, compress=False):
 
     timer.tic('reorder adj')
     # reorder adj_bn columns
-    jj = np.zeros((NN,), dtype=np.int_)
-    jj = npa([np.flatnonzero(np.all(ivv[tr] == iVV, axis=-1))[0] for ivv in iVV])
-    _print(f'{jj=}')
-    ia = np.argsort(jj)
-    adj_bnt = adj_bn[:, ia]
+    ia = _adj_column_order(tr, NN)
+    _print(f'{ia=}')
     timer.toc('reorder adj')
 
     timer.tic('write')
@@ -108,8 +125,10 @@ def rotate(sim_dir, tr=None, compress=False):
     h5f.close()
 
     h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r+')
-    h5f['bn_ixyz'][...] = bn_ixyzt
-    h5f['adj_bn'][...] = adj_bnt
+    for rows in _row_chunks(Nb, chunk_size):
+        bn_ixyz = h5f['bn_ixyz'][rows]
+        h5f['bn_ixyz'][rows] = npa(_swap3(*ind2sub3d(bn_ixyz, Nx, Ny, Nz), tr)).T @ npa([Nzt*Nyt, Nzt, 1])
+        h5f['adj_bn'][rows] = h5f['adj_bn'][rows][:, ia]
     h5f['Nx'][()] = Nxt
     h5f['Ny'][()] = Nyt
     h5f['Nz'][()] = Nzt
@@ -124,7 +143,7 @@ def rotate(sim_dir, tr=None, compress=False):
     _print(timer.ftoc('write'))
 
 
-def sort_sim_data(sim_dir):
+def sort_sim_data(sim_dir, chunk_size=CHUNK_SIZE):
     def _print(fstring):
         print(f'--SORT_DATA: {fstring}')
     timer = TimerDict()
@@ -132,13 +151,6 @@ def sort_sim_data(sim_dir):
 
     timer.tic('read')
     # read
-    h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r')
-    adj_bn = h5f['adj_bn'][...]
-    bn_ixyz = h5f['bn_ixyz'][...]
-    mat_bn = h5f['mat_bn'][...]
-    saf_bn = h5f['saf_bn'][...]
-    h5f.close()
-
     h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
     in_ixyz = h5f['in_ixyz'][...]
     out_ixyz = h5f['out_ixyz'][...]
@@ -148,13 +160,6 @@ def sort_sim_data(sim_dir):
     _print(timer.ftoc('read'))
 
     timer.tic('reorder')
-    # sort rows
-    ii = np.argsort(bn_ixyz)
-    bn_ixyz = bn_ixyz[ii]
-    adj_bn = adj_bn[ii]
-    mat_bn = mat_bn[ii]
-    saf_bn = saf_bn[ii]
-
     ii = np.argsort(in_ixyz)
     in_ixyz = in_ixyz[ii]
     in_sigs = in_sigs[ii]
@@ -174,17 +179,61 @@ def sort_sim_data(sim_dir):
     h5f['out_alpha'][...] = out_alpha
     h5f['out_reorder'][...] = out_reorder
     h5f.close()
+    _print(timer.ftoc('write'))
 
+    # sort boundary-node rows by bn_ixyz
+    timer.tic('sort bn')
     h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r+')
-    h5f['bn_ixyz'][...] = bn_ixyz
-    h5f['adj_bn'][...] = adj_bn
-    h5f['mat_bn'][...] = mat_bn
-    h5f['saf_bn'][...] = saf_bn
+    Nb = h5f['bn_ixyz'].shape[0]
+    if Nb <= chunk_size:
+        ii = np.argsort(h5f['bn_ixyz'][...])
+        for name in BN_DATASETS:
+            h5f[name][...] = h5f[name][...][ii]
+    else:
+        _print(f'external sort, {Nb=}, {chunk_size=}')
+        _external_sort_bn(h5f, sim_dir / Path('sort_runs.h5'), chunk_size)
     h5f.close()
-    _print(timer.ftoc('write'))
-
-
-def fold_fcc_sim_data(sim_dir):
+    _print(timer.ftoc('sort bn'))
+
+
+def _external_sort_bn(h5f, runs_file, chunk_size):
+    # sorted runs of chunk_size rows to a scratch file, then k-way merge back into h5f in blocks
+    # (rows up to smallest last key of current blocks of unfinished runs are final)
+    Nb = h5f['bn_ixyz'].shape[0]
+    runs = _row_chunks(Nb, chunk_size)
+    with h5py.File(runs_file, 'w') as h5r:
+        for name in BN_DATASETS:
+            h5r.create_dataset(name, shape=h5f[name].shape, dtype=h5f[name].dtype)
+        for rows in runs:
+            ii = np.argsort(h5f['bn_ixyz'][rows])
+            for name in BN_DATASETS:
+                h5r[name][rows] = h5f[name][rows][ii]
+
+        block_size = max(chunk_size//(len(runs)+1), 1)
+        pos = [rows.start for rows in runs]  # next row to read, per run
+        blocks = [None]*len(runs)
+        Nout = 0
+        while Nout < Nb:
+            for r, rows in enumerate(runs):
+                if (blocks[r] is None or blocks[r]['bn_ixyz'].size == 0) and pos[r] < rows.stop:
+                    stop = min(pos[r]+block_size, rows.stop)
+                    blocks[r] = {name: h5r[name][pos[r]:stop] for name in BN_DATASETS}
+                    pos[r] = stop
+            key_max = min((blocks[r]['bn_ixyz'][-1] for r, rows in enumerate(runs) if pos[r] < rows.stop),
+                          default=np.iinfo(np.int64).max)
+            Ntake = [0 if block is None else np.searchsorted(block['bn_ixyz'], key_max, side='right') for block in blocks]
+            merged = {name: np.concatenate([block[name][:n] for block, n in zip(blocks, Ntake) if block is not None])
+                      for name in BN_DATASETS}
+            ii = np.argsort(merged['bn_ixyz'])
+            for name in BN_DATASETS:
+                h5f[name][Nout:Nout+ii.size] = merged[name][ii]
+            Nout += ii.size
+            blocks = [None if block is None else {name: block[name][n:] for name in BN_DATASETS}
+                      for block, n in zip(blocks, Ntake)]
+    runs_file.unlink()
+
+
+def fold_fcc_sim_data(sim_dir, chunk_size=CHUNK_SIZE):
     def _print(fstring):
         print(f'--FOLD_FCC_DATA: {fstring}')
 
@@ -197,11 +246,6 @@ def fold_fcc_sim_data(sim_dir):
     h5f.close()
     assert (Ny % 2) == 0
 
-    h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r')
-    adj_bn = h5f['adj_bn'][...]
-    bn_ixyz = h5f['bn_ixyz'][...]
-    h5f.close()
-
     h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
     in_ixyz = h5f['in_ixyz'][...]
     out_ixyz = h5f['out_ixyz'][...]
@@ -215,18 +259,6 @@ def fold_fcc_sim_data(sim_dir):
 
     Nyh = np.int_(Ny/2)+1
 
-    bix, biy, biz = ind2sub3d(bn_ixyz, Nx, Ny, Nz)
-    ii = biy >= Ny/2
-
-    # bn_ixyz
-    bn_ixyz[ii] = np.c_[bix[ii], Ny-biy[ii]-1, biz[ii]] @ npa([Nz*Nyh, Nz, 1])
-    bn_ixyz[~ii] = np.c_[bix[~ii], biy[~ii], biz[~ii]] @ npa([Nz*Nyh, Nz, 1])
-
-    adj_bn[ii, 0], adj_bn[ii, 6] = adj_bn[ii, 6], adj_bn[ii, 0]
-    adj_bn[ii, 1], adj_bn[ii, 7] = adj_bn[ii, 7], adj_bn[ii, 1]
-    adj_bn[ii, 2], adj_bn[ii, 9] = adj_bn[ii, 9], adj_bn[ii, 2]
-    adj_bn[ii, 3], adj_bn[ii, 8] = adj_bn[ii, 8], adj_bn[ii, 3]
-
     # in_ixyz
     bix, biy, biz = ind2sub3d(in_ixyz, Nx, Ny, Nz)
     ii = biy >= Ny/2
@@ -247,8 +279,24 @@ def fold_fcc_sim_data(sim_dir):
     h5f.close()
 
     h5f = h5py.File(sim_dir / Path('vox_out.h5'), 'r+')
-    h5f['bn_ixyz'][...] = bn_ixyz
-    h5f['adj_bn'][...] = adj_bn
+    for rows in _row_chunks(h5f['bn_ixyz'].shape[0], chunk_size):
+        bn_ixyz = h5f['bn_ixyz'][rows]
+        adj_bn = h5f['adj_bn'][rows]
+
+        bix, biy, biz = ind2sub3d(bn_ixyz, Nx, Ny, Nz)
+        ii = biy >= Ny/2
+
+        # bn_ixyz
+        bn_ixyz[ii] = np.c_[bix[ii], Ny-biy[ii]-1, biz[ii]] @ npa([Nz*Nyh, Nz, 1])
+        bn_ixyz[~ii] = np.c_[bix[~ii], biy[~ii], biz[~ii]] @ npa([Nz*Nyh, Nz, 1])
+
+        adj_bn[ii, 0], adj_bn[ii, 6] = adj_bn[ii, 6], adj_bn[ii, 0]
+        adj_bn[ii, 1], adj_bn[ii, 7] = adj_bn[ii, 7], adj_bn[ii, 1]
+        adj_bn[ii, 2], adj_bn[ii, 9] = adj_bn[ii, 9], adj_bn[ii, 2]
+        adj_bn[ii, 3], adj_bn[ii, 8] = adj_bn[ii, 8], adj_bn[ii, 3]
+
+        h5f['bn_ixyz'][rows] = bn_ixyz
+        h5f['adj_bn'][rows] = adj_bn
     h5f['Ny'][()] = Nyh
     h5f.close()
 
@@ -258,6 +306,136 @@ def fold_fcc_sim_data(sim_dir):
     _print(timer.ftoc('write'))
 
 
+def save_gpu_sim_data(sim_dir, gpu_dir, bn_ixyz, adj_bn, mat_bn, saf_bn, tr=None, compress=None):
+    # rotate, fold (FCC) and sort boundary-node data (from voxelizer) and sources/receivers in one pass,
+    # write GPU-ready vox_out.h5 and signals.h5 to gpu_dir once (other .h5 files copied from sim_dir)
+    # same result as copy_sim_data, rotate, fold_fcc_sim_data and sort_sim_data in sequence
+    def _print(fstring):
+        print(f'--GPU_DATA: {fstring}')
+    timer = TimerDict()
+    sim_dir = Path(sim_dir)
+    gpu_dir = Path(gpu_dir)
+    _print(f'{gpu_dir=}')
+    if not gpu_dir.exists():
+        gpu_dir.mkdir(parents=True)
+    else:
+        assert gpu_dir.is_dir()
+
+    timer.tic('read')
+    h5f = h5py.File(sim_dir / Path('cart_grid.h5'), 'r')
+    xv = h5f['xv'][()]
+    yv = h5f['yv'][()]
+    zv = h5f['zv'][()]
+    h = h5f['h'][()]
+    h5f.close()
+
+    h5f = h5py.File(sim_dir / Path('constants.h5'), 'r')
+    fcc_flag = h5f['fcc_flag'][()]
+    h5f.close()
+
+    h5f = h5py.File(sim_dir / Path('signals.h5'), 'r')
+    signals = {name: h5f[name][()] for name in h5f.keys()}
+    h5f.close()
+    _print(timer.ftoc('read'))
+
+    Nx, Ny, Nz = xv.size, yv.size, zv.size
+    if tr is None:
+        tr = _default_tr(Nx, Ny, Nz)
+    else:
+        assert np.all(np.sort(tr) == npa([0, 1, 2]))
+    _print(f'{tr=}')
+    fold = fcc_flag == 1
+
+    timer.tic('transform')
+    Nxt, Nyt, Nzt = _swap3(Nx, Ny, Nz, tr)
+    xvt, yvt, zvt = _swap3(xv, yv, zv, tr)
+    if fold:
+        assert (Nyt % 2) == 0
+        Nyf = np.int_(Nyt/2)+1
+    else:
+        Nyf = Nyt
+
+    def _transform(ixyz):
+        # rotated and folded linear indices, and which points got folded
+        ix, iy, iz = _swap3(*ind2sub3d(ixyz, Nx, Ny, Nz), tr)
+        folded = (iy >= Nyt/2) if fold else np.zeros(ixyz.shape, dtype=bool)
+        iy = np.where(folded, Nyt-iy-1, iy)
+        return (ix*Nyf + iy)*Nzt + iz, folded
+
+    bn_ixyzt, folded = _transform(bn_ixyz)
+    ii = np.argsort(bn_ixyzt)
+    bn_ixyzt = bn_ixyzt[ii]
+    # adj columns: rotated, then swapped for folded points
+    NN = adj_bn.shape[1]
+    cols = _adj_column_order(tr, NN)
+    swap = np.arange(NN)
+    if fold:
+        swap[[0, 6, 1, 7, 2, 9, 3, 8]] = [6, 0, 7, 1, 9, 2, 8, 3]
+    adj_bnt = np.empty_like(adj_bn)
+    nb_gather_adj(adj_bn, ii, folded, cols, cols[swap], adj_bnt)
+    mat_bnt = mat_bn[ii]
+    saf_bnt = saf_bn[ii]
+    del ii, folded
+
+    in_ixyzt, _ = _transform(signals['in_ixyz'])
+    ii = np.argsort(in_ixyzt)
+    signals['in_ixyz'] = in_ixyzt[ii]
+    signals['in_sigs'] = signals['in_sigs'][ii]
+
+    out_ixyzt, _ = _transform(signals['out_ixyz'])
+    ii = np.argsort(out_ixyzt)
+    signals['out_ixyz'] = out_ixyzt[ii]
+    # out_alpha = out_alpha[ii] #will apply to reordered signals
+    signals['out_reorder'] = np.argsort(ii)
+    _print(timer.ftoc('transform'))
+
+    timer.tic('write')
+    if compress is not None:
+        kw = {'compression': 'gzip', 'compression_opts': compress}
+    else:
+        kw = {}
+    if gpu_dir.resolve() != sim_dir.resolve():
+        for file in sim_dir.glob('*.h5'):
+            if file.name not in ('vox_out.h5', 'signals.h5'):
+                shutil.copy(file, gpu_dir)
+
+    h5f = h5py.File(gpu_dir / Path('signals.h5'), 'w')
+    for name, data in signals.items():
+        h5f.create_dataset(name, data=data, **(kw if np.ndim(data) > 0 else {}))
+    h5f.close()
+
+    h5f = h5py.File(gpu_dir / Path('vox_out.h5'), 'w')
+    h5f.create_dataset('bn_ixyz', data=bn_ixyzt, **kw)
+    h5f.create_dataset('adj_bn', data=adj_bnt, **kw)
+    h5f.create_dataset('mat_bn', data=mat_bnt, **kw)
+    h5f.create_dataset('saf_bn', data=saf_bnt, **kw)
+    h5f.create_dataset('xv', data=xvt, **kw)
+    h5f.create_dataset('yv', data=yvt, **kw)
+    h5f.create_dataset('zv', data=zvt, **kw)
+    h5f.create_dataset('h', data=np.float64(h))
+    h5f.create_dataset('Nx', data=np.int64(Nxt))
+    h5f.create_dataset('Ny', data=np.int64(Nyf))
+    h5f.create_dataset('Nz', data=np.int64(Nzt))
+    h5f.create_dataset('Nb', data=np.int64(bn_ixyzt.size))
+    h5f.close()
+
+    if fold:
+        h5f = h5py.File(gpu_dir / Path('constants.h5'), 'r+')
+        h5f['fcc_flag'][()] = 2
+        h5f.close()
+    _print(timer.ftoc('write'))
+
+
+@nb.jit(nopython=True, parallel=False)
+def nb_gather_adj(adj_bn, rows, folded, cols, cols_folded, adj_bnt):
+    # adj_bnt[i] = adj_bn[rows[i]] with columns reordered (different order for folded points)
+    for i in range(rows.size):
+        r = rows[i]
+        c = cols_folded if folded[r] else cols
+        for j in range(c.size):
+            adj_bnt[i, j] = adj_bn[r, c[j]]
+
+
 def copy_sim_data(src_sim_dir, dst_sim_dir):
     def _print(fstring):
         print(f'--COPY DATA: {fstring}')
@@ -12,13 +12,15 @@ from typing import Literal
 import uuid
 
 import click
+import h5py
 import numpy as np
 
 from pffdtd.common.misc import ensure_folder_exists
 from pffdtd.sim3d.constants import SimConstants
+from pffdtd.sim3d.container import pack_sim_dir
 from pffdtd.sim3d.materials import SimMaterials
 from pffdtd.sim3d.room_geometry import RoomGeometry
-from pffdtd.sim3d.rotate import rotate, sort_sim_data, copy_sim_data, fold_fcc_sim_data
+from pffdtd.sim3d.rotate import rotate, sort_sim_data, copy_sim_data, fold_fcc_sim_data, save_gpu_sim_data
 from pffdtd.sim3d.signals import SimSignals
 from pffdtd.voxelizer.cart_grid import CartGrid
 from pffdtd.voxelizer.vox_grid import VoxGrid
@@ -53,6 +55,10 @@ def sim_setup_3d(
     compress=None,  # GZIP compress for HDF5, 0 to 9 (fast to slow)
     rot_az_el=[0., 0.],  # to rotate the whole scene (including sources/receivers) -- to test robustness of scheme
     model_factory=None,
+    vox_cache_folder=None,  # to reuse voxelization results of unchanged parts of the scene from a previous run
+    vox_method='voxel',  # 'voxel' or 'scanline' (rasterize triangles along grid lines)
+    vox_stream=False,  # write boundary-node data to save_folder as voxels finish (bounded memory, for very large grids; adjacency check still needs 10 bytes per boundary node)
+    sim_container=False,  # pack save_folder into one compact file (python engine; 'sim3d unpack' for C++ engine)
 ):
     assert Tc is not None
     assert rh is not None
@@ -65,6 +71,9 @@ def sim_setup_3d(
     assert mat_folder is not None
     assert mat_files_dict is not None
     assert duration is not None
+    if vox_stream and (vox_method != 'voxel' or vox_cache_folder is not None):
+        raise ValueError(f"vox_stream needs vox_method='voxel' and no vox_cache_folder, "
+                         f'got vox_method={vox_method!r}, vox_cache_folder={vox_cache_folder!r}')
 
     # some constants for the simulation, in one place
     constants = SimConstants(Tc=Tc, rh=rh, fmax=fmax, PPW=PPW, fcc=fcc_flag)
@@ -113,24 +122,45 @@ def sim_setup_3d(
 
     # 'voxelize' the scene (calculate FDTD mesh adjacencies and identify/correct boundary surfaces)
     vox_scene = VoxScene(room_geo, cart_grid, vox_grid, fcc=fcc_flag)
-    vox_scene.calc_adj(Nprocs=Nprocs)
-    vox_scene.check_adj_full()
-    vox_scene.save(save_folder, compress=compress)
-
-    # check that source/receivers don't intersect with boundaries
-    sim_comms.check_for_clashes(vox_scene.bn_ixyz)
-
-    # make copy for sorting/rotation for gpu
-    if save_folder_gpu is not None and Path(save_folder_gpu) != Path(save_folder):
-        copy_sim_data(save_folder, save_folder_gpu)
-    if save_folder_gpu is not None:
-        rotate(save_folder_gpu)
-        if fcc_flag:
-            fold_fcc_sim_data(save_folder_gpu)
-        sort_sim_data(save_folder_gpu)
+    if vox_stream:
+        # boundary-node data not kept in memory (no drawing), reciprocity checked on
+        # vox_out.h5 (sorted indices and packed adjacencies in memory, 10 bytes per boundary node)
+        vox_scene.calc_adj_stream(save_folder, Nprocs=Nprocs, compress=compress)
+        vox_scene.check_adj_stream(save_folder, Nprocs=Nprocs)
+        # check that source/receivers don't intersect with boundaries
+        with h5py.File(Path(save_folder) / Path('vox_out.h5'), 'r') as h5f:
+            sim_comms.check_for_clashes(h5f['bn_ixyz'])
+
+        # make copy for sorting/rotation for gpu (in place, in chunks)
+        if save_folder_gpu is not None and Path(save_folder_gpu) != Path(save_folder):
+            copy_sim_data(save_folder, save_folder_gpu)
+        if save_folder_gpu is not None:
+            rotate(save_folder_gpu)
+            if fcc_flag:
+                fold_fcc_sim_data(save_folder_gpu)
+            sort_sim_data(save_folder_gpu)
+    else:
+        vox_scene.calc_adj(Nprocs=Nprocs, cache_folder=vox_cache_folder, method=vox_method)
+        vox_scene.check_adj_full(Nprocs=Nprocs)
+        # CPU-format data not needed if overwritten by gpu data
+        if save_folder_gpu is None or Path(save_folder_gpu) != Path(save_folder):
+            vox_scene.save(save_folder, compress=compress)
+
+        # check that source/receivers don't intersect with boundaries
+        sim_comms.check_for_clashes(vox_scene.bn_ixyz)
+
+        # sorted/rotated/folded data for gpu, written once
+        if save_folder_gpu is not None:
+            save_gpu_sim_data(save_folder, save_folder_gpu, vox_scene.bn_ixyz, vox_scene.adj_bn,
+                              vox_scene.mat_bn, vox_scene.saf_bn, compress=compress)
+
+    if sim_container:
+        pack_sim_dir(save_folder, remove=True)
 
     # draw the voxelisation (use polyscope for dense grids)
-    if draw_vox:
+    if draw_vox and vox_stream:
+        print('--SIM_SETUP: skipping voxelization drawing, boundary nodes not kept in memory with vox_stream')
+    elif draw_vox:
         room_geo.draw(wireframe=False, backend=draw_backend)
         vox_scene.draw(backend=draw_backend)
         room_geo.show(backend=draw_backend)
@@ -162,6 +192,11 @@ class Setup3D:
     draw_vox: bool = True
     draw_backend: Literal['mayavi', 'polyscope'] = 'polyscope'
 
+    vox_cache_folder: str | None = None
+    vox_method: str = 'voxel'
+    vox_stream: bool = False
+    sim_container: bool = False
+
 
 def run_setup3d_for_class(class_name):
     assert issubclass(class_name, Setup3D)
@@ -205,18 +240,26 @@ def run_setup3d_for_class(class_name):
         compress=sim.compress,
         rot_az_el=sim.rot_az_el,
         model_factory=model_factory,
+        vox_cache_folder=sim.vox_cache_folder,
+        vox_method=sim.vox_method,
+        vox_stream=sim.vox_stream,
+        sim_container=sim.sim_container,
     )
 
 
-def run_setup3d_for_file(sim_file):
+def load_setup3d_classes(sim_file):
     module_id = str(uuid.uuid1())
     spec = importlib.util.spec_from_file_location(module_id, sim_file)
     loaded = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(loaded)
 
-    for name, value in inspect.getmembers(loaded):
-        if inspect.isclass(value) and issubclass(value, Setup3D) and name != 'Setup3D':
-            run_setup3d_for_class(value)
+    return [value for name, value in inspect.getmembers(loaded)
+            if inspect.isclass(value) and issubclass(value, Setup3D) and name != 'Setup3D']
+
+
+def run_setup3d_for_file(sim_file):
+    for sim_class in load_setup3d_classes(sim_file):
+        run_setup3d_for_class(sim_class)
 
 
 @click.command(name='setup', help='Generate simulation files.')
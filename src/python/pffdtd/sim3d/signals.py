@@ -226,12 +226,15 @@ class SimSignals:
 
         return alpha8, ixyz8
 
-    def check_for_clashes(self, bn_ixyz):
+    def check_for_clashes(self, bn_ixyz, chunk_size=2**24):
         # scheme implementation designed to only have source/receiver in 'regular' air nodes
+        # bn_ixyz can be an HDF5 dataset (read in chunks)
         def _check_for_clashes(_ixyz, bn_ixyz):
             ixyz = np.unique(_ixyz)  # can have duplicates in receivers
-            # could speed this up with a numba routine (don't need to know clashes, just say yes or no)
-            assert np.union1d(ixyz.flat[:], bn_ixyz).size == ixyz.size + bn_ixyz.size
+            for i in range(0, bn_ixyz.shape[0], chunk_size):
+                bn_ixyz_chunk = bn_ixyz[i:i+chunk_size]
+                # could speed this up with a numba routine (don't need to know clashes, just say yes or no)
+                assert np.union1d(ixyz.flat[:], bn_ixyz_chunk).size == ixyz.size + bn_ixyz_chunk.size
             self.print('intersection with boundaries: passed')
 
         timer = TimerDict()
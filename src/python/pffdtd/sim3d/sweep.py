@@ -0,0 +1,366 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Parameter sweeps over Setup3D classes, with cached intermediate results
+
+A sweep expands lists of values for Setup3D attributes (fmax, ppw, materials,
+rot_az_el, source_index, ...) into all their combinations. Each variant runs
+through a chain of stages:
+
+    materials -> geometry -> voxelize -> signals -> engine -> process -> analysis
+
+where signals also reads the materials. Each stage writes its output into
+cache_dir/<stage>/<key>, with the key a hash of the stage's inputs: the
+attributes it reads and the keys of the stages it depends on. Variants that
+share a prefix (e.g. only source_index differs) share those stage outputs,
+and a later sweep reuses everything already in the cache. Stages of the same
+depth don't depend on each other and run on a pool of worker processes.
+
+Swept attributes not listed in STAGE_PARAMS are assumed to affect all stages,
+unless the class maps them to the first stage using them, e.g.
+sweep_params = {'absorption': 'materials'} for an attribute only read in
+generate_materials.
+The analysis stage runs if the class defines analyze(self, sim_dir), which
+returns a dict (saved as analysis.json).
+"""
+
+import hashlib
+import inspect
+import itertools
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import time
+
+import click
+import h5py
+import numpy as np
+
+from pffdtd.common.misc import file_hash
+from pffdtd.common.procs import run_task_queue, worker_utilisation
+from pffdtd.sim3d.constants import SimConstants
+from pffdtd.sim3d.engine import EnginePython3D
+from pffdtd.sim3d.materials import SimMaterials
+from pffdtd.sim3d.process_outputs import process_outputs
+from pffdtd.sim3d.room_geometry import RoomGeometry
+from pffdtd.sim3d.rotate import copy_sim_data, fold_fcc_sim_data, rotate, sort_sim_data
+from pffdtd.sim3d.setup import load_setup3d_classes
+from pffdtd.sim3d.signals import SimSignals
+from pffdtd.voxelizer.cart_grid import CartGrid
+from pffdtd.voxelizer.vox_grid import VoxGrid
+from pffdtd.voxelizer.vox_scene import VoxScene
+
+SWEEP_CACHE_VERSION = 1
+STAGE_FILE = 'stage.json'
+
+SWEEP_STAGES = ('materials', 'geometry', 'voxelize', 'signals', 'engine', 'process', 'analysis')
+STAGE_DEPS = {
+    'materials': (),
+    'geometry': (),
+    'voxelize': ('geometry',),
+    'signals': ('voxelize', 'materials'),
+    'engine': ('signals',),
+    'process': ('engine',),
+    'analysis': ('process',),
+}
+STAGE_PARAMS = {
+    'materials': ('materials', 'mat_folder'),
+    'geometry': ('model_file', 'fmax', 'ppw', 'fcc', 'Tc', 'rh', 'bmin', 'bmax', 'rot_az_el'),
+    'voxelize': ('vox_method', 'compress'),
+    'signals': ('source_index', 'source_signal', 'duration', 'diff_source'),
+    'engine': (),
+    'process': (),
+    'analysis': (),
+}
+STAGE_HOOKS = {'materials': 'generate_materials', 'geometry': 'generate_model', 'analysis': 'analyze'}
+
+PROCESS_DEFAULTS = {
+    'resample_fs': 48_000.0,
+    'fcut_lowcut': 10.0,
+    'order_lowcut': 8,
+    'fcut_lowpass': 0.0,
+    'order_lowpass': 8,
+    'symmetric_lowpass': False,
+    'air_abs_filter': 'none',
+    'save_wav': True,
+}
+
+
+def _print(fstring):
+    print(f'--SWEEP: {fstring}')
+
+
+def expand_params(params):
+    """All combinations of parameter values, as list of dicts (name -> value)"""
+    names = list(params.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[params[name] for name in names])]
+
+
+def _hash(obj):
+    text = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=10).hexdigest()
+
+
+def _variant(sim_class, overrides):
+    return type(sim_class.__name__, (sim_class,), dict(overrides))()
+
+
+def _link(src, dst):
+    # hard links where possible, cached files are never modified in place
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def _stage_inputs(stage, sim, overrides, options):
+    inputs = {name: getattr(sim, name, None) for name in STAGE_PARAMS[stage]}
+    # other attributes: first stage using them as declared by class, else all stages
+    known = {name for names in STAGE_PARAMS.values() for name in names}
+    declared = getattr(sim, 'sweep_params', {})
+    other = {name for name, declared_stage in declared.items() if declared_stage == stage}
+    other |= {name for name in overrides if name not in known and name not in declared}
+    inputs['other'] = {name: getattr(sim, name) for name in other}
+    hook = STAGE_HOOKS.get(stage)
+    if hook is not None and hasattr(sim, hook):
+        inputs[hook] = inspect.getsource(getattr(sim, hook))
+    elif stage == 'materials':
+        inputs['files'] = {mat: file_hash(Path(sim.mat_folder) / file) for mat, file in sim.materials.items()}
+    elif stage == 'geometry':
+        inputs['model'] = file_hash(sim.model_file)
+    if stage == 'engine':
+        inputs['engine'] = options['engine']
+    if stage == 'process':
+        inputs['process'] = options['process']
+    return inputs
+
+
+def _run_materials(sim, dirs, out_dir, options):
+    if hasattr(sim, 'generate_materials'):
+        sim.mat_folder = str(out_dir)
+        sim.generate_materials()
+    else:
+        for file in set(sim.materials.values()):
+            _link(Path(sim.mat_folder) / file, out_dir / file)
+
+
+def _run_geometry(sim, dirs, out_dir, options):
+    constants = SimConstants(Tc=sim.Tc, rh=sim.rh, fmax=sim.fmax, PPW=sim.ppw, fcc=sim.fcc)
+    constants.save(out_dir)
+    if hasattr(sim, 'generate_model'):
+        sim.model_file = str(out_dir / 'model.json')
+        sim.generate_model(constants)
+    else:
+        shutil.copy(sim.model_file, out_dir / 'model.json')
+
+
+def _room_geometry(sim, dirs):
+    bmin, bmax = sim.bmin, sim.bmax
+    if (bmin is not None) and (bmax is not None):
+        bmin = np.array(bmin, dtype=np.float64)
+        bmax = np.array(bmax, dtype=np.float64)
+    return RoomGeometry(dirs['geometry'] / 'model.json', az_el=sim.rot_az_el, bmin=bmin, bmax=bmax)
+
+
+def _run_voxelize(sim, dirs, out_dir, options):
+    room_geo = _room_geometry(sim, dirs)
+    with h5py.File(dirs['geometry'] / 'constants.h5', 'r') as h5f:
+        h = h5f['h'][()]
+    cart_grid = CartGrid(h=h, offset=3.5, bmin=room_geo.bmin, bmax=room_geo.bmax, fcc=sim.fcc)
+    cart_grid.save(out_dir)
+
+    # stages already run in parallel
+    vox_grid = VoxGrid(room_geo, cart_grid)
+    vox_grid.fill(Nprocs=1)
+    vox_scene = VoxScene(room_geo, cart_grid, vox_grid, fcc=sim.fcc)
+    vox_scene.calc_adj(Nprocs=1, method=sim.vox_method)
+    vox_scene.check_adj_full(Nprocs=1)
+    vox_scene.save(out_dir, compress=sim.compress or None)
+
+
+def _run_signals(sim, dirs, out_dir, options):
+    _link(dirs['geometry'] / 'constants.h5', out_dir / 'constants.h5')
+    _link(dirs['voxelize'] / 'cart_grid.h5', out_dir / 'cart_grid.h5')
+    _link(dirs['voxelize'] / 'vox_out.h5', out_dir / 'vox_out.h5')
+
+    room_geo = _room_geometry(sim, dirs)
+    materials = SimMaterials(save_folder=out_dir)
+    materials.package(mat_files_dict=sim.materials, mat_list=room_geo.mat_str, read_folder=dirs['materials'])
+
+    sim_comms = SimSignals(save_folder=out_dir)
+    sim_comms.prepare_source_pts(room_geo.Sxyz[sim.source_index-1])
+    sim_comms.prepare_receiver_pts(room_geo.Rxyz)
+    sim_comms.prepare_source_signals(sim.duration, sig_type=sim.source_signal)
+    if sim.diff_source:
+        sim_comms.diff_source()
+    sim_comms.save(compress=sim.compress or None)
+    with h5py.File(out_dir / 'vox_out.h5', 'r') as h5f:
+        sim_comms.check_for_clashes(h5f['bn_ixyz'])
+
+
+def _run_engine(sim, dirs, out_dir, options):
+    engine = options['engine']
+    if engine == 'python':
+        for file in dirs['signals'].glob('*.h5'):
+            _link(file, out_dir / file.name)
+        eng = EnginePython3D(out_dir, nthreads=options['engine_nthreads'])
+        eng.run_all(1)
+        eng.save_outputs()
+    else:
+        # native engines read gpu layout (sorted, rotated and folded)
+        copy_sim_data(dirs['signals'], out_dir)
+        rotate(out_dir)
+        if sim.fcc:
+            fold_fcc_sim_data(out_dir)
+        sort_sim_data(out_dir)
+        exe = Path(os.environ.get('PFFDTD_ENGINE_3D', 'pffdtd-engine'))
+        subprocess.run([str(exe), 'sim3d', '-e', engine, '-p', '64', '-s', str(out_dir)], check=True)
+
+
+def _run_process(sim, dirs, out_dir, options):
+    _link(dirs['engine'] / 'signals.h5', out_dir / 'signals.h5')
+    _link(dirs['engine'] / 'constants.h5', out_dir / 'constants.h5')
+    shutil.copy(dirs['engine'] / 'sim_outs.h5', out_dir / 'sim_outs.h5')  # r_out gets added
+    process_outputs(sim_dir=out_dir, plot=False, plot_raw=False, **options['process'])
+
+
+def _run_analysis(sim, dirs, out_dir, options):
+    result = sim.analyze(dirs['process'])
+    with open(out_dir / 'analysis.json', 'w') as f:
+        json.dump(result, f, indent=2, default=float)
+
+
+STAGE_FUNCS = {
+    'materials': _run_materials,
+    'geometry': _run_geometry,
+    'voxelize': _run_voxelize,
+    'signals': _run_signals,
+    'engine': _run_engine,
+    'process': _run_process,
+    'analysis': _run_analysis,
+}
+
+
+def _stage_depth(stage):
+    return 1 + max((_stage_depth(dep) for dep in STAGE_DEPS[stage]), default=-1)
+
+
+class Sweep:
+    """Stages of all variants of a sweep, deduplicated by key
+    """
+
+    def __init__(self, sim_class, params, cache_dir, engine='python', process=None, until='analysis', Nprocs=1):
+        assert until in SWEEP_STAGES
+        self.sim_class = sim_class
+        self.cache_dir = Path(cache_dir)
+        self.Nprocs = Nprocs
+        self.options = {
+            'engine': engine,
+            'process': {**PROCESS_DEFAULTS, **(process or {})},
+            'engine_nthreads': 1 if Nprocs > 1 else None,
+        }
+        stages = SWEEP_STAGES[:SWEEP_STAGES.index(until)+1]
+
+        self.variants = []
+        self.nodes = {}  # (stage, key) -> (overrides, keys of variant)
+        # params: name -> list of values (all combinations), or list of variants (dicts)
+        for overrides in (params if isinstance(params, list) else expand_params(params)):
+            sim = _variant(sim_class, overrides)
+            keys = {}
+            for stage in stages:
+                if stage == 'analysis' and not hasattr(sim, 'analyze'):
+                    continue
+                inputs = _stage_inputs(stage, sim, overrides, self.options)
+                deps = {dep: keys[dep] for dep in STAGE_DEPS[stage]}
+                keys[stage] = _hash([SWEEP_CACHE_VERSION, stage, inputs, deps])
+                self.nodes.setdefault((stage, keys[stage]), (overrides, keys))
+            self.variants.append((overrides, keys))
+
+    def stage_dir(self, stage, key):
+        return self.cache_dir / stage / key
+
+    def is_cached(self, stage, key):
+        return (self.stage_dir(stage, key) / STAGE_FILE).exists()
+
+    def run_stage(self, stage, key):
+        overrides, keys = self.nodes[(stage, key)]
+        sim = _variant(self.sim_class, overrides)
+        dirs = {dep: self.stage_dir(dep, keys[dep]) for dep in keys}
+        out_dir = self.stage_dir(stage, key)
+
+        # write to temporary folder, renamed once complete
+        tmp_dir = out_dir.with_name(f'{key}.tmp{os.getpid()}')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        t0 = time.perf_counter()
+        STAGE_FUNCS[stage](sim, dirs, tmp_dir.absolute(), self.options)
+        elapsed = time.perf_counter() - t0
+        with open(tmp_dir / STAGE_FILE, 'w') as f:
+            json.dump({'stage': stage, 'key': key, 'params': overrides, 'deps': {dep: keys[dep] for dep in STAGE_DEPS[stage]},
+                       'elapsed': elapsed}, f, indent=2, default=str)
+        shutil.rmtree(out_dir, ignore_errors=True)  # incomplete leftovers
+        tmp_dir.rename(out_dir)
+        return elapsed
+
+    def run(self):
+        """Run all stages not in cache (by depth, in parallel), returns one dict per variant"""
+        Ncached = 0
+        for depth in range(len(SWEEP_STAGES)):
+            todo = [node for node in self.nodes if _stage_depth(node[0]) == depth]
+            Ncached += sum(self.is_cached(*node) for node in todo)
+            todo = [node for node in todo if not self.is_cached(*node)]
+            if len(todo) == 0:
+                continue
+            _print(f'running {len(todo)} stages: {", ".join(sorted({node[0] for node in todo}))}')
+            if self.Nprocs == 1:
+                elapsed = [self.run_stage(*node) for node in todo]
+            else:
+                elapsed, stats = run_task_queue(self.run_stage, todo, min(self.Nprocs, len(todo)))
+                for line in worker_utilisation(stats):
+                    _print(line)
+            for node, t in zip(todo, elapsed):
+                _print(f'{node[0]} {node[1]}: {t:.2f} s')
+        _print(f'{len(self.variants)} variants, {len(self.nodes)} stages ({Ncached} cached)')
+        self.Ncached = Ncached
+
+        return [{'params': overrides, **{stage: str(self.stage_dir(stage, key)) for stage, key in keys.items()}}
+                for overrides, keys in self.variants]
+
+
+def run_sweep(sim_class, params, cache_dir, engine='python', process=None, until='analysis', Nprocs=1, out_file=None):
+    """Run a parameter sweep of a Setup3D subclass (params: name -> list of values)
+
+    Returns one dict per variant with its parameters and the folder of each stage.
+    """
+    sweep = Sweep(sim_class, params, cache_dir, engine=engine, process=process, until=until, Nprocs=Nprocs)
+    results = sweep.run()
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+    return results
+
+
+@click.command(name='sweep', help='Run parameter sweep with cached stages.')
+@click.argument('sim_file', nargs=1, type=click.Path(exists=True))
+@click.option('--param', 'params', multiple=True, help='name=[values] (JSON list), e.g. fmax=[500,800]')
+@click.option('--cache_dir', default='sweep_cache', type=click.Path())
+@click.option('--until', type=click.Choice(SWEEP_STAGES), default='analysis')
+@click.option('--engine', default='python', help="'python' or native engine (cpu, cuda, ...)")
+@click.option('--nprocs', default=1, type=int, help='stages run in parallel')
+@click.option('--fcut_lowcut', default=PROCESS_DEFAULTS['fcut_lowcut'])
+@click.option('--fcut_lowpass', default=PROCESS_DEFAULTS['fcut_lowpass'])
+@click.option('--air_abs_filter', default=PROCESS_DEFAULTS['air_abs_filter'])
+def main(sim_file, params, cache_dir, until, engine, nprocs, fcut_lowcut, fcut_lowpass, air_abs_filter):
+    sweep_params = {}
+    for param in params:
+        name, values = param.split('=', 1)
+        sweep_params[name] = json.loads(values)
+        assert isinstance(sweep_params[name], list)
+
+    process = {'fcut_lowcut': fcut_lowcut, 'fcut_lowpass': fcut_lowpass, 'air_abs_filter': air_abs_filter}
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    for sim_class in load_setup3d_classes(sim_file):
+        run_sweep(sim_class, sweep_params, cache_dir, engine=engine, process=process, until=until, Nprocs=nprocs,
+                  out_file=Path(cache_dir) / f'sweep_{sim_class.__name__}.json')
@@ -0,0 +1,207 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Scanline voxelization (alternative to per-voxel point tests in VoxScene)
+
+All rays in the voxelizer are grid-aligned (6 Cartesian or 12 FCC neighbour
+directions, in pairs of opposite directions along the same grid lines). So
+instead of testing every point near a triangle, each triangle is rasterized
+into the grid lines it crosses (for each direction family). The crossing
+parameter is computed once per line and only the few points on either side
+of the crossing go through the (same) ray-triangle test.
+
+Cost scales with triangle area over h^2 (number of lines crossed) rather than
+with points x triangles per voxel. Output is the same boundary-node data as
+the voxel method (bn_ixyz, adj_bn, ndist_bn, tidx_bn), sorted by bn_ixyz.
+
+Only interior points (one-layer halo around grid) are marked, as with voxels.
+"""
+
+import numba as nb
+import numpy as np
+
+from pffdtd.common.procs import cost_chunks, run_task_queue, worker_utilisation
+from pffdtd.geometry.tri_ray_intersection import nb_tri_ray_intersection
+
+R_EPS = 1e-6  # relative eps (to grid spacing) for near hits, same as VoxScene
+
+
+def scanline_bn(tris_pre, cart_grid, VV, vvh, uvv, hf, fcc, Nprocs=1):
+    """Boundary-node data by scanline rasterization of triangles.
+
+    tris_pre: precomputed triangles, VV: integer neighbour steps (opposite directions in pairs)
+    vvh: steps scaled by h, uvv: normalised directions, hf: length of steps
+    Returns (bn_ixyz, adj_bn, ndist_bn, tidx_bn)
+    """
+    cg = cart_grid
+    NN = VV.shape[0]
+    args = (cg.xv, cg.yv, cg.zv, cg.h, np.int_(VV), vvh, uvv, hf, fcc,
+            np.ascontiguousarray(tris_pre['v']), np.ascontiguousarray(tris_pre['unor']),
+            np.ascontiguousarray(tris_pre['cent']), np.ascontiguousarray(tris_pre['eab_unor']),
+            np.ascontiguousarray(tris_pre['ebc_unor']), np.ascontiguousarray(tris_pre['eca_unor']),
+            np.ascontiguousarray(tris_pre['bmin']), np.ascontiguousarray(tris_pre['bmax']),
+            1.0e-3*cg.h, 1.0e-6)
+
+    def no_records():
+        return np.zeros((0,), np.int64), np.zeros((0,), np.int8), np.zeros((0,), np.float64), np.zeros((0,), np.int32), np.zeros((0,), np.bool_)
+
+    def process_tris(tri_list):
+        # count first, then fill exact-size record arrays
+        Nrec = nb_scanline_tris(tri_list, *args, *no_records())
+        rec_ixyz = np.empty((Nrec,), np.int64)
+        rec_k = np.empty((Nrec,), np.int8)
+        rec_dist = np.empty((Nrec,), np.float64)
+        rec_tidx = np.empty((Nrec,), np.int32)
+        rec_nb = np.empty((Nrec,), np.bool_)
+        nb_scanline_tris(tri_list, *args, rec_ixyz, rec_k, rec_dist, rec_tidx, rec_nb)
+        return rec_ixyz, rec_k, rec_dist, rec_tidx, rec_nb
+
+    Ntris = tris_pre.size
+    if Nprocs == 1:
+        records = [process_tris(np.arange(Ntris))]
+    else:
+        # compile once before forking (otherwise every worker compiles)
+        nb_scanline_tris(np.zeros((0,), np.int64), *args, *no_records())
+        # workers pull chunks of triangles from a queue (largest first), cost estimated by bounding-box area in grid steps
+        ext = np.sort((tris_pre['bmax']-tris_pre['bmin'])/cg.h + 1.0, axis=-1)
+        chunks, chunk_costs = cost_chunks(ext[:, 1]*ext[:, 2], 16*Nprocs)
+        records, stats = run_task_queue(process_tris, [(np.sort(chunk),) for chunk in chunks], Nprocs, costs=chunk_costs)
+        for line in worker_utilisation(stats):
+            print(f'--SCANLINE: {line}')
+
+    rec_ixyz, rec_k, rec_dist, rec_tidx, rec_nb = [np.concatenate(rec) for rec in zip(*records)]
+    del records
+
+    bn_ixyz, rec_bn = np.unique(rec_ixyz, return_inverse=True)
+    Nbt = bn_ixyz.size
+
+    adj_bn = np.full((Nbt, NN), True, dtype=bool)
+    adj_bn[rec_bn, rec_k] = False
+    # anything 'near boundary' not adjacent to any neighbour
+    nb_bn = np.bincount(rec_bn, weights=rec_nb, minlength=Nbt) > 0
+    adj_bn[nb_bn] = False
+
+    # nearest hit, lowest triangle index on ties (as in order of voxel tests)
+    order = np.lexsort((rec_tidx, rec_dist, rec_bn))
+    first = order[np.r_[True, rec_bn[order][1:] != rec_bn[order][:-1]]] if Nbt > 0 else order
+    ndist_bn = rec_dist[first]
+    tidx_bn = rec_tidx[first]
+
+    return bn_ixyz, adj_bn, ndist_bn, tidx_bn
+
+
+@nb.jit(nopython=True, parallel=False)
+def nb_scanline_tris(tri_list, xv, yv, zv, h, ivv, vvh, uvv, hf, fcc,
+                     tris_v, tris_unor, tris_cent, tris_eab_unor, tris_ebc_unor, tris_eca_unor, tris_bmin, tris_bmax,
+                     d_eps, cp_eps,
+                     rec_ixyz, rec_k, rec_dist, rec_tidx, rec_nb):
+    # records (point, direction, distance, tri, near-boundary) for every marked non-adjacency
+    # only counts records if record arrays are empty
+    write = rec_ixyz.size > 0
+    Nx, Ny, Nz = xv.size, yv.size, zv.size
+    NN = ivv.shape[0]
+    bb_eps = hf*(1+R_EPS)
+    nb_eps = R_EPS*hf
+    hit_eps = (1+R_EPS)*hf
+    xyzv = (xv, yv, zv)
+    Nxyz = np.array([Nx, Ny, Nz])
+    ilo = np.empty((3,), np.int64)
+    ihi = np.empty((3,), np.int64)
+    ixyz = np.empty((3,), np.int64)
+
+    Nrec = 0
+    for tri_ind in tri_list:
+        tri_v = tris_v[tri_ind]
+        tri_unor = tris_unor[tri_ind]
+        tri_cent = tris_cent[tri_ind]
+        tri_eab_unor = tris_eab_unor[tri_ind]
+        tri_ebc_unor = tris_ebc_unor[tri_ind]
+        tri_eca_unor = tris_eca_unor[tri_ind]
+        ux, uy, uz = tri_unor[0], tri_unor[1], tri_unor[2]
+        cx, cy, cz = tri_cent[0], tri_cent[1], tri_cent[2]
+
+        # index range of interior points around bounding box (with some slack, exact bbox test later)
+        empty = False
+        for d in range(3):
+            v = xyzv[d]
+            ilo[d] = max(1, int(np.floor((tris_bmin[tri_ind, d] - bb_eps - v[0])/h)))
+            ihi[d] = min(Nxyz[d]-2, int(np.ceil((tris_bmax[tri_ind, d] + bb_eps - v[0])/h)))
+            if ilo[d] > ihi[d]:
+                empty = True
+        if empty:
+            continue
+
+        # one family per pair of opposite directions (even k has first non-zero component +1)
+        for k in range(0, NN, 2):
+            beta = uvv[k, 0]*ux + uvv[k, 1]*uy + uvv[k, 2]*uz
+            if np.abs(beta) < cp_eps:
+                continue  # parallel to triangle, ray test fails for all points
+
+            # lines: point(m) = c + m*s, with c[a]=0 on driving axis a
+            s = ivv[k]
+            a = 0
+            while s[a] == 0:
+                a += 1
+            b1 = (a+1) % 3
+            b2 = (a+2) % 3
+            # range of line offsets c[b] = i[b] - s[b]*i[a] over box
+            c1lo = ilo[b1] - max(s[b1]*ilo[a], s[b1]*ihi[a])
+            c1hi = ihi[b1] - min(s[b1]*ilo[a], s[b1]*ihi[a])
+            c2lo = ilo[b2] - max(s[b2]*ilo[a], s[b2]*ihi[a])
+            c2hi = ihi[b2] - min(s[b2]*ilo[a], s[b2]*ihi[a])
+            # crossing parameter along line, in steps
+            sdotn = h*(s[0]*ux + s[1]*uy + s[2]*uz)
+            for c1 in range(c1lo, c1hi+1):
+                for c2 in range(c2lo, c2hi+1):
+                    if fcc and (c1+c2) % 2 != 0:
+                        continue  # parity constant along FCC lines
+                    ixyz[a] = 0
+                    ixyz[b1] = c1
+                    ixyz[b2] = c2
+                    x0 = xv[0] + ixyz[0]*h
+                    y0 = yv[0] + ixyz[1]*h
+                    z0 = zv[0] + ixyz[2]*h
+                    mc = (ux*(cx-x0) + uy*(cy-y0) + uz*(cz-z0))/sdotn
+                    m0 = int(np.floor(mc))
+                    for m in range(max(m0-2, ilo[a]), min(m0+3, ihi[a])+1):
+                        ixyz[a] = m
+                        ixyz[b1] = c1 + s[b1]*m
+                        ixyz[b2] = c2 + s[b2]*m
+                        if ixyz[b1] < ilo[b1] or ixyz[b1] > ihi[b1] or ixyz[b2] < ilo[b2] or ixyz[b2] > ihi[b2]:
+                            continue
+                        ix, iy, iz = ixyz[0], ixyz[1], ixyz[2]
+                        x, y, z = xv[ix], yv[iy], zv[iz]
+
+                        # same masks as voxel method: bounding box, then distance to plane
+                        if x < tris_bmin[tri_ind, 0] - bb_eps or x > tris_bmax[tri_ind, 0] + bb_eps:
+                            continue
+                        if y < tris_bmin[tri_ind, 1] - bb_eps or y > tris_bmax[tri_ind, 1] + bb_eps:
+                            continue
+                        if z < tris_bmin[tri_ind, 2] - bb_eps or z > tris_bmax[tri_ind, 2] + bb_eps:
+                            continue
+                        dtp = ux*(cx-x) + uy*(cy-y) + uz*(cz-z)
+                        if np.abs(dtp) > bb_eps:
+                            continue
+
+                        # both directions along line
+                        for kk in range(k, k+2):
+                            t = nb_tri_ray_intersection(x-vvh[kk, 0], y-vvh[kk, 1], z-vvh[kk, 2],
+                                                        uvv[kk, 0], uvv[kk, 1], uvv[kk, 2], tri_v, tri_unor, tri_cent,
+                                                        tri_eab_unor, tri_ebc_unor, tri_eca_unor, d_eps, cp_eps)
+                            hd = t - hf  # shift, doesn't affect np.inf entries
+                            if hd < -nb_eps:
+                                continue  # hits behind point
+                            near = np.abs(hd) <= nb_eps
+                            if near:
+                                hd = np.abs(hd)  # so ndist is positive
+                            if hd > hit_eps:
+                                continue
+                            if write:
+                                rec_ixyz[Nrec] = (ix*Ny + iy)*Nz + iz
+                                rec_k[Nrec] = kk
+                                rec_dist[Nrec] = hd
+                                rec_tidx[Nrec] = tri_ind
+                                rec_nb[Nrec] = near
+                            Nrec += 1
+
+    return Nrec
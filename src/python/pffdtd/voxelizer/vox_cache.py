@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+"""Per-voxel result cache for incremental re-voxelization.
+
+Each non-empty voxel is keyed by a hash of everything its ray-triangle tests
+depend on: grid spacing and origin, scheme (Cartesian/FCC), voxel extent and
+the precomputed data of the triangles inside it (in order). When only a few
+objects in a scene move, most voxels hash to the same key as in the previous
+run and their boundary-node data can be reused instead of recomputed.
+
+Triangle indices are stored relative to the voxel's triangle list, so cached
+entries stay valid when triangles elsewhere in the scene are added or removed.
+"""
+
+import hashlib
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+VOX_CACHE_VERSION = 1
+
+
+class VoxCache:
+    """Cache of per-voxel boundary-node data, stored in one HDF5 file
+    """
+
+    def __init__(self, folder, NN, filename='vox_cache.h5'):
+        self.file = Path(folder) / filename
+        self.NN = NN
+        self.entries = {}  # key -> (bn_ixyz_loc, adj_bn, ndist_bn, tidx_loc)
+        self.new_entries = {}
+        self.hits = 0
+
+    def print(self, fstring):
+        print(f'--VOX_CACHE: {fstring}')
+
+    @staticmethod
+    def key(h, xyzmin, fcc, ixyz_start, Nhxyz, tris_pre):
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(np.float64(h).tobytes())
+        hasher.update(np.asarray(xyzmin, dtype=np.float64).tobytes())
+        hasher.update(np.int64(fcc).tobytes())
+        hasher.update(np.asarray(ixyz_start, dtype=np.int64).tobytes())
+        hasher.update(np.asarray(Nhxyz, dtype=np.int64).tobytes())
+        hasher.update(np.ascontiguousarray(tris_pre).tobytes())
+        return hasher.digest()
+
+    def load(self):
+        if not self.file.exists():
+            self.print(f'no cache at {self.file}')
+            return
+        with h5py.File(self.file, 'r') as h5f:
+            if h5f.attrs.get('version', -1) != VOX_CACHE_VERSION or h5f.attrs['NN'] != self.NN:
+                self.print('cache version or scheme mismatch, ignoring')
+                return
+            keys = h5f['keys'][...]
+            offsets = h5f['offsets'][...]
+            bn_ixyz_loc = h5f['bn_ixyz_loc'][...]
+            adj_bn = h5f['adj_bn'][...]
+            ndist_bn = h5f['ndist_bn'][...]
+            tidx_loc = h5f['tidx_loc'][...]
+
+        for i in range(keys.shape[0]):
+            s = slice(offsets[i], offsets[i+1])
+            self.entries[keys[i].tobytes()] = (bn_ixyz_loc[s], adj_bn[s], ndist_bn[s], tidx_loc[s])
+        self.print(f'loaded {len(self.entries)} voxels from {self.file}')
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.new_entries[key] = entry
+        return entry
+
+    def put(self, key, bn_ixyz_loc, adj_bn, ndist_bn, tidx_loc):
+        self.new_entries[key] = (bn_ixyz_loc, adj_bn, ndist_bn, tidx_loc)
+
+    def save(self):
+        # only keep what was used or computed in this run (stale voxels are dropped)
+        keys = list(self.new_entries.keys())
+        Nvox = len(keys)
+        counts = np.array([self.new_entries[key][0].size for key in keys], dtype=np.int64)
+        offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+
+        def _cat(i, shape, dtype):
+            if Nvox == 0:
+                return np.zeros(shape, dtype=dtype)
+            return np.concatenate([self.new_entries[key][i] for key in keys], axis=0).astype(dtype, copy=False)
+
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(self.file, 'w') as h5f:
+            h5f.attrs['version'] = VOX_CACHE_VERSION
+            h5f.attrs['NN'] = self.NN
+            h5f.create_dataset('keys', data=np.array([np.frombuffer(key, dtype=np.uint8) for key in keys], dtype=np.uint8).reshape(Nvox, 16))
+            h5f.create_dataset('offsets', data=offsets)
+            h5f.create_dataset('bn_ixyz_loc', data=_cat(0, (0,), np.int64))
+            h5f.create_dataset('adj_bn', data=_cat(1, (0, self.NN), bool))
+            h5f.create_dataset('ndist_bn', data=_cat(2, (0,), np.float64))
+            h5f.create_dataset('tidx_loc', data=_cat(3, (0,), np.int32))
+        self.print(f'saved {Nvox} voxels to {self.file}')
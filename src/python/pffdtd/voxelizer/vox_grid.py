@@ -7,31 +7,20 @@ VoxGrid class for voxelizer. Uses multiprocessing.
 Notes:
  - Performance will depend on geometry, grid spacing, voxel size and # processes
  - Simple *heuristic* default auto-tuning provided
- - Not designed for more than 10^6 voxels (initialisation becomes bottleneck)
+ - Voxels are stored as a table of arrays (no per-voxel objects), triangle lists in CSR format
  - Expected to run on a powerful CPU (+4 cores with SMT).
 """
 
 import numpy as np
 from numpy import array as npa
-from tqdm import tqdm
 
 from pffdtd.common.misc import get_default_nprocs
 from pffdtd.geometry.math import iceil
 from pffdtd.sim3d.room_geometry import RoomGeometry
 from pffdtd.voxelizer.cart_grid import CartGrid
-from pffdtd.voxelizer.vox_grid_base import VoxGridBase, VoxBase
+from pffdtd.voxelizer.vox_grid_base import VoxGridBase
 
 
-class Voxel(VoxBase):
-    # using cubic voxels for simplicity
-    def __init__(self, bmin, bmax, ixyz_start, Nhxyz, vox_idx):
-        super().__init__(bmin, bmax)  # this has tri_idxs member
-        # lower corner (of halo), greater than one
-        self.ixyz_start = ixyz_start
-        # size of voxel in grid-steps (not points), including halo
-        self.Nhxyz = Nhxyz
-        self.idx = vox_idx
-
 # inherits draw_boxes() and and fill()
 
 
@@ -86,64 +75,35 @@ class VoxGrid(VoxGridBase):
 
         Nvox = int(np.prod(Nvox_xyz))  # keep as int so we can use in ranges
 
-        vox_idx = 0
-        self.timer.tic('allocate voxels')
-        # allocate dummy voxels
-        self.voxels = [Voxel(npa([0, 0, 0]), npa([np.inf, np.inf, np.inf]), npa([0, 0, 0]), npa([0, 0, 0]), 0) for i in range(Nvox)]
-        self.print(self.timer.ftoc('allocate voxels'))
-
+        # voxel table (struct of arrays), with vox_idx = (vix*Nvy + viy)*Nvz + viz
         self.timer.tic('initialise voxels')
-        # Nh is step for voxels
-        Nvox_x, Nvox_y, Nvox_z = Nvox_xyz
-        # can vectorize most of this but not creating Voxel objects
-        vix = 0
-        Nvx, Nvy, Nvz = Nvox_xyz
-
-        pbar = tqdm(total=np.prod(Nvox_xyz), desc=f'vox grid init', ascii=True, leave=False, position=0)
-        for vix in range(Nvx):
-            ix_start = vix*Nh
-            if vix < Nvx-1:
-                ix_last = ix_start+Nh+1  # using matlab-style end (last)
-            else:
-                ix_last = Nx-1
-
-            for viy in range(Nvy):
-                iy_start = viy*Nh
-                if viy < Nvy-1:
-                    iy_last = iy_start+Nh+1
-                else:
-                    iy_last = Ny-1
-
-                for viz in range(Nvz):
-                    iz_start = viz*Nh
-                    if viz < Nvz-1:
-                        iz_last = iz_start+Nh+1
-                    else:
-                        iz_last = Nz-1
-
-                    # box for voxel is one more layer thick
-                    bmin = npa([xv[ix_start], yv[iy_start], zv[iz_start]])-0.5*h
-                    bmax = npa([xv[ix_last], yv[iy_last], zv[iz_last]])+0.5*h  # using matlab-style end
-                    ixyz_start = npa([ix_start, iy_start, iz_start])
-                    ixyz_last = npa([ix_last, iy_last, iz_last])  # matlab-style end
-
-                    vox = self.voxels[vox_idx]
-                    vox.bmin = bmin
-                    vox.bmax = bmax
-                    vox.ixyz_start = ixyz_start
-                    vox.Nhxyz = ixyz_last-ixyz_start+1
-                    vox.idx = vox_idx
-
-                    # start and end values of vox with one-layer still inbounds
-                    assert np.all(vox.Nhxyz >= Nh+2)  # min size
-                    assert np.all(vox.Nhxyz < 2*(Nh+2))  # max size
-                    vox_idx += 1
-                    pbar.update(1)
-                    # print(f'{vix=},{viy=},{viz=}')
-
-        pbar.close()
+        # Nh is step for voxels, voxels include one-layer halo
+        i_start_axis = []
+        i_last_axis = []
+        for Nv, N in zip(Nvox_xyz, Nxyz):
+            i_start = np.arange(Nv)*Nh
+            i_last = i_start+Nh+1  # using matlab-style end (last)
+            i_last[-1] = N-1
+            i_start_axis.append(i_start)
+            i_last_axis.append(i_last)
+
+        # box for voxel is one more layer thick
+        # voxel bounds along each axis (sorted, for binning triangles)
+        self.vox_axis_bmin = [v[i_start]-0.5*h for v, i_start in zip((xv, yv, zv), i_start_axis)]
+        self.vox_axis_bmax = [v[i_last]+0.5*h for v, i_last in zip((xv, yv, zv), i_last_axis)]
+
+        vixyz = [vi.ravel() for vi in np.meshgrid(*[np.arange(Nv) for Nv in Nvox_xyz], indexing='ij')]
+        self.vox_bmin = np.stack([self.vox_axis_bmin[d][vixyz[d]] for d in range(3)], axis=-1)
+        self.vox_bmax = np.stack([self.vox_axis_bmax[d][vixyz[d]] for d in range(3)], axis=-1)
+        # lower corner (of halo), greater than one
+        self.vox_ixyz_start = np.stack([i_start_axis[d][vixyz[d]] for d in range(3)], axis=-1)
+        # size of voxel in points, including halo
+        self.vox_Nhxyz = np.stack([i_last_axis[d][vixyz[d]] for d in range(3)], axis=-1) - self.vox_ixyz_start + 1
+
+        # start and end values of vox with one-layer still inbounds
+        assert np.all(self.vox_Nhxyz >= Nh+2)  # min size
+        assert np.all(self.vox_Nhxyz < 2*(Nh+2))  # max size
         self.print(self.timer.ftoc('initialise voxels'))
-        assert vox_idx == Nvox
 
         self.Nvox_xyz = Nvox_xyz
         self.Nvox = Nvox
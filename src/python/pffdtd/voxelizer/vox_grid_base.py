@@ -1,31 +1,21 @@
 # SPDX-License-Identifier: MIT
 # SPDX-FileCopyrightText: 2021 Brian Hamilton
 """Class for a voxel-grid for ray-tri / tri-box intersections. Uses multiprocessing
-"""
-import multiprocessing as mp
-from multiprocessing import shared_memory
+(results passed back through pipes, no temporary files)
 
+Triangles are binned to voxels by their bounding boxes (per-axis voxel bounds
+are sorted), so exact tri-box tests only run on candidate pairs.
+"""
 import numpy as np
 from tqdm import tqdm
 
-from pffdtd.common.misc import clear_dat_folder, get_default_nprocs
+from pffdtd.common.misc import get_default_nprocs
+from pffdtd.common.procs import run_task_queue, worker_utilisation
 from pffdtd.common.timerdict import TimerDict
 from pffdtd.geometry.box import Box
 from pffdtd.geometry.tri_box_intersection import tri_box_intersection_vec
 
 
-class VoxBase:
-    """Base class for a voxel
-    """
-
-    def __init__(self, bmin, bmax):
-        self.bmin = bmin
-        self.bmax = bmax
-        self.tri_idxs = []  # triangle indices as list
-        self.tris_pre = None
-        self.tris_mat = None
-
-
 class VoxGridBase:
     """Base class for a voxel grid
     """
@@ -51,8 +41,10 @@ class VoxGridBase:
         self.Npts = Npts
         self.Ntris = Ntris
 
-        self.voxels = []
-        self.nonempty_idx = []
+        # triangle lists for voxels (CSR): triangles of voxel i are tri_idxs[tri_offsets[i]:tri_offsets[i+1]]
+        self.tri_offsets = np.zeros((1,), dtype=np.int64)
+        self.tri_idxs = np.zeros((0,), dtype=np.int64)
+        self.nonempty_idx = np.zeros((0,), dtype=np.int64)
         self.timer = TimerDict()
         self.nprocs = get_default_nprocs()
 
@@ -75,108 +67,76 @@ class VoxGridBase:
         tri_bmax = tris_pre['bmax']
 
         if Nvox == 1:
-            vox = self.voxels[0]
-            vox.tri_idxs = np.arange(Ntris)
-            vox.tris_pre = self.tris_pre
-            vox.tris_mat = self.mats
-            self.nonempty_idx = [0]
+            self.tri_offsets = np.array([0, Ntris], dtype=np.int64)
+            self.tri_idxs = np.arange(Ntris, dtype=np.int64)
+            self.nonempty_idx = np.array([0], dtype=np.int64)
         else:
-            if Nprocs > 1:
-                clear_dat_folder('mmap_dat')
-
-            # create shared memory
-            Ntris_vox_shm = shared_memory.SharedMemory(create=True, size=Nvox*np.dtype(np.int64).itemsize)
-            Ntris_vox = np.ndarray((Nvox,), dtype=np.int64, buffer=Ntris_vox_shm.buf)
-            Ntris_vox[:] = 0
-
-            # use as buffer view to np array
-            N_tribox_tests_shm = shared_memory.SharedMemory(create=True, size=Nvox*np.dtype(np.int64).itemsize)
-            N_tribox_tests = np.ndarray((Nvox,), dtype=np.int64, buffer=N_tribox_tests_shm.buf)
-            N_tribox_tests[:] = 0
-
-            # looping through boxes makes more sense because we append to voxels (for multithreading)
-            def process_voxel(vox):
-                candidates = np.nonzero(np.all(np.logical_and(vox.bmax >= tri_bmin, vox.bmin <= tri_bmax), axis=-1))[0]
-                tri_idxs_vox = []
-                N_tribox_tests[vox.idx] += candidates.size
-                hits = tri_box_intersection_vec(vox.bmin, vox.bmax, tris_pre[candidates])
-                tri_idxs_vox = candidates[hits].tolist()
-                return tri_idxs_vox
-
-            def process_voxels(vidx_list, proc_idx):
-                pbar = tqdm(total=len(vidx_list), desc=f'process {proc_idx:02d} voxgrid processing', ascii=True, leave=False, position=0)
-                for vox_idx in vidx_list:
-                    tri_idxs_vox = process_voxel(self.voxels[vox_idx])
-                    Ntris_vox[vox_idx] = len(tri_idxs_vox)
-                    # if not empty, save vox data as file
-                    if len(tri_idxs_vox) > 0:
-                        np.array(tri_idxs_vox, dtype=np.int64).tofile(f'mmap_dat/vox_{vox_idx}.dat')
-                    pbar.update(1)
-
+            # triangle-to-voxel binning: voxel bounds are sorted along each axis, so the range of voxels
+            # overlapping a triangle's bounding box is found by binary search (same candidates as a bbox test)
+            self.timer.tic('binning')
+            Nvx, Nvy, Nvz = self.Nvox_xyz
+            vlo = np.zeros((Ntris, 3), dtype=np.int64)
+            vhi = np.zeros((Ntris, 3), dtype=np.int64)
+            for d in range(3):
+                vlo[:, d] = np.searchsorted(self.vox_axis_bmax[d], tri_bmin[:, d], side='left')
+                vhi[:, d] = np.searchsorted(self.vox_axis_bmin[d], tri_bmax[:, d], side='right')
+            Nv_tri = np.maximum(vhi-vlo, 0)
+            Ncand_tri = np.prod(Nv_tri, axis=-1)
+
+            # candidate (tri,vox) pairs, in order of triangles
+            pair_tri = np.repeat(np.arange(Ntris), Ncand_tri)
+            r = np.arange(pair_tri.size) - np.repeat(np.cumsum(Ncand_tri)-Ncand_tri, Ncand_tri)
+            Nvy_tri = Nv_tri[pair_tri, 1]
+            Nvz_tri = Nv_tri[pair_tri, 2]
+            vix = vlo[pair_tri, 0] + r//(Nvz_tri*Nvy_tri)
+            viy = vlo[pair_tri, 1] + (r//Nvz_tri) % Nvy_tri
+            viz = vlo[pair_tri, 2] + r % Nvz_tri
+            pair_vox = (vix*Nvy + viy)*Nvz + viz
+            pair_bmin = np.c_[self.vox_axis_bmin[0][vix], self.vox_axis_bmin[1][viy], self.vox_axis_bmin[2][viz]]
+            pair_bmax = np.c_[self.vox_axis_bmax[0][vix], self.vox_axis_bmax[1][viy], self.vox_axis_bmax[2][viz]]
+            del r, vix, viy, viz, Nvy_tri, Nvz_tri
+            N_tribox_tests = pair_tri.size
+            self.print(self.timer.ftoc('binning'))
+
+            # exact tri-box tests only on candidate pairs (in chunks to bound temporaries)
+            chunk_size = 2**16
+
+            def process_pairs(p_lo, p_hi, progress):
+                pbar = tqdm(total=p_hi-p_lo, desc='voxgrid processing', ascii=True, leave=False, position=0, disable=not progress)
+                hits = np.zeros((p_hi-p_lo,), dtype=bool)
+                for c_lo in range(p_lo, p_hi, chunk_size):
+                    c_hi = min(c_lo+chunk_size, p_hi)
+                    hits[c_lo-p_lo:c_hi-p_lo] = tri_box_intersection_vec(pair_bmin[c_lo:c_hi], pair_bmax[c_lo:c_hi], tris_pre[pair_tri[c_lo:c_hi]])
+                    pbar.update(c_hi-c_lo)
                 pbar.close()
+                return hits
 
             if Nprocs == 1:  # keep separate for debug purposes
-                # process without intermediate files
-                pbar = tqdm(total=Nvox, desc=f'single process voxgrid processing', ascii=True, leave=False)
-                for vox_idx in range(Nvox):
-                    vox = self.voxels[vox_idx]
-                    tri_idxs_vox = process_voxel(vox)
-                    Ntris_vox[vox_idx] = len(tri_idxs_vox)
-                    pbar.update(1)
-                    if Ntris_vox[vox_idx] > 0:
-                        vox.tri_idxs = tri_idxs_vox
-                        vox.tris_pre = self.tris_pre[vox.tri_idxs]
-                        vox.tris_mat = self.mats[vox.tri_idxs]
-                        assert Ntris_vox[vox_idx] == len(vox.tri_idxs)
-                        self.nonempty_idx.append(vox_idx)
-                pbar.close()
+                hits = process_pairs(0, N_tribox_tests, True)
 
             elif Nprocs > 1:
-                procs = []
-
-                vox_idx_lists = [[] for i in range(Nprocs)]
-                vox_order = np.random.permutation(Nvox)
-                # vox_order = np.arange(Nvox)
-                for idx in range(Nvox):
-                    cc = np.argmin([len(l) for l in vox_idx_lists])
-                    vox_idx_lists[cc].append(vox_order[idx])
-
-                for proc_idx in range(Nprocs):
-                    proc = mp.Process(target=process_voxels, args=(vox_idx_lists[proc_idx], proc_idx))
-                    procs.append(proc)
-
-                for proc_idx in range(Nprocs):
-                    procs[proc_idx].start()
-
-                for one_proc in procs:
-                    one_proc.join()
-
-                # now load from temp files
-                for vox_idx in range(Nvox):
-                    vox = self.voxels[vox_idx]
-                    if Ntris_vox[vox_idx] > 0:
-                        # now with one process read data from files
-                        vox.tri_idxs = np.fromfile(f'mmap_dat/vox_{vox_idx}.dat', dtype=np.int64)
-                        vox.tris_pre = self.tris_pre[vox.tri_idxs]
-                        vox.tris_mat = self.mats[vox.tri_idxs]
-                        assert Ntris_vox[vox_idx] == len(vox.tri_idxs)
-                        self.nonempty_idx.append(vox_idx)
-
-                clear_dat_folder('mmap_dat')
+                # workers pull chunks of pairs from a queue (about same cost per pair)
+                bounds = list(range(0, N_tribox_tests, chunk_size)) + [N_tribox_tests]
+                results, stats = run_task_queue(process_pairs, [(bounds[i], bounds[i+1], False) for i in range(len(bounds)-1)],
+                                                Nprocs, desc='voxgrid processing (chunks)')
+                for line in worker_utilisation(stats):
+                    self.print(line)
+                hits = np.concatenate(results) if len(results) > 0 else np.zeros((0,), dtype=bool)
+            del pair_bmin, pair_bmax
+
+            # counting sort of hits by voxel (stable, so triangles stay in ascending order within voxel)
+            pair_tri = pair_tri[hits]
+            pair_vox = pair_vox[hits]
+            Ntris_vox = np.bincount(pair_vox, minlength=Nvox)
+            self.tri_offsets = np.r_[0, np.cumsum(Ntris_vox)].astype(np.int64)
+            self.tri_idxs = pair_tri[np.argsort(pair_vox, kind='stable')].astype(np.int64)
+            self.nonempty_idx = np.flatnonzero(Ntris_vox > 0)
 
             self.print(self.timer.ftoc('voxgrid fill'))
 
             Ntris_vox_tot = np.sum(Ntris_vox)
 
-            N_tribox_tests_tot = np.sum(N_tribox_tests)
-            self.print(f'tribox checks={N_tribox_tests_tot} for {Ntris} tris and {Nvox} vox ({N_tribox_tests_tot/(Nvox*Ntris)*100.0:.2f} %)')
-
-            # cleanup shared memory
-            Ntris_vox_shm.close()
-            Ntris_vox_shm.unlink()
-
-            N_tribox_tests_shm.close()
-            N_tribox_tests_shm.unlink()
+            self.print(f'tribox checks={N_tribox_tests} for {Ntris} tris and {Nvox} vox ({N_tribox_tests/(Nvox*Ntris)*100.0:.2f} %)')
 
             self.print(f'tris redundant={Ntris_vox_tot}, {100.*Ntris_vox_tot/self.Ntris:.2f} %')
             self.print(f'avg tris per voxel={Ntris_vox_tot/Nvox:.2f}')
@@ -184,8 +144,12 @@ class VoxGridBase:
     def print(self, fstring):
         print(f'--VOX_GRID_BASE: {fstring}')
 
+    def vox_tri_idxs(self, vox_idx):
+        # triangle indices in voxel (view)
+        return self.tri_idxs[self.tri_offsets[vox_idx]:self.tri_offsets[vox_idx+1]]
+
     def print_stats(self):
-        ntris_found = np.sum([len(vox.tri_idxs) for vox in self.voxels])
+        ntris_found = self.tri_idxs.size
         self.print(f'total tris found in voxels={ntris_found:d}')
 
     # draws non-empty boxes only
@@ -197,9 +161,11 @@ class VoxGridBase:
         tp = 0
         # build up a triangular mesh for all boxes in one go
         for i in range(len(self.nonempty_idx)):
-            vox = self.voxels[self.nonempty_idx[i]]
-            assert len(vox.tri_idxs) > 0
-            box = Box(*(vox.bmax-vox.bmin), shift=vox.bmin, centered=False)
+            vox_idx = self.nonempty_idx[i]
+            assert self.vox_tri_idxs(vox_idx).size > 0
+            bmin = self.vox_bmin[vox_idx]
+            bmax = self.vox_bmax[vox_idx]
+            box = Box(*(bmax-bmin), shift=bmin, centered=False)
             boxtris[i*12:(i+1)*12, :] = box.tris + tp
             boxpts[i*8:(i+1)*8, :] = box.verts
             tp += 8
@@ -10,8 +10,9 @@ Tested up to ~10^10 points. Meant for single-node use (no MPI)
 Notes:
  - Performance will depend on geometry, grid spacing, voxel size and # processes
  - Simple *heuristic* default auto-tuning (Nvox_est) provided (manual choice usually better)
- - This temporarily uses disk space for multiprocessing, will warn if not enough space
- - In single precision or with FCC, Disk usage relative to simulation size goes up
+ - Workers pass results back through pipes (no temporary files per voxel)
+ - For very large grids, calc_adj_stream appends boundary-node data to vox_out.h5 as voxels finish (bounded memory)
+ - The full adjacency check only visits boundary nodes (in RAM, scales with number of boundary nodes)
 
 About voxelisation:
  - despite the use of term 'voxelizer' this is not necessarily a solid or surface voxelizer
@@ -30,23 +31,23 @@ import numpy as np
 from numpy import array as npa
 import numba as nb
 import h5py
-import psutil
 
-import multiprocessing as mp
-from multiprocessing import shared_memory
 from tqdm import tqdm
 
-from pffdtd.common.misc import get_default_nprocs, clear_dat_folder, yes_or_no
+from pffdtd.common.misc import get_default_nprocs
+from pffdtd.common.procs import cost_chunks, run_task_queue, worker_utilisation
 from pffdtd.common.timerdict import TimerDict
-from pffdtd.geometry.math import ind2sub3d, dotv
-from pffdtd.geometry.tri_ray_intersection import tri_ray_intersection_vec
+from pffdtd.geometry.math import ind2sub3d, normalise
+from pffdtd.geometry.tri_ray_intersection import nb_tri_ray_intersection
 from pffdtd.sim3d.room_geometry import RoomGeometry
 from pffdtd.voxelizer.cart_grid import CartGrid
+from pffdtd.voxelizer.scanline import scanline_bn
+from pffdtd.voxelizer.vox_cache import VoxCache
 from pffdtd.voxelizer.vox_grid import VoxGrid
 
 F_EPS = np.finfo(np.float64).eps
 R_EPS = 1e-6  # relative eps (to grid spacing) for near hits
-DAT_FOLDER = 'mmap_dat'  # change as needed
+STREAM_CHUNK_PTS = 2**24  # grid points per chunk of voxels when streaming output (bounds memory)
 
 
 class VoxScene:
@@ -74,6 +75,7 @@ class VoxScene:
         self.vvh = h * self.VV
         self.fcc = fcc
         self.nprocs = get_default_nprocs()
+        self.cache_hits = 0  # non-empty voxels reused from cache in last calc_adj
 
         self.timer = TimerDict()
 
@@ -81,11 +83,94 @@ class VoxScene:
         print(f'--VOX_SCENE: {fstring}')
 
     # @memory_profile
-    def calc_adj(self, Nprocs=None):
+    def calc_adj(self, Nprocs=None, cache_folder=None, method='voxel'):
+        # method: 'voxel' (ray-tri tests for points in voxels) or 'scanline' (per triangle, along grid lines it crosses)
+        # cache_folder: reuse per-voxel results of a previous run (only voxels whose triangles changed are re-processed)
         if Nprocs is None:
             Nprocs = self.nprocs
         self.print(f'using {Nprocs} processes')
 
+        self.timer.tic('calc_adj total')
+        self.cache_hits = 0
+        if method == 'voxel':
+            bn_ixyz, adj_bn, ndist_bn, tidx_bn = self._calc_bn_voxel(Nprocs, cache_folder)
+        elif method == 'scanline':
+            assert cache_folder is None  # cache is per voxel
+            bn_ixyz, adj_bn, ndist_bn, tidx_bn = self._calc_bn_scanline(Nprocs)
+        else:
+            raise ValueError(f'unknown voxelization method: {method}')
+
+        # materials (+sides) and surface area corrections (effective cell surface seen by walls)
+        self.print('materials (+sides) and surface area corrections...')
+        self.timer.tic('materials and surface area corrections')
+        mat_bn, saf_bn, mat_sums, counts = self._calc_materials(bn_ixyz, adj_bn, tidx_bn, Nprocs)
+        self.print(self.timer.ftoc('materials and surface area corrections'))
+        self._print_materials(mat_sums, counts)
+
+        # attach to class
+        self.bn_ixyz = bn_ixyz
+        self.adj_bn = adj_bn
+        self.mat_bn = mat_bn
+        self.saf_bn = saf_bn
+
+        self.print(self.timer.ftoc('calc_adj total'))
+
+    def _calc_materials(self, bn_ixyz, adj_bn, tidx_bn, Nprocs):
+        # one compiled pass over boundary nodes (in chunks, on workers if Nprocs>1), no Nb x 3 temporaries
+        Nbt = bn_ixyz.size
+        mat_bn = np.empty((Nbt,), dtype=np.int8)
+        saf_bn = np.empty((Nbt,), dtype=np.float64)  # this will be a number between 0 and NN
+
+        # bounded chunk size (workers return copies of their chunk)
+        bounds = np.linspace(0, Nbt, max(16*Nprocs, -(-Nbt//2**22))+1).astype(np.int64)
+        if Nprocs == 1:
+            results = [self._materials_chunk(bn_ixyz[i_lo:i_hi], adj_bn[i_lo:i_hi], tidx_bn[i_lo:i_hi], mat_bn[i_lo:i_hi], saf_bn[i_lo:i_hi])
+                       for i_lo, i_hi in zip(bounds[:-1], bounds[1:])]
+        else:
+            self._materials_chunk(bn_ixyz[:0], adj_bn[:0], tidx_bn[:0])  # compile once before forking
+            results, _ = run_task_queue(lambda i_lo, i_hi: self._materials_chunk(bn_ixyz[i_lo:i_hi], adj_bn[i_lo:i_hi], tidx_bn[i_lo:i_hi]),
+                                        list(zip(bounds[:-1], bounds[1:])), Nprocs)
+            for i_lo, i_hi, (mat_bn_chunk, saf_bn_chunk, *_) in zip(bounds[:-1], bounds[1:], results):
+                mat_bn[i_lo:i_hi] = mat_bn_chunk
+                saf_bn[i_lo:i_hi] = saf_bn_chunk
+
+        mat_sums = np.sum([r[2] for r in results], axis=0)
+        counts = np.sum([r[3] for r in results], axis=0)
+        return mat_bn, saf_bn, mat_sums, counts
+
+    def _materials_chunk(self, bn_ixyz, adj_bn, tidx_bn, mat_bn=None, saf_bn=None):
+        # materials and surface area factors for a chunk of boundary nodes (into new arrays if not given)
+        # also returns per-material surface areas (corrected, original) and counts from nb_bn_materials
+        cg = self.cart_grid
+        rg = self.room_geo
+        if mat_bn is None:
+            mat_bn = np.empty((bn_ixyz.size,), dtype=np.int8)
+            saf_bn = np.empty((bn_ixyz.size,), dtype=np.float64)
+        mat_sums = np.zeros((2, rg.Nmat+1), dtype=np.float64)  # -1, rigid goes to end
+        counts = nb_bn_materials(bn_ixyz, adj_bn, tidx_bn, cg.Nxyz[1], cg.Nxyz[2], cg.xv, cg.yv, cg.zv,
+                                 np.ascontiguousarray(rg.tris_pre['cent']), np.ascontiguousarray(rg.tris_pre['unor']),
+                                 rg.mat_ind, rg.mat_side, self.uvv, self.face_area, mat_bn, saf_bn, mat_sums)
+        return mat_bn, saf_bn, mat_sums, counts
+
+    def _print_materials(self, mat_sums, counts):
+        rg = self.room_geo
+        mat_approx_sa, mat_approx_sa_0 = mat_sums
+        Nbl, Nside0_mat, Nside0_nonrigid = counts
+        self.print(f'Npts = {self.cart_grid.Npts}, Nbl = {Nbl}')
+
+        if Nside0_mat > 0:
+            assert rg.mat_str[-1] == '_RIGID'
+            assert len(rg.mat_str) == rg.Nmat+1
+            assert Nside0_nonrigid == 0
+
+        # N.B: rg.mat_area takes into account two-sided
+        for i in range(rg.Nmat):
+            self.print(f'mat: {rg.mat_str[i]}, original: {(mat_approx_sa_0[i]/rg.mat_area[i]-1)*100.:.3f}% over, corrected: {(mat_approx_sa[i]/rg.mat_area[i]-1)*100:.3f}% over')
+
+    def _calc_bn_voxel(self, Nprocs, cache_folder, chunk_fn=None, on_chunk=None):
+        # ray-tri tests for all points in non-empty voxels, returns unified boundary-node arrays
+        # if on_chunk given: boundary-node arrays of bounded chunks of voxels go through chunk_fn (in worker)
+        # and its result to on_chunk (in parent) as chunks finish, nothing returned
         cg = self.cart_grid
         vg = self.vox_grid
         rg = self.room_geo
@@ -95,6 +180,7 @@ class VoxScene:
         VV = self.VV
         vvh = self.vvh  # vectors scaled by h (with length gf)
         uvv = self.uvv  # normalised
+        uvv_n = normalise(uvv)  # as in tri_ray_intersection_vec (to match hits exactly)
         ivv = np.int_(VV)  # integer grid steps
         face_area = self.face_area
         Nx, Ny, Nz = cg.Nxyz
@@ -112,40 +198,49 @@ class VoxScene:
 
         min_vox_shape = (Nh, Nh, Nh)  # for memory calculation
 
-        # set up shared memory
-        Nb_proc_shm = shared_memory.SharedMemory(create=True, size=Nprocs*np.dtype(np.int64).itemsize)
-        Nb_proc = np.ndarray((Nprocs,), dtype=np.int64, buffer=Nb_proc_shm.buf)
-        Nb_proc[:] = 0
-
         NN = self.NN
 
-        # will need this much for check_adj (less needed for vox data)
-        disk_space_needed = Nx*Ny*Nz*(1+self.fcc)
-        self.print(f'{disk_space_needed/2**30=:.3f} GiB')
-        disk_space_available = psutil.disk_usage('.').free
-        self.print(f'{disk_space_available/2**30=:.3f} GiB')
-        # proceed without asking unless more than 50% of free space
-        if disk_space_needed > 0.5*disk_space_available:
-            self.print('WARNING: -- disk space usage high')
-            if not yes_or_no('continue?'):
-                raise Exception('cancelled')
-
-        clear_dat_folder(DAT_FOLDER)
+        # look up voxels with unchanged triangles from previous run
+        cache = None
+        vox_keys = [None]*Nvox_nonempty
+        cached = {}
+        if cache_folder is not None:
+            self.timer.tic('cache lookup')
+            cache = VoxCache(cache_folder, NN)
+            cache.load()
+            for idx in range(Nvox_nonempty):
+                vox_idx = vg.nonempty_idx[idx]
+                vox_keys[idx] = VoxCache.key(h, cg.xyzmin, self.fcc, vg.vox_ixyz_start[vox_idx], vg.vox_Nhxyz[vox_idx],
+                                             rg.tris_pre[vg.vox_tri_idxs(vox_idx)])
+                entry = cache.get(vox_keys[idx])
+                if entry is not None:
+                    cached[idx] = entry
+            self.print(f'cache: reusing {len(cached)} of {Nvox_nonempty} non-empty voxels')
+            self.cache_hits = cache.hits
+            self.print(self.timer.ftoc('cache lookup'))
+        todo_idx = [idx for idx in range(Nvox_nonempty) if idx not in cached]
+        Nvox_todo = len(todo_idx)
+
+        # triangle data as contiguous arrays, indexed through voxel triangle lists (no per-voxel copies)
+        tris_data = [np.ascontiguousarray(rg.tris_pre[field]) for field in ('v', 'unor', 'cent', 'eab_unor', 'ebc_unor', 'eca_unor', 'bmin', 'bmax')]
 
         # this is main function called by mp
-        def process_voxel(idx, proc_idx):
+        def process_voxel(idx):
             vox_idx = vg.nonempty_idx[idx]
-            vox = vg.voxels[vox_idx]
 
             # voxel start indices (absolute) and including halos
-            ix_start, iy_start, iz_start = vox.ixyz_start
+            ix_start, iy_start, iz_start = vg.vox_ixyz_start[vox_idx]
             # these are widths of voxel, but number points is plus one
-            Nhx, Nhy, Nhz = vox.Nhxyz
-
-            vox_shape = (Nhx, Nhy, Nhz)  # in points
+            Nhx, Nhy, Nhz = vg.vox_Nhxyz[vox_idx]
 
-            # local indices for vox
-            ix_vox, iy_vox, iz_vox = np.mgrid[0:Nhx, 0:Nhy, 0:Nhz]
+            parity = (ix_start+iy_start+iz_start) % 2
+            if self.fcc:
+                # only even-parity (FCC subgrid) points stored, compact index iz//2 along z
+                vox_shape = (Nhx, Nhy, (Nhz+1)//2)
+                vox_iz = 2*np.arange(vox_shape[2]) + (parity + np.arange(Nhx)[:, None, None] + np.arange(Nhy)[None, :, None]) % 2
+            else:
+                vox_shape = (Nhx, Nhy, Nhz)  # in points
+                vox_iz = np.broadcast_to(np.arange(Nhz), vox_shape)
 
             vox_ndist = np.full(vox_shape, np.inf, dtype=np.float64)  # distance to nearest hit
             vox_bp = np.full(vox_shape, False, dtype=bool)  # boundary point?
@@ -153,87 +248,14 @@ class VoxScene:
             vox_nb = np.full(vox_shape, False, dtype=bool)  # near a boundary (nothing to do with numba)
             vox_tidx = np.full(vox_shape, -1, dtype=np.int32)  # tri index for nearest hit
 
-            # to store distances to tris
-            hit_dist = np.full(vox_shape, np.inf)
-
-            xyz_vox = np.c_[xv[ix_start+ix_vox.flat[:]],
-                            yv[iy_start+iy_vox.flat[:]],
-                            zv[iz_start+iz_vox.flat[:]]]
             in_mask = np.full(vox_shape, False)
-            in_mask[1:-1, 1:-1, 1:-1] = True,
-
-            if self.fcc:
-                fcc_mask = (np.mod(ix_start+ix_vox+iy_start+iy_vox+iz_start+iz_vox, 2) == 0)
-            else:
-                fcc_mask = np.full(vox_shape, True)
-
-            # loop through triangles in voxel
-            for tri_pre, tri_ind in zip(vox.tris_pre, vox.tri_idxs):
-                cent = tri_pre['cent']
-                unor = tri_pre['unor']
-                tbmin = tri_pre['bmin']
-                tbmax = tri_pre['bmax']
-                # first mask by bounding box
-                bb_mask = (np.all(xyz_vox >= tbmin - hf*(1+R_EPS), axis=-1)
-                           & np.all(xyz_vox <= tbmax + hf*(1+R_EPS), axis=-1)).reshape(vox_shape)
-
-                # bb_mask &= in_mask.flat[:] #inside halo
-
-                bb_mask &= fcc_mask
-                if ~np.any(bb_mask):
-                    continue
-
-                # then mask by distance to plane
-                dtp = np.full(vox_shape, np.inf, dtype=np.float64)
-                dtp.flat[bb_mask.flat[:]] = dotv(unor, cent-xyz_vox[bb_mask.flat[:]])
-                dist_mask1 = (np.abs(dtp) <= hf*(1+R_EPS))
-                if ~np.any(dist_mask1):
-                    continue
-
-                ray_mask = dist_mask1
-                tnb_mask = np.full(vox_shape, False)  # this is reset at triangle, accumulates across directions
-                for k in range(0, NN):
-                    ray_o = xyz_vox[ray_mask.flat[:]]-vvh[k]
-                    rd = uvv[k]
-
-                    ray_d = rd*np.ones(ray_o.shape)
+            in_mask[1:-1, 1:-1, :] = (vox_iz[1:-1, 1:-1, :] >= 1) & (vox_iz[1:-1, 1:-1, :] <= Nhz-2)
 
-                    # returns np.inf or dist>0 if hit
-                    hit_dist = np.full(vox_shape, np.inf)
-                    _, hit_dist.flat[ray_mask.flat[:]] = tri_ray_intersection_vec(ray_o, ray_d, npa([tri_pre]), d_eps=1.0e-3*h)
-
-                    assert np.all(hit_dist >= 0.0)
-                    hit_dist -= hf  # shift, doesn't affect np.inf entries
-                    hit_dist[hit_dist < -R_EPS*hf] = np.inf  # overwrite hits behind point
-
-                    tnb_mask |= (np.abs(hit_dist) <= R_EPS*hf)
-                    hit_dist[tnb_mask] = np.abs(hit_dist[tnb_mask])  # so ndist is positive
-                    vox_nb |= tnb_mask
-
-                    if ~np.any(hit_dist <= hf):
-                        continue
-                    hit_dist[hit_dist > (1+R_EPS)*hf] = np.inf  # zero those out so they don't interfere
-
-                    ii0 = np.flatnonzero(hit_dist <= (1+R_EPS)*hf)  # linear indices
-
-                    # mark non-adjencies (later use to detect boundary nodes)
-                    vox_adj.reshape(-1, NN)[ii0, k] = False
-                    vox_bp.flat[ii0] = True
-
-                    # indices where new nearest hit
-                    nh_mask = np.full(vox_shape, False)
-                    nh_mask.flat[ii0] = (hit_dist.flat[ii0] < vox_ndist.flat[ii0])
-                    vox_ndist[nh_mask] = hit_dist[nh_mask]  # update to abs for neg dist
-                    vox_tidx[nh_mask] = tri_ind
-
-                # NB can have fictitious boundary faces at edges
-                # leg on correct side but not overtop triangle... (since intersection not registered)
-                # ..same problem with jordan's theorem tests
-
-                # finally zero out nb points
-                vox_adj.reshape(-1, NN)[vox_nb.flat[:], :] = False
-
-                assert np.all(~vox_adj.reshape(-1, NN)[tnb_mask.flat[:], :])
+            # loop through triangles in voxel (tri index stored relative to voxel's list, mapped back in consolidation)
+            nb_vox_ray_tri(xv[ix_start:ix_start+Nhx], yv[iy_start:iy_start+Nhy], zv[iz_start:iz_start+Nhz],
+                           parity, self.fcc, vg.vox_tri_idxs(vox_idx), *tris_data,
+                           vvh, uvv_n, hf, 1.0e-3*h, 1.0e-6,
+                           vox_adj, vox_bp, vox_ndist, vox_tidx, vox_nb)
 
             vox_adj = vox_adj.reshape((-1, NN))
             assert np.all(~vox_adj[vox_nb.flat[:], :])
@@ -250,120 +272,88 @@ class VoxScene:
             assert qq.size == qq2.size
             # assert np.intersect1d(qq,qq2).size == qq2.size
             assert np.all(qq == qq2)
-            # tally boundary points inside vox without halo (add on to tally for process)
-            Nb_proc[proc_idx] += np.sum(vox_bp.flat[:])
-
             ndist_bn_vox = vox_ndist.flat[qq]
             tidx_bn_vox = vox_tidx.flat[qq]
             assert np.all(tidx_bn_vox >= -1)  # all marked
 
             adj_bn_vox = vox_adj[qq, :]
-            bn_ixyz_loc_vox = qq
-
-            # store vox info on disk (variable size, can't use shared mem), no compression for speed
-            h5f_vox = h5py.File(Path(DAT_FOLDER) / Path(f'vox_data_{vox.idx}.h5'), 'w')
-            h5f_vox.create_dataset('adj_bn', data=adj_bn_vox)
-            h5f_vox.create_dataset('tidx_bn', data=tidx_bn_vox)
-            h5f_vox.create_dataset('ndist_bn', data=ndist_bn_vox)
-            h5f_vox.create_dataset('bn_ixyz_loc', data=bn_ixyz_loc_vox)
-            h5f_vox.close()
-
-        def process_voxels(idx_list, proc_idx):
-            # using one progress bar because tqdm has problems with multiple, and cleaner
-            pbar = tqdm(total=len(idx_list), desc=f'process {proc_idx:02d} voxeliser processing', ascii=True, leave=False, position=0)
+            # linear index in voxel (all points), same order
+            bn_ixyz_loc_vox = (qq//vox_shape[2])*Nhz + vox_iz.flat[qq]
+
+            return bn_ixyz_loc_vox, adj_bn_vox, ndist_bn_vox, tidx_bn_vox
+
+        # per-chunk results are appended to growable buffers with an offset index, returned to parent (no temp files)
+        def process_voxels(idx_list, progress):
+            pbar = tqdm(total=len(idx_list), desc='voxeliser processing', ascii=True, leave=False, position=0, disable=not progress)
+            vox_data = []
             for idx in idx_list:
-                process_voxel(idx, proc_idx)
+                vox_data.append(process_voxel(idx))
                 pbar.update(1)
             pbar.close()
+            return vox_buffer(idx_list, vox_data, NN)
 
-        self.timer.tic('calc_adj total')
         self.timer.tic('ray-tri checks')
 
-        if Nprocs == 1:  # no need to use mp
-            process_voxels(range(Nvox_nonempty), 0)
-
-        else:  # multiproc with vox grid
-            procs = []
-            idx_lists = [[] for i in range(Nprocs)]
-            # only random shuffle for balancing
-            vox_order = np.random.permutation(Nvox_nonempty)
-            for qq in range(Nvox_nonempty):
-                cc = np.argmin([len(l) for l in idx_lists])
-                idx_lists[cc].append(vox_order[qq])
-
-            for proc_idx in range(Nprocs):
-                idx_list = idx_lists[proc_idx]
-                proc = mp.Process(target=process_voxels, args=(idx_list, proc_idx))
-                procs.append(proc)
-
-            for proc_idx in range(Nprocs):
-                procs[proc_idx].start()
-
-            for one_proc in procs:
-                one_proc.join()
+        if on_chunk is not None:
+            assert cache is None  # cache keeps all voxels in memory
+            self._stream_bn_voxel(Nprocs, todo_idx, process_voxels, chunk_fn, on_chunk)
+            self.print(self.timer.ftoc('ray-tri checks'))
+            return
+
+        if Nprocs == 1 or Nvox_todo == 0:  # no need to use mp
+            buffers = [process_voxels(todo_idx, True)]
+
+        else:  # multiproc with vox grid, workers pull chunks of voxels from a queue (largest estimated cost first)
+            todo_ids = vg.nonempty_idx[todo_idx]
+            vox_cost = np.diff(vg.tri_offsets)[todo_ids]*np.prod(vg.vox_Nhxyz[todo_ids], axis=-1)  # tris x points
+            chunks, chunk_costs = cost_chunks(vox_cost, 16*Nprocs)
+            process_voxel(todo_idx[0])  # compile kernels once before forking (otherwise every worker compiles)
+            buffers, stats = run_task_queue(process_voxels, [(np.asarray(todo_idx)[chunk], False) for chunk in chunks],
+                                            Nprocs, costs=chunk_costs, desc='voxeliser processing (chunks)')
+            for line in worker_utilisation(stats):
+                self.print(line)
 
         self.print(self.timer.ftoc('ray-tri checks'))
 
         self.timer.tic('consolidate')
 
+        if cache is not None:
+            for vox_idxs, vox_offsets, *vox_data in buffers:
+                for i, idx in enumerate(vox_idxs):
+                    s = slice(vox_offsets[i], vox_offsets[i+1])
+                    cache.put(vox_keys[idx], *[data[s] for data in vox_data])
+            if len(cached) > 0:
+                cached_idx = sorted(cached.keys())
+                buffers.append(vox_buffer(cached_idx, [cached[idx] for idx in cached_idx], NN))
+
+        # prefix sum over boundary points per voxel (in order of non-empty voxels) gives output offsets
+        Nb_vox = np.zeros((Nvox_nonempty,), dtype=np.int64)
+        for vox_idxs, vox_offsets, *_ in buffers:
+            Nb_vox[vox_idxs] = np.diff(vox_offsets)
+        bn_offsets = np.r_[0, np.cumsum(Nb_vox)]
+
         # total number of boundary points, to allocate unified arrays
-        Nbt = np.sum(Nb_proc)
+        Nbt = bn_offsets[-1]
         self.print(f'{Nbt=}')
 
-        # clean up shared memory
-        Nb_proc_shm.close()
-        Nb_proc_shm.unlink()
-
         # unified arrays
         bn_ixyz = np.full((Nbt,), -1, dtype=np.int64)
         adj_bn = np.full((Nbt, NN), True, dtype=bool)
         tidx_bn = np.full((Nbt,), -1, dtype=np.int32)
         ndist_bn = np.full((Nbt,), np.inf, dtype=np.float64)
 
-        # consolidate now with single process
-        pbar = tqdm(total=Nvox_nonempty, desc=f'process 0: consolidate', ascii=True, leave=False, position=0)
-        bb = 0  # boundary point counter
-        for idx in range(Nvox_nonempty):
-            vox_idx = vg.nonempty_idx[idx]
-            vox = vg.voxels[vox_idx]
-            Nhx, Nhy, Nhz = vox.Nhxyz
-            vox_shape = (Nhx, Nhy, Nhz)  # in points
-            ix_start, iy_start, iz_start = vox.ixyz_start
-
-            if len(vox.tri_idxs) == 0:
-                continue
-
-            # extract boundary points only
-            h5f_vox = h5py.File(Path(DAT_FOLDER) / Path(f'vox_data_{vox.idx}.h5'), 'r')
-            adj_bn_vox = h5f_vox['adj_bn'][...]
-            tidx_bn_vox = h5f_vox['tidx_bn'][...]
-            ndist_bn_vox = h5f_vox['ndist_bn'][...]
-            bn_ixyz_loc_vox = h5f_vox['bn_ixyz_loc'][...]
-            h5f_vox.close()
-
-            qq = bn_ixyz_loc_vox
-
-            bn_ix, bn_iy, bn_iz = ind2sub3d(qq, *vox_shape)
-
-            bn_ixyz_vox = (bn_iz+iz_start) \
-                + (bn_iy+iy_start)*Nz \
-                + (bn_ix+ix_start)*Ny*Nz
-
-            assert np.all(bn_ixyz_vox < Ngridpoints)
-            assert np.all(bn_ixyz_vox >= 0)
-
-            Nb_vox = bn_ixyz_vox.size
-            if Nb_vox > 0:
-                assert bb+Nb_vox <= Nbt
-                adj_bn[bb:bb+Nb_vox] = adj_bn_vox
-                tidx_bn[bb:bb+Nb_vox] = tidx_bn_vox
-                ndist_bn[bb:bb+Nb_vox] = ndist_bn_vox
-                bn_ixyz[bb:bb+Nb_vox] = bn_ixyz_vox
-            bb += Nb_vox
-            pbar.update(1)
-        assert bb == Nbt
+        # scatter each buffer into unified arrays
+        for vox_idxs, vox_offsets, bn_ixyz_loc_buf, adj_bn_buf, ndist_bn_buf, tidx_loc_buf in buffers:
+            vox_ids = vg.nonempty_idx[vox_idxs]
+            nb_scatter_bn(bn_offsets[vox_idxs], vox_offsets, vg.vox_ixyz_start[vox_ids], vg.vox_Nhxyz[vox_ids],
+                          vg.tri_offsets[vox_ids], vg.tri_idxs,
+                          bn_ixyz_loc_buf, adj_bn_buf, ndist_bn_buf, tidx_loc_buf, Ny, Nz,
+                          bn_ixyz, adj_bn, ndist_bn, tidx_bn)
+        del buffers
+
+        assert np.all(bn_ixyz < Ngridpoints)
+        assert np.all(bn_ixyz >= 0)
         self.print(self.timer.ftoc('consolidate'))
-        pbar.close()
 
         # merge
         self.timer.tic('merge')
@@ -372,59 +362,59 @@ class VoxScene:
 
         self.print(self.timer.ftoc('merge'))
 
-        clear_dat_folder(DAT_FOLDER)
-
-        # surface area corrections (effective cell surface seen by walls)
-        self.print('materials (+sides)...')
-        self.timer.tic('sides')
-        bn_ix, bn_iy, bn_iz = ind2sub3d(bn_ixyz, Nx, Ny, Nz)
-        xyz_bn = np.c_[xv[bn_ix], yv[bn_iy], zv[bn_iz]]
-        xyz_bn = np.c_[xv[bn_ix], yv[bn_iy], zv[bn_iz]]
-        dv = dotv(xyz_bn-rg.tris_pre['cent'][tidx_bn], rg.tris_pre['unor'][tidx_bn])
-
-        mat_bn = rg.mat_ind[tidx_bn]  # default choice
-        # unmark wrong sides of one-sided triangles
-        mat_bn[(dv > 0) & (rg.mat_side[tidx_bn] == 1)] = -1
-        mat_bn[(dv < 0) & (rg.mat_side[tidx_bn] == 2)] = -1
-        # anything 'near boundary' mark as rigid
-        mat_bn[np.all(~adj_bn, axis=-1)] = -1
-
-        self.print(f'Npts = {cg.Npts}, Nbl = {np.sum(mat_bn > -1)}')
-
-        if np.any(mat_bn[rg.mat_side[tidx_bn] == 0]):
-            assert rg.mat_str[-1] == '_RIGID'
-            assert len(rg.mat_str) == rg.Nmat+1
-            assert np.all(mat_bn[rg.mat_side[tidx_bn] == 0] == -1)
-        self.print(self.timer.ftoc('sides'))
-
-        self.print('surface area corrections...')
-        self.timer.tic('surface area corrections')
-
-        saf_bn_0 = np.sum(~adj_bn, axis=-1)  # this will be number of faces by default
-        saf_bn = np.zeros(bn_ixyz.size, dtype=np.float64)  # this will be a number between 0 and NN
-        for j in range(0, NN, 2):
-            saf = np.abs(dotv(uvv[j], rg.tris_pre['unor'][tidx_bn]))
-            saf_bn += (~adj_bn[:, j] + ~adj_bn[:, j+1])*saf
-
-        mat_approx_sa = np.zeros((rg.Nmat+1,), dtype=np.float64)
-        mat_approx_sa_0 = np.zeros((rg.Nmat+1,), dtype=np.float64)
+        if cache is not None:
+            cache.save()
 
-        # could parallel reduce (maybe with numba)
-        np.add.at(mat_approx_sa, mat_bn, face_area*saf_bn)  # -1, rigid goes to end
-        np.add.at(mat_approx_sa_0, mat_bn, face_area*saf_bn_0)  # -1, rigid goes to end
+        return bn_ixyz, adj_bn, ndist_bn, tidx_bn
 
-        self.print(self.timer.ftoc('surface area corrections'))
-        # N.B: rg.mat_area takes into account two-sided
-        for i in range(rg.Nmat):
-            self.print(f'mat: {rg.mat_str[i]}, original: {(mat_approx_sa_0[i]/rg.mat_area[i]-1)*100.:.3f}% over, corrected: {(mat_approx_sa[i]/rg.mat_area[i]-1)*100:.3f}% over')
-
-        # attach to class
-        self.bn_ixyz = bn_ixyz
-        self.adj_bn = adj_bn
-        self.mat_bn = mat_bn
-        self.saf_bn = saf_bn
-
-        self.print(self.timer.ftoc('calc_adj total'))
+    def _stream_bn_voxel(self, Nprocs, todo_idx, process_voxels, chunk_fn, on_chunk):
+        # chunks of voxels bounded by number of points (memory), largest estimated cost first on workers
+        cg = self.cart_grid
+        vg = self.vox_grid
+        NN = self.NN
+        Nx, Ny, Nz = cg.Nxyz
+        if len(todo_idx) == 0:
+            return
+
+        def process_chunk(idx_list):
+            vox_idxs, vox_offsets, *vox_data = process_voxels(idx_list, False)
+            # to grid indices and scene triangle indices (chunk-local unified arrays)
+            Nbc = vox_offsets[-1]
+            bn_ixyz = np.empty((Nbc,), dtype=np.int64)
+            adj_bn = np.empty((Nbc, NN), dtype=bool)
+            ndist_bn = np.empty((Nbc,), dtype=np.float64)
+            tidx_bn = np.empty((Nbc,), dtype=np.int32)
+            vox_ids = vg.nonempty_idx[vox_idxs]
+            nb_scatter_bn(vox_offsets[:-1], vox_offsets, vg.vox_ixyz_start[vox_ids], vg.vox_Nhxyz[vox_ids],
+                          vg.tri_offsets[vox_ids], vg.tri_idxs, *vox_data, Ny, Nz,
+                          bn_ixyz, adj_bn, ndist_bn, tidx_bn)
+            return chunk_fn(bn_ixyz, adj_bn, ndist_bn, tidx_bn)
+
+        todo_ids = vg.nonempty_idx[todo_idx]
+        vox_pts = np.prod(vg.vox_Nhxyz[todo_ids], axis=-1)
+        chunks, _ = cost_chunks(vox_pts, max(16*Nprocs, -(-np.sum(vox_pts)//STREAM_CHUNK_PTS)))
+        vox_cost = np.diff(vg.tri_offsets)[todo_ids]*vox_pts  # tris x points
+        chunk_costs = [np.sum(vox_cost[chunk]) for chunk in chunks]
+        args_list = [(np.asarray(todo_idx)[chunk],) for chunk in chunks]
+
+        if Nprocs == 1:
+            for args in tqdm(args_list, desc='voxeliser processing (chunks)', ascii=True, leave=False, position=0):
+                on_chunk(process_chunk(*args))
+        else:
+            process_chunk([todo_idx[0]])  # compile kernels once before forking (otherwise every worker compiles)
+            _, stats = run_task_queue(process_chunk, args_list, Nprocs, costs=chunk_costs,
+                                      desc='voxeliser processing (chunks)', on_result=lambda _, result: on_chunk(result))
+            for line in worker_utilisation(stats):
+                self.print(line)
+
+    def _calc_bn_scanline(self, Nprocs):
+        # ray-tri tests only for points next to where grid lines cross triangles, returns unified boundary-node arrays
+        self.timer.tic('ray-tri checks')
+        bn_ixyz, adj_bn, ndist_bn, tidx_bn = scanline_bn(self.room_geo.tris_pre, self.cart_grid, self.VV, self.vvh,
+                                                         normalise(self.uvv), self.hf, self.fcc, Nprocs)
+        self.print(self.timer.ftoc('ray-tri checks'))
+        self.print(f'Nbt={bn_ixyz.size}')
+        return bn_ixyz, adj_bn, ndist_bn, tidx_bn
 
     def save(self, save_folder, compress=None):
         # save to HDF5 data file
@@ -442,8 +432,6 @@ class VoxScene:
         xv = self.cart_grid.xv
         yv = self.cart_grid.yv
         zv = self.cart_grid.zv
-        h = self.cart_grid.h
-        Nx, Ny, Nz = self.cart_grid.Nxyz
 
         memory_saved = 0
         memory_saved += (bn_ixyz.size * bn_ixyz.itemsize)
@@ -465,13 +453,7 @@ class VoxScene:
         h5f.create_dataset('adj_bn', data=adj_bn, **kw)
         h5f.create_dataset('mat_bn', data=mat_bn, **kw)
         h5f.create_dataset('saf_bn', data=saf_bn, **kw)
-        h5f.create_dataset('xv', data=xv, **kw)  # also in cart_grid, but this one can get transformed
-        h5f.create_dataset('yv', data=yv, **kw)
-        h5f.create_dataset('zv', data=zv, **kw)
-        h5f.create_dataset('h', data=np.float64(h))  # giving types just to be clear
-        h5f.create_dataset('Nx', data=np.int64(Nx))
-        h5f.create_dataset('Ny', data=np.int64(Ny))
-        h5f.create_dataset('Nz', data=np.int64(Nz))
+        self._save_grid(h5f, kw)
         h5f.create_dataset('Nb', data=np.int64(bn_ixyz.size))
         h5f.close()
 
@@ -480,40 +462,124 @@ class VoxScene:
         # h5f.create_dataset('adj_bn', data=adj_bn.astype(np.int8), **kw)
         # h5f.close()
 
-    def check_adj_full(self):
-        # check full adjacency map (pre-req for stability)
-        # uses disk space (but bit compressed)
+    def _save_grid(self, h5f, kw):
         cg = self.cart_grid
         Nx, Ny, Nz = cg.Nxyz
-        bn_ixyz = self.bn_ixyz
-        adj_bn = self.adj_bn
-        mat_bn = self.mat_bn
-        Nb = bn_ixyz.size
+        h5f.create_dataset('xv', data=cg.xv, **kw)  # also in cart_grid, but this one can get transformed
+        h5f.create_dataset('yv', data=cg.yv, **kw)
+        h5f.create_dataset('zv', data=cg.zv, **kw)
+        h5f.create_dataset('h', data=np.float64(cg.h))  # giving types just to be clear
+        h5f.create_dataset('Nx', data=np.int64(Nx))
+        h5f.create_dataset('Ny', data=np.int64(Ny))
+        h5f.create_dataset('Nz', data=np.int64(Nz))
+
+    def calc_adj_stream(self, save_folder, Nprocs=None, compress=None):
+        # calc_adj (voxel method) and save, with boundary-node data appended to chunked datasets in vox_out.h5
+        # as chunks of voxels finish: memory bounded independent of number of boundary nodes (not kept in class)
+        # output not sorted (sort_sim_data does an external sort)
+        if Nprocs is None:
+            Nprocs = self.nprocs
+        save_folder = Path(save_folder)
+        self.print(f'using {Nprocs} processes, streaming to {save_folder=}')
+        if not save_folder.exists():
+            save_folder.mkdir(parents=True)
+        else:
+            assert save_folder.is_dir()
+        if compress is not None:
+            kw = {'compression': 'gzip', 'compression_opts': compress}
+        else:
+            kw = {}
+
+        self.timer.tic('calc_adj total')
+        h5f = h5py.File(save_folder / Path('vox_out.h5'), 'w')
+        self._save_grid(h5f, kw)
+        dsets = [h5f.create_dataset(name, shape=(0, *shape), maxshape=(None, *shape), chunks=(2**16, *shape), dtype=dtype, **kw)
+                 for name, shape, dtype in (('bn_ixyz', (), np.int64), ('adj_bn', (self.NN,), bool),
+                                            ('mat_bn', (), np.int8), ('saf_bn', (), np.float64))]
+        Nbt = 0
+        mat_sums = np.zeros((2, self.room_geo.Nmat+1), dtype=np.float64)
+        counts = np.zeros((3,), dtype=np.int64)
+
+        def chunk_fn(bn_ixyz, adj_bn, ndist_bn, tidx_bn):
+            return bn_ixyz, adj_bn, *self._materials_chunk(bn_ixyz, adj_bn, tidx_bn)
+
+        def on_chunk(result):
+            nonlocal Nbt
+            *bn_data, chunk_mat_sums, chunk_counts = result
+            Nbc = bn_data[0].size
+            for dset, data in zip(dsets, bn_data):
+                dset.resize(Nbt+Nbc, axis=0)
+                dset[Nbt:] = data
+            Nbt += Nbc
+            mat_sums[:] += chunk_mat_sums
+            counts[:] += chunk_counts
+
+        self._calc_bn_voxel(Nprocs, None, chunk_fn=chunk_fn, on_chunk=on_chunk)
+        h5f.create_dataset('Nb', data=np.int64(Nbt))
+        h5f.close()
+
+        self.print(f'{Nbt=}')
+        self._print_materials(mat_sums, counts)
+        self.print(self.timer.ftoc('calc_adj total'))
+
+    def check_adj_full(self, Nprocs=None):
+        # check reciprocity of adjacencies (pre-req for stability)
+        # points that aren't boundary nodes are adjacent to all neighbours, so only
+        # boundary nodes (and their neighbours) are checked, via lookups in sorted bn_ixyz
+        if Nprocs is None:
+            Nprocs = self.nprocs
+        Nb = self.bn_ixyz.size
 
         self.print('checking adj...')
         self.timer.tic('check_full')
 
-        self.print('mmap...')
-        # numba has no problem with memmap'd arrays
-        if self.fcc:
-            # FCC uses int16
-            adj_full = np.memmap(Path(DAT_FOLDER) / Path('adj_check.dat'), dtype='uint16', mode='w+', shape=(Nx, Ny, Nz))
-            self.print('filling full adj map (16-bit compressed)...')
-            adj_full[:] = ~np.uint16(0)
-            nb_fill_adj_fcc(bn_ixyz, adj_bn, adj_full)
-            self.print('check...')
-            nb_check_adj_full_fcc(adj_full, Nx, Ny, Nz)
+        if np.all(self.bn_ixyz[1:] > self.bn_ixyz[:-1]):
+            order = np.arange(Nb)  # usually already sorted
         else:
-            adj_full = np.memmap(Path(DAT_FOLDER) / Path('adj_check.dat'), dtype='uint8', mode='w+', shape=(Nx, Ny, Nz))
-            self.print('filling full adj map (8-bit compressed)...')
-            adj_full[:] = ~np.uint8(0)
-            nb_fill_adj(bn_ixyz, adj_bn, adj_full)
-            self.print('check...')
-            nb_check_adj_full(adj_full, Nx, Ny, Nz)
-
-        del adj_full  # release mmap
-        clear_dat_folder(DAT_FOLDER)
+            order = np.argsort(self.bn_ixyz, kind='stable')
+        bn_ixyz = self.bn_ixyz[order]
+        # bit-packed adjacencies (bit k for direction k)
+        adj_bits = nb_pack_adj_bits(self.adj_bn, order)
+        del order
+        self._check_adj_bits(bn_ixyz, adj_bits, Nprocs)
+
+    def check_adj_stream(self, save_folder, Nprocs=None, chunk_size=2**20):
+        # check_adj_full for output of calc_adj_stream (unsorted vox_out.h5), adjacencies read in chunks
+        # keeps sorted bn_ixyz and packed adjacencies in memory (10 bytes per boundary node)
+        if Nprocs is None:
+            Nprocs = self.nprocs
+        self.print('checking adj (streamed)...')
+        self.timer.tic('check_full')
+        with h5py.File(Path(save_folder) / Path('vox_out.h5'), 'r') as h5f:
+            bn_ixyz = h5f['bn_ixyz'][...]
+            Nb = bn_ixyz.size
+            adj_bits = np.empty((Nb,), dtype=np.uint16)
+            for i_lo in range(0, Nb, chunk_size):
+                adj_bn = h5f['adj_bn'][i_lo:i_lo+chunk_size]
+                adj_bits[i_lo:i_lo+adj_bn.shape[0]] = nb_pack_adj_bits(adj_bn, np.arange(adj_bn.shape[0]))
+        order = np.argsort(bn_ixyz, kind='stable')
+        self._check_adj_bits(bn_ixyz[order], adj_bits[order], Nprocs)
+
+    def _check_adj_bits(self, bn_ixyz, adj_bits, Nprocs):
+        # reciprocity check on sorted boundary nodes, in chunks on Nprocs processes
+        Nx, Ny, Nz = self.cart_grid.Nxyz
+        Nb = bn_ixyz.size
+        # linear index steps of neighbours
+        ioff = np.int_(self.VV) @ np.array([Ny*Nz, Nz, 1], dtype=np.int64)
+
+        if Nprocs == 1 or Nb == 0:
+            Nfail, ifail = nb_check_adj_bn(bn_ixyz, adj_bits, ioff, 0, Nb)
+        else:
+            nb_check_adj_bn(bn_ixyz, adj_bits, ioff, 0, 0)  # compile once before forking
+            bounds = np.linspace(0, Nb, min(16*Nprocs, Nb)+1).astype(np.int64)
+            results, stats = run_task_queue(nb_check_adj_bn,
+                                            [(bn_ixyz, adj_bits, ioff, i_lo, i_hi) for i_lo, i_hi in zip(bounds[:-1], bounds[1:])],
+                                            Nprocs)
+            Nfail = sum(r[0] for r in results)
+            ifail = min((r[1] for r in results if r[0] > 0), default=-1)
+
         self.print(self.timer.ftoc('check_full'))
+        assert Nfail == 0, f'{Nfail} non-reciprocal adjacencies, first at point {bn_ixyz[ifail]}'
 
     def draw(self, backend='mayavi'):
         # better to use use polyscope for large grids
@@ -592,66 +658,246 @@ class VoxScene:
 
         self.print('drawn')
 
-# numba funcs
-# these are in fact faster in serial as written and current numba version
-# possible to improve with option to choose scheduling types (maybe a feature in future numba versions)
 
+def vox_buffer(idx_list, vox_data, NN):
+    # concatenate per-voxel (bn_ixyz_loc, adj_bn, ndist_bn, tidx_loc) into one buffer with offset index
+    vox_idxs = np.asarray(idx_list, dtype=np.int64)
+    vox_offsets = np.r_[0, np.cumsum([data[0].size for data in vox_data])].astype(np.int64)
+    if len(vox_data) == 0:
+        return vox_idxs, vox_offsets, np.zeros((0,), np.int64), np.zeros((0, NN), bool), np.zeros((0,), np.float64), np.zeros((0,), np.int32)
+    bn_ixyz_loc = np.concatenate([data[0] for data in vox_data]).astype(np.int64, copy=False)
+    adj_bn = np.concatenate([data[1] for data in vox_data], axis=0)
+    ndist_bn = np.concatenate([data[2] for data in vox_data])
+    tidx_loc = np.concatenate([data[3] for data in vox_data]).astype(np.int32, copy=False)
+    return vox_idxs, vox_offsets, bn_ixyz_loc, adj_bn, ndist_bn, tidx_loc
+
+
+# serial: called per voxel inside worker processes (already parallel over voxels)
+@nb.jit(nopython=True, parallel=False)
+def nb_vox_ray_tri(xv_vox, yv_vox, zv_vox, parity, fcc, tri_idxs,
+                   tris_v, tris_unor, tris_cent, tris_eab_unor, tris_ebc_unor, tris_eca_unor, tris_bmin, tris_bmax,
+                   vvh, uvv, hf, d_eps, cp_eps,
+                   vox_adj, vox_bp, vox_ndist, vox_tidx, vox_nb):
+    # ray-triangle tests for one voxel: loop over (triangle, direction, candidate point), updating voxel arrays in place
+    # voxel arrays indexed [ix, iy, iz//zstep]: for FCC only even-parity points are stored (zstep=2)
+    Nhx, Nhy, Nhz = xv_vox.size, yv_vox.size, zv_vox.size
+    Nhzc = vox_bp.shape[2]
+    zstep = 2 if fcc else 1
+    NN = vvh.shape[0]
+    Ntris = tri_idxs.size
+    bb_eps = hf*(1+R_EPS)
+    nb_eps = R_EPS*hf
+    hit_eps = (1+R_EPS)*hf
+
+    # candidate points for current triangle (linear index) and their hit distances for current direction
+    cand = np.empty((Nhx*Nhy*Nhzc,), dtype=np.int64)
+    tnb = np.empty((Nhx*Nhy*Nhzc,), dtype=np.bool_)
+    hit_dist = np.empty((Nhx*Nhy*Nhzc,), dtype=np.float64)
+
+    for tri_ind in range(Ntris):
+        tri = tri_idxs[tri_ind]  # index into scene triangles (tri_ind is local to voxel)
+        ux, uy, uz = tris_unor[tri, 0], tris_unor[tri, 1], tris_unor[tri, 2]
+        cx, cy, cz = tris_cent[tri, 0], tris_cent[tri, 1], tris_cent[tri, 2]
+
+        # first mask by bounding box (only fcc subgrid points visited), then by distance to plane
+        Ncand = 0
+        for ix in range(Nhx):
+            x = xv_vox[ix]
+            if x < tris_bmin[tri, 0] - bb_eps or x > tris_bmax[tri, 0] + bb_eps:
+                continue
+            for iy in range(Nhy):
+                y = yv_vox[iy]
+                if y < tris_bmin[tri, 1] - bb_eps or y > tris_bmax[tri, 1] + bb_eps:
+                    continue
+                iz0 = (parity+ix+iy) % 2 if fcc else 0
+                for iz in range(iz0, Nhz, zstep):
+                    z = zv_vox[iz]
+                    if z < tris_bmin[tri, 2] - bb_eps or z > tris_bmax[tri, 2] + bb_eps:
+                        continue
+                    dtp = ux*(cx-x) + uy*(cy-y) + uz*(cz-z)
+                    if np.abs(dtp) > bb_eps:
+                        continue
+                    cand[Ncand] = (ix*Nhy + iy)*Nhzc + iz//zstep
+                    tnb[Ncand] = False  # reset at triangle, accumulates across directions
+                    Ncand += 1
+        if Ncand == 0:
+            continue
+
+        tri_v = tris_v[tri]
+        tri_unor = tris_unor[tri]
+        tri_cent = tris_cent[tri]
+        tri_eab_unor = tris_eab_unor[tri]
+        tri_ebc_unor = tris_ebc_unor[tri]
+        tri_eca_unor = tris_eca_unor[tri]
+
+        for k in range(NN):
+            any_hit = False
+            for i in range(Ncand):
+                q = cand[i]
+                iy = (q//Nhzc) % Nhy
+                ix = q//(Nhzc*Nhy)
+                iz = zstep*(q % Nhzc) + ((parity+ix+iy) % 2 if fcc else 0)
+                t = nb_tri_ray_intersection(xv_vox[ix]-vvh[k, 0], yv_vox[iy]-vvh[k, 1], zv_vox[iz]-vvh[k, 2],
+                                            uvv[k, 0], uvv[k, 1], uvv[k, 2], tri_v, tri_unor, tri_cent,
+                                            tri_eab_unor, tri_ebc_unor, tri_eca_unor, d_eps, cp_eps)
+                hd = t - hf  # shift, doesn't affect np.inf entries
+                if hd < -nb_eps:
+                    hd = np.inf  # hits behind point
+                if np.abs(hd) <= nb_eps:
+                    tnb[i] = True
+                if tnb[i]:
+                    hd = np.abs(hd)  # so ndist is positive
+                    vox_nb.flat[q] = True
+                if hd <= hf:
+                    any_hit = True
+                hit_dist[i] = hd
+
+            if not any_hit:
+                continue
 
+            for i in range(Ncand):
+                hd = hit_dist[i]
+                if hd <= hit_eps:
+                    q = cand[i]
+                    # mark non-adjencies (later use to detect boundary nodes)
+                    vox_adj.reshape((-1, NN))[q, k] = False
+                    vox_bp.flat[q] = True
+                    # new nearest hit
+                    if hd < vox_ndist.flat[q]:
+                        vox_ndist.flat[q] = hd
+                        vox_tidx.flat[q] = tri_ind
+
+    # NB can have fictitious boundary faces at edges
+    # leg on correct side but not overtop triangle... (since intersection not registered)
+    # ..same problem with jordan's theorem tests
+
+    # finally zero out nb points
+    adj = vox_adj.reshape((-1, NN))
+    for q in range(Nhx*Nhy*Nhzc):
+        if vox_nb.flat[q]:
+            for k in range(NN):
+                adj[q, k] = False
+
+
+# serial: runs in parent between forks of worker processes (TBB threading layer is not fork-safe), memory-bound anyway
 @nb.jit(nopython=True, parallel=False)
-def nb_fill_adj(bn_ixyz, adj_bn, adj_full):
-    for i in nb.prange(bn_ixyz.size):
-        bitmask = np.uint8(0)
-        for jj in np.arange(6):
-            bitmask |= (adj_bn[i, jj] << jj)
-        adj_full.flat[bn_ixyz[i]] = bitmask
-        # print(f'{bitmask=}, {adj_bn[i]=}')
+def nb_scatter_bn(dst_offsets, src_offsets, vox_ixyz_start, vox_Nhxyz, vox_tri_start, tri_idxs,
+                  bn_ixyz_loc, adj_bn_src, ndist_bn_src, tidx_loc, Ny, Nz,
+                  bn_ixyz, adj_bn, ndist_bn, tidx_bn):
+    # voxel-local to global linear indices and triangle indices, written at prefix-sum offsets
+    for v in range(dst_offsets.size):
+        ix0, iy0, iz0 = vox_ixyz_start[v, 0], vox_ixyz_start[v, 1], vox_ixyz_start[v, 2]
+        Nhy, Nhz = vox_Nhxyz[v, 1], vox_Nhxyz[v, 2]
+        tri_start = vox_tri_start[v]
+        for i in range(src_offsets[v+1]-src_offsets[v]):
+            j = src_offsets[v]+i
+            k = dst_offsets[v]+i
+            q = bn_ixyz_loc[j]
+            iz = q % Nhz
+            iy = (q//Nhz) % Nhy
+            ix = q//(Nhz*Nhy)
+            bn_ixyz[k] = (iz+iz0) + (iy+iy0)*Nz + (ix+ix0)*Ny*Nz
+            for jj in range(adj_bn.shape[1]):
+                adj_bn[k, jj] = adj_bn_src[j, jj]
+            ndist_bn[k] = ndist_bn_src[j]
+            if tidx_loc[j] > -1:
+                tidx_bn[k] = tri_idxs[tri_start+tidx_loc[j]]
+            else:
+                tidx_bn[k] = -1
 
 
 @nb.jit(nopython=True, parallel=False)
-def nb_fill_adj_fcc(bn_ixyz, adj_bn, adj_full):
-    for i in nb.prange(bn_ixyz.size):
-        bitmask = np.uint16(0)
-        for jj in np.arange(12):
-            bitmask |= (adj_bn[i, jj] << jj)
-        adj_full.flat[bn_ixyz[i]] = bitmask
-        # print(f'{bitmask=}, {adj_bn[i]=}')
+def nb_bn_materials(bn_ixyz, adj_bn, tidx_bn, Ny, Nz, xv, yv, zv,
+                    tris_cent, tris_unor, tris_mat_ind, tris_mat_side, uvv, face_area,
+                    mat_bn, saf_bn, mat_sums):
+    # per boundary node: material (side of nearest triangle), surface area factor, and approximate
+    # surface area per material (accumulated in mat_sums, rigid (-1) at end)
+    # returns counts of (non-rigid nodes, side-0 nodes with material != 0, side-0 nodes not rigid)
+    NN = adj_bn.shape[1]
+    Nmat = mat_sums.shape[1]-1
+    Nbl = 0
+    Nside0_mat = 0
+    Nside0_nonrigid = 0
+    for i in range(bn_ixyz.size):
+        ii = bn_ixyz[i]
+        iz = ii % Nz
+        iy = (ii - iz)//Nz % Ny
+        ix = ((ii - iz)//Nz-iy)//Ny
+        t = tidx_bn[i]
+        unor = tris_unor[t]
+        cent = tris_cent[t]
+        dv = (xv[ix]-cent[0])*unor[0] + (yv[iy]-cent[1])*unor[1] + (zv[iz]-cent[2])*unor[2]
+
+        mat = tris_mat_ind[t]  # default choice
+        side = tris_mat_side[t]
+        # unmark wrong sides of one-sided triangles
+        if (dv > 0 and side == 1) or (dv < 0 and side == 2):
+            mat = -1
+        # anything 'near boundary' mark as rigid
+        Nfaces = 0
+        for k in range(NN):
+            if not adj_bn[i, k]:
+                Nfaces += 1
+        if Nfaces == NN:
+            mat = -1
+        mat_bn[i] = mat
+
+        if mat > -1:
+            Nbl += 1
+        if side == 0:
+            if mat != 0:
+                Nside0_mat += 1
+            if mat != -1:
+                Nside0_nonrigid += 1
+
+        saf = 0.0
+        for k in range(0, NN, 2):
+            if not (adj_bn[i, k] and adj_bn[i, k+1]):
+                saf += np.abs(uvv[k, 0]*unor[0] + uvv[k, 1]*unor[1] + uvv[k, 2]*unor[2])
+        saf_bn[i] = saf
+
+        im = Nmat if mat == -1 else mat
+        mat_sums[0, im] += face_area*saf
+        mat_sums[1, im] += face_area*Nfaces  # this will be number of faces by default
+    return np.array([Nbl, Nside0_mat, Nside0_nonrigid])
 
 
 @nb.jit(nopython=True, parallel=False)
-def nb_check_adj_full(adj, Nx, Ny, Nz):
-    assert adj.shape == (Nx, Ny, Nz)
-    for ix in nb.prange(1, Nx-1):
-        for iy in np.arange(1, Ny-1):
-            for iz in np.arange(1, Nz-1):
-                assert ~(((adj[ix, iy, iz] >> 0) & 1) ^ ((adj[ix+1, iy, iz] >> 1) & 1))
-                assert ~(((adj[ix, iy, iz] >> 1) & 1) ^ ((adj[ix-1, iy, iz] >> 0) & 1))
-                assert ~(((adj[ix, iy, iz] >> 2) & 1) ^ ((adj[ix, iy+1, iz] >> 3) & 1))
-                assert ~(((adj[ix, iy, iz] >> 3) & 1) ^ ((adj[ix, iy-1, iz] >> 2) & 1))
-                assert ~(((adj[ix, iy, iz] >> 4) & 1) ^ ((adj[ix, iy, iz+1] >> 5) & 1))
-                assert ~(((adj[ix, iy, iz] >> 5) & 1) ^ ((adj[ix, iy, iz-1] >> 4) & 1))
+def nb_pack_adj_bits(adj_bn, order):
+    adj_bits = np.zeros((order.size,), np.uint16)
+    for i in range(order.size):
+        bitmask = np.uint16(0)
+        for k in range(adj_bn.shape[1]):
+            bitmask |= np.uint16(adj_bn[order[i], k]) << k
+        adj_bits[i] = bitmask
+    return adj_bits
 
 
+# serial: called per chunk of boundary nodes (inside worker processes if Nprocs>1)
 @nb.jit(nopython=True, parallel=False)
-def nb_check_adj_full_fcc(adj, Nx, Ny, Nz):
-    assert adj.shape == (Nx, Ny, Nz)
-    for ix in nb.prange(1, Nx-1):
-        for iy in np.arange(1, Ny-1):
-            # for iz in np.arange(1,Nz-1):
-            # if np.mod(ix+iy+iz,2)==1:
-            # continue
-            for iz in np.arange(2-(ix+iy) % 2, Nz-1):
-                assert ~(((adj[ix, iy, iz] >> 0) & 1) ^ ((adj[ix+1, iy+1, iz] >> 1) & 1))
-                assert ~(((adj[ix, iy, iz] >> 1) & 1) ^ ((adj[ix-1, iy-1, iz] >> 0) & 1))
-                assert ~(((adj[ix, iy, iz] >> 2) & 1) ^ ((adj[ix, iy+1, iz+1] >> 3) & 1))
-                assert ~(((adj[ix, iy, iz] >> 3) & 1) ^ ((adj[ix, iy+1, iz+1] >> 2) & 1))
-                assert ~(((adj[ix, iy, iz] >> 4) & 1) ^ ((adj[ix+1, iy, iz+1] >> 5) & 1))
-                assert ~(((adj[ix, iy, iz] >> 5) & 1) ^ ((adj[ix-1, iy, iz-1] >> 4) & 1))
-                assert ~(((adj[ix, iy, iz] >> 6) & 1) ^ ((adj[ix+1, iy-1, iz] >> 7) & 1))
-                assert ~(((adj[ix, iy, iz] >> 7) & 1) ^ ((adj[ix-1, iy+1, iz] >> 6) & 1))
-                assert ~(((adj[ix, iy, iz] >> 8) & 1) ^ ((adj[ix, iy+1, iz-1] >> 9) & 1))
-                assert ~(((adj[ix, iy, iz] >> 9) & 1) ^ ((adj[ix, iy-1, iz+1] >> 8) & 1))
-                assert ~(((adj[ix, iy, iz] >> 10) & 1) ^ ((adj[ix+1, iy, iz-1] >> 11) & 1))
-                assert ~(((adj[ix, iy, iz] >> 11) & 1) ^ ((adj[ix-1, iy, iz+1] >> 10) & 1))
+def nb_check_adj_bn(bn_ixyz, adj_bits, ioff, i_lo, i_hi):
+    # count boundary nodes in [i_lo,i_hi) whose adjacency in some direction k differs from the
+    # neighbour's in the opposite direction (k^1); neighbours not in bn_ixyz are adjacent in all directions
+    # bn_ixyz sorted, so neighbour indices are too: one merge pass per direction
+    Nb = bn_ixyz.size
+    Nfail = 0
+    ifail = -1
+    if i_lo >= i_hi:
+        return Nfail, ifail
+    for k in range(ioff.size):
+        j = np.searchsorted(bn_ixyz, bn_ixyz[i_lo]+ioff[k])
+        for i in range(i_lo, i_hi):
+            q = bn_ixyz[i] + ioff[k]
+            while j < Nb and bn_ixyz[j] < q:
+                j += 1
+            adj_q = 1
+            if j < Nb and bn_ixyz[j] == q:
+                adj_q = (adj_bits[j] >> (k ^ 1)) & 1
+            if ((adj_bits[i] >> k) & 1) != adj_q:
+                Nfail += 1
+                if ifail < 0 or i < ifail:
+                    ifail = i
+    return Nfail, ifail
 
 
 def main():
@@ -669,6 +915,9 @@ def main():
     parser.add_argument('--area_eps', type=float, help='for pruning degenerate triangels')
     parser.add_argument('--check_full', action='store_true', help='check whole adj')
     parser.add_argument('--save_folder', type=str, help='where to save')
+    parser.add_argument('--cache_folder', type=str, help='reuse per-voxel results from previous run')
+    parser.add_argument('--method', type=str, choices=['voxel', 'scanline'], help='voxelization method')
+    parser.add_argument('--stream', action='store_true', help='write to save_folder as voxels finish (bounded memory)')
     parser.add_argument('--az_el', nargs=2, type=float, help='two angles in deg')
     parser.add_argument('--polyscope', action='store_true', help='use polyscope backend')
     parser.set_defaults(draw=False)
@@ -685,6 +934,9 @@ def main():
     parser.set_defaults(json=None)
     parser.set_defaults(check_full=False)
     parser.set_defaults(save_folder=None)
+    parser.set_defaults(cache_folder=None)
+    parser.set_defaults(method='voxel')
+    parser.set_defaults(stream=False)
     args = parser.parse_args()
     print(args)
     assert args.Nprocs > 0
@@ -709,13 +961,19 @@ def main():
     vox_grid.print_stats()
 
     vox_scene = VoxScene(room_geo, cart_grid, vox_grid, fcc=args.fcc)
-    vox_scene.calc_adj(Nprocs=args.Nprocs)
+    if args.stream:
+        # nothing kept in memory to check or draw
+        assert args.save_folder is not None and args.method == 'voxel' and args.cache_folder is None
+        assert not (args.check_full or args.draw)
+        vox_scene.calc_adj_stream(args.save_folder, Nprocs=args.Nprocs)
+    else:
+        vox_scene.calc_adj(Nprocs=args.Nprocs, cache_folder=args.cache_folder, method=args.method)
 
-    if args.check_full:
-        vox_scene.check_adj_full()
+        if args.check_full:
+            vox_scene.check_adj_full(Nprocs=args.Nprocs)
 
-    if args.save_folder:
-        vox_scene.save(args.save_folder)
+        if args.save_folder:
+            vox_scene.save(args.save_folder)
 
     if args.draw:
         room_geo.draw(wireframe=False, backend=draw_backend)
@@ -0,0 +1,11 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def material_cache(tmp_path, monkeypatch):
+    # material fits are cached per test, never in ~/.cache
+    monkeypatch.setenv('PFFDTD_MATERIAL_CACHE', str(tmp_path/'material_cache'))
+    return tmp_path/'material_cache'
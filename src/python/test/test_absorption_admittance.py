@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import numpy as np
+import scipy.optimize as scpo
+
+from pffdtd.absorption.admittance import (
+    _nabs_from_Yn,
+    _oct_11_basis,
+    convert_Sabs_to_Yn,
+    fit_Sabs_oct_11,
+    fit_to_Sabs_oct_11,
+    fit_to_Sabs_oct_11_batch,
+    read_mat_DEF,
+)
+from pffdtd.absorption.porous import porous_absorber
+
+MATERIALS = np.array([
+    porous_absorber(0.1, 8000.0, frequency=1000*(2.0**np.arange(-6, 5)), offset_zeros=True),
+    [0.01, 0.01, 0.01, 0.05, 0.06, 0.07, 0.09, 0.08, 0.08, 0.08, 0.08],
+    [0.15, 0.30, 0.27, 0.18, 0.06, 0.04, 0.03, 0.02, 0.02, 0.02, 0.01],
+    [0.10, 0.11, 0.13, 0.15, 0.11, 0.10, 0.07, 0.06, 0.07, 0.07, 0.07],
+])
+
+
+def test_convert_Sabs_to_Yn_vectorised():
+    Sabs = np.array([0.0, 0.01, 0.3, 0.9])
+    Yn = convert_Sabs_to_Yn(Sabs)
+    assert Yn.shape == Sabs.shape
+    for i in range(Sabs.size):
+        assert convert_Sabs_to_Yn(Sabs[i]) == Yn[i]
+
+
+def test_fit_Sabs_oct_11():
+    fv, band, _, _, Yb = _oct_11_basis()
+    abs_target = _nabs_from_Yn(convert_Sabs_to_Yn(MATERIALS)[:, band])
+
+    def cost_function(ym, i):
+        return np.sum(np.abs(_nabs_from_Yn(ym @ Yb.T)-abs_target[i]), axis=-1)
+
+    DEF = fit_Sabs_oct_11(MATERIALS)
+    assert DEF.shape == (len(MATERIALS), 11, 3)
+    assert np.all(DEF > 0)
+    assert np.array_equal(fit_Sabs_oct_11(MATERIALS[1]), DEF[1])
+
+    # same cost as the previous per-material Nelder-Mead fit (or lower), fitted absorption close
+    for i, Sabs in enumerate(MATERIALS):
+        x0 = convert_Sabs_to_Yn(Sabs)
+        res = scpo.minimize(lambda x: np.inf if np.any(x < 0) else cost_function(x, i), x0, method='Nelder-Mead')
+        ym = 1.0/DEF[i, :, 1]
+        assert cost_function(ym, i) <= 1.01*res.fun
+        assert np.max(np.abs(_nabs_from_Yn(ym @ Yb.T)-_nabs_from_Yn(res.x @ Yb.T))) < 0.05
+
+
+def test_fit_to_Sabs_oct_11_batch_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('PFFDTD_MATERIAL_CACHE', str(tmp_path/'cache'))
+    mats = {tmp_path/f'mat{i}.h5': Sabs for i, Sabs in enumerate(MATERIALS)}
+    fit_to_Sabs_oct_11_batch(mats)
+    assert len(list((tmp_path/'cache').iterdir())) == len(MATERIALS)
+    DEF = [read_mat_DEF(filename) for filename in mats]
+    assert np.array_equal(DEF, fit_Sabs_oct_11(MATERIALS))
+
+    # unchanged materials come from the cache
+    (tmp_path/'mat0.h5').unlink()
+    fit_to_Sabs_oct_11_batch({**mats, tmp_path/'new.h5': MATERIALS[0]*0.5})
+    assert len(list((tmp_path/'cache').iterdir())) == len(MATERIALS)+1
+    assert np.array_equal(read_mat_DEF(tmp_path/'mat0.h5'), DEF[0])
+
+
+def test_fit_to_Sabs_oct_11_cache_opt_in(tmp_path, monkeypatch, material_cache):
+    # single fits only use the on-disk cache if PFFDTD_MATERIAL_CACHE is set
+    monkeypatch.delenv('PFFDTD_MATERIAL_CACHE')
+    monkeypatch.setenv('HOME', str(tmp_path/'home'))
+    fit_to_Sabs_oct_11(MATERIALS[0], tmp_path/'mat.h5')
+    assert not (tmp_path/'home').exists()
+
+    monkeypatch.setenv('PFFDTD_MATERIAL_CACHE', str(material_cache))
+    fit_to_Sabs_oct_11(MATERIALS[0], tmp_path/'mat.h5')
+    assert len(list(material_cache.iterdir())) == 1
@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import numpy as np
+from scipy.fft import dct, idct, irfft, rfft
+
+from pffdtd.absorption.air import air_absorption, apply_modal_filter, apply_ola_filter, apply_visco_filter
+
+
+def modal_filter_reference(x, Fs, Tc, rh):
+    # modes = samples, recursion over all samples
+    Ts = 1/Fs
+    Nt = x.shape[-1]
+    wqTs = np.pi*(np.arange(Nt)/Nt)
+    rd = air_absorption(wqTs/Ts/2/np.pi, Tc, rh)
+    sigqTs = rd.c*rd.absfull_Np*Ts
+    a1 = 2*np.exp(-sigqTs)*np.cos(wqTs)
+    a2 = -np.exp(-2*sigqTs)
+    fx = np.zeros(Nt)
+    fx[0] = 1
+    Fm = dct(fx, type=2, norm='ortho')
+    Fmsig1 = Fm*(1+sigqTs/2)/(1+sigqTs)
+    Fmsig2 = Fm*(1-sigqTs/2)/(1+sigqTs)
+    u = np.zeros((x.shape[0], Nt+1))
+    u[:, 1:] = x[:, ::-1]
+    P0 = np.zeros(x.shape)
+    P1 = np.zeros(x.shape)
+    for n in range(Nt):
+        P0 = a1*P1 + a2*P0 + Fmsig1*u[:, n+1][:, None] - Fmsig2*u[:, n][:, None]
+        if n < Nt-1:
+            P1, P0 = P0, P1
+    return idct(P0, type=2, norm='ortho', axis=-1)
+
+
+def test_apply_modal_filter():
+    Fs = 48_000
+    rng = np.random.default_rng(1)
+    x = rng.standard_normal((3, 800))*np.exp(-np.arange(800)/200)
+    y = apply_modal_filter(x, Fs, Tc=20, rh=50)
+    assert np.allclose(y, modal_filter_reference(x, Fs, Tc=20, rh=50), rtol=0, atol=1e-12)
+    assert np.allclose(apply_modal_filter(x[1], Fs, Tc=20, rh=50), y[1], rtol=0, atol=1e-12)
+
+    # decimated modal basis (blocks), long signal
+    x = rng.standard_normal((2, 6000))*np.exp(-np.arange(6000)/2000)
+    y = apply_modal_filter(x, Fs, Tc=20, rh=30)
+    for Nmodes in (512, 2048):
+        y_dec = apply_modal_filter(x, Fs, Tc=20, rh=30, Nmodes=Nmodes)
+        assert y_dec.shape == y.shape
+        assert np.sqrt(np.mean((y_dec-y)**2)/np.mean(y**2)) < 1e-3
+
+
+def visco_filter_reference(x, Fs, Tc, rh, NdB=120):
+    # per-sample Gaussian kernels
+    Ts = 1/Fs
+    g = air_absorption(1, Tc, rh).gamma_p
+    n_start = int(np.ceil(Ts/(2*np.pi*g)))
+    Nt0 = x.shape[-1]
+    y = np.zeros((x.shape[0], Nt0+int(np.ceil(Fs*np.sqrt(0.1*np.log(10)*NdB*(Nt0-1)*Ts*g)))))
+    y[:, :n_start] = x[:, :n_start]
+    for n in range(n_start, Nt0):
+        dt_int = int(np.ceil(np.sqrt(0.1*np.log(10)*NdB*g*Ts*n)/Ts))
+        nv = np.arange(n-dt_int, n+dt_int+1)
+        y[:, nv] += (Ts/np.sqrt(n*2*Ts*g*np.pi))*x[:, n][:, None]*np.exp(-((n-nv)*Ts)**2/(n*2*Ts*g))[None, :]
+    return y
+
+
+def test_apply_visco_filter():
+    Fs = 48_000
+    rng = np.random.default_rng(2)
+    x = rng.standard_normal((2, 20_000))*np.exp(-np.arange(20_000)/5000)
+    y_ref = visco_filter_reference(x, Fs, Tc=20, rh=50)
+
+    y, error = apply_visco_filter(x, Fs, Tc=20, rh=50, rtol=0, return_error=True)
+    assert error == 0 and np.allclose(y, y_ref, rtol=0, atol=1e-12)
+
+    for rtol in (1e-3, 1e-2):
+        y, error = apply_visco_filter(x, Fs, Tc=20, rh=50, rtol=rtol, return_error=True)
+        assert y.shape == y_ref.shape
+        assert 0 < error < rtol
+        assert np.sum(np.abs(y-y_ref)) <= error*np.sum(np.abs(x))
+
+
+def ola_filter_reference(x, Fs, Tc, rh, Nw):
+    # frame by frame
+    Ts = 1/Fs
+    Nt0 = x.shape[-1]
+    Ha = int(np.round(Nw*0.25))
+    Nfft = int(2**np.ceil(np.log2(Nw)))
+    NF = int(np.ceil((Nt0+Nw)/Ha))
+    Np = (NF-1)*Ha-Nt0
+    xp = np.zeros((x.shape[0], Nw+Nt0+Np))
+    xp[:, Nw:Nw+Nt0] = x
+    wa = 0.5*(1-np.cos(2*np.pi*np.arange(Nw)/Nw))
+    ws = wa/(3/8*Nw/Ha)
+    rd = air_absorption(np.arange(Nfft//2+1)/Nfft*Fs, Tc, rh)
+    yp = np.zeros(xp.shape)
+    for m in range(NF):
+        dist = rd.c*Ts*(m*Ha-Nw/2)
+        xf = xp[:, m*Ha:m*Ha+Nw]
+        if dist < 0:
+            yp[:, m*Ha:m*Ha+Nw] += ws*xf
+        else:
+            yf = irfft(rfft(wa*xf, Nfft, axis=-1)*np.exp(-rd.absfull_Np*dist), Nfft, axis=-1)[:, :Nw]
+            yp[:, m*Ha:m*Ha+Nw] += ws*yf
+    return yp[:, Nw:]
+
+
+def test_apply_ola_filter():
+    Fs = 48_000
+    x = np.random.default_rng(3).standard_normal((3, 5000))
+    for Nw in (1024, 1000):
+        y = apply_ola_filter(x, Fs, Tc=20, rh=50, Nw=Nw)
+        assert np.array_equal(y, ola_filter_reference(x, Fs, Tc=20, rh=50, Nw=Nw))
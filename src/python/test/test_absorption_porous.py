@@ -4,7 +4,13 @@ import numpy as np
 import pytest
 
 from pffdtd.absorption.air import Air, air_density, sound_velocity
-from pffdtd.absorption.porous import porous_absorber
+from pffdtd.absorption.admittance import OCT_11_FREQS, fit_Sabs_oct_11
+from pffdtd.absorption.porous import (
+    porous_absorber,
+    porous_absorption,
+    porous_absorption_oct_11,
+    porous_absorption_random,
+)
 
 
 @pytest.mark.parametrize('offset_zeros', [True, False])
@@ -35,3 +41,34 @@ def test_absorption_porous(offset_zeros, thickness, flow_resistivity, air, expec
     assert np.allclose(absorber, expected)
     if offset_zeros:
         assert np.count_nonzero(absorber) == absorber.shape[0]
+
+
+def test_absorption_porous_broadcast():
+    frequency = np.geomspace(20, 20_000, 64)
+    thickness = np.array([0.05, 0.1, 0.2])[:, None, None]
+    flow_resistivity = np.array([3000, 8000])[None, :, None]
+    air_gap = np.array([np.nan, 0.05])[None, None, :]
+    alphas = porous_absorption(thickness, flow_resistivity, frequency, air_gap=air_gap, angle=30.0)
+    assert alphas.shape == (3, 2, 2, frequency.size)
+    for i, j, k in np.ndindex(*alphas.shape[:-1]):
+        gap = air_gap[0, 0, k] if k > 0 else None
+        expected = porous_absorber(thickness[i, 0, 0], flow_resistivity[0, j, 0], frequency, air_gap=gap, angle=30.0)
+        assert np.allclose(alphas[i, j, k], expected, rtol=1e-12, atol=0)
+
+
+def test_absorption_porous_random_incidence():
+    frequency = np.geomspace(20, 20_000, 32)
+    alpha = porous_absorption_random([0.05, 0.1], 8000, frequency, air_gap=0.05)
+    assert alpha.shape == (2, frequency.size)
+
+    # Paris formula, midpoint rule
+    angles = np.linspace(0, 90, 2001)
+    angles = 0.5*(angles[1:]+angles[:-1])
+    expected = porous_absorption([0.05, 0.1], 8000, frequency, air_gap=0.05, angle=angles[:, None])
+    expected = np.sum(expected*np.sin(2*np.deg2rad(angles))[:, None, None], axis=0)*np.deg2rad(angles[1]-angles[0])
+    assert np.allclose(alpha, expected, atol=2e-3)
+
+    octaves = porous_absorption_oct_11([0.05, 0.1], 8000, angle='random')
+    assert np.allclose(octaves, porous_absorption_random([0.05, 0.1], 8000, OCT_11_FREQS, offset_zeros=True))
+    assert np.all(octaves > 0)
+    assert fit_Sabs_oct_11(octaves).shape == (2, 11, 3)
@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import csv
+import json
+
+import h5py
+import numpy as np
+
+from pffdtd.analysis.metrics import METRICS, room_metrics, run, write_csv, write_json
+from pffdtd.common.wavfile import wavwrite
+
+
+def decaying_noise(fs, t60, duration, noise, Nch, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration*fs))/fs
+    ir = rng.standard_normal((Nch, t.size))*10**(-3*t/t60)
+    ir[:, :int(0.005*fs)] = 0.0  # direct sound after 5 ms
+    return ir + noise*rng.standard_normal(ir.shape)
+
+
+def test_analysis_room_metrics():
+    fs, t60 = 48000, 0.8
+    ir = decaying_noise(fs, t60, 2.0, 3e-3, 4)  # noise floor about 50 dB below peak
+    center_freqs = np.array([500, 1000, 2000, 4000])
+    metrics = room_metrics(ir, fs, center_freqs, fraction=1)
+    for name in METRICS:
+        assert metrics[name].shape == (4, 4)
+
+    # exponential decay: D50 = 1-exp(-k 50ms), Ts = 1/k
+    k = 6*np.log(10)/t60
+    for name in ('EDT', 'T20', 'T30'):
+        assert np.allclose(np.mean(metrics[name], axis=1), t60, rtol=0.1)
+    assert np.allclose(np.mean(metrics['D50'], axis=1), 1-np.exp(-k*0.05), atol=0.05)
+    assert np.allclose(np.mean(metrics['C80'], axis=1), 10*np.log10(np.exp(k*0.08)-1), atol=1.0)
+    assert np.allclose(np.mean(metrics['Ts'], axis=1), 1/k, rtol=0.1)
+
+    # without noise handling, T30 is biased by the floor
+    biased = room_metrics(ir, fs, center_freqs, fraction=1, use_noise_floor=False)
+    assert np.all(np.mean(biased['T30'], axis=1) > 1.1*t60)
+
+
+def test_analysis_metrics_files(tmp_path):
+    fs = 48000
+    sim_dir = tmp_path/'sim'
+    sim_dir.mkdir()
+    with h5py.File(sim_dir/'sim_outs_processed.h5', 'w') as h5f:
+        h5f.create_dataset('r_out_f', data=decaying_noise(fs, 0.5, 1.0, 0.0, 3))
+        h5f.create_dataset('Fs_f', data=float(fs))
+    wavwrite(tmp_path/'ir.wav', fs, 0.5*decaying_noise(fs, 0.5, 1.0, 0.0, 1, seed=1))
+
+    results = run([sim_dir, tmp_path/'ir.wav'], fmin=100, fmax=4000, fraction=3)
+    assert [result['receivers'] for result in results] == [['R001', 'R002', 'R003'], ['ir']]
+    assert len(results[0]['bands']) == 17
+    assert np.allclose(np.mean(results[0]['T30'], axis=0)[-8:], 0.5, rtol=0.1)
+
+    write_json(results, tmp_path/'metrics.json')
+    write_csv(results, tmp_path/'metrics.csv')
+    assert json.loads((tmp_path/'metrics.json').read_text())[1]['receivers'] == ['ir']
+    with open(tmp_path/'metrics.csv') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['path', 'receiver', 'band', *METRICS]
+    assert len(rows) == 1 + 4*17
@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import numpy as np
+import pytest
+
+from pffdtd.analysis.response import fractional_octave_smoothing
+
+
+def smoothing_reference(magnitudes, fs, nfft, fraction):
+    frequencies = np.fft.rfftfreq(nfft, 1/fs)
+    smoothed = np.zeros_like(magnitudes)
+    for i, fc in enumerate(frequencies):
+        fl = fc / 2**(1/(2*fraction))
+        fu = fc * 2**(1/(2*fraction))
+        smoothed[..., i] = np.mean(magnitudes[..., (frequencies >= fl) & (frequencies <= fu)], axis=-1)
+    return smoothed
+
+
+@pytest.mark.parametrize('fraction', [1, 3, 6, 24])
+def test_analysis_fractional_octave_smoothing(fraction):
+    fs, nfft = 48000, 2048
+    rng = np.random.default_rng(0)
+    spectrum = np.fft.rfft(rng.standard_normal((3, nfft)), nfft)
+    dB = 20*np.log10(np.abs(spectrum))
+
+    smoothed = fractional_octave_smoothing(dB, fs, nfft, fraction)
+    assert smoothed.shape == dB.shape
+    assert np.allclose(smoothed, smoothing_reference(dB, fs, nfft, fraction), rtol=0, atol=1e-9)
+    assert np.allclose(fractional_octave_smoothing(dB[1], fs, nfft, fraction), smoothed[1], rtol=0, atol=1e-9)
+
+    power = fractional_octave_smoothing(spectrum, fs, nfft, fraction, mode='power')
+    assert np.allclose(power, np.sqrt(smoothing_reference(np.abs(spectrum)**2, fs, nfft, fraction)))
+
+    complex_ = fractional_octave_smoothing(spectrum, fs, nfft, fraction, mode='complex')
+    assert np.allclose(complex_, smoothing_reference(spectrum, fs, nfft, fraction))
@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import numpy as np
+import pytest
+from scipy.signal import butter, sosfilt
+
+from pffdtd.common.filter import FilterBank, lowcut_sos, lowpass_sos, sosfilt_inplace
+
+
+@pytest.mark.parametrize('apply_int', [False, True])
+def test_common_filter_sosfilt_inplace(apply_int):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((5, 1000))
+
+    sos = lowcut_sos(8000.0, 20.0, 4, apply_int)
+    y = x.copy()
+    assert sosfilt_inplace(sos, y) is y
+    assert np.array_equal(y, sosfilt(sos, x))
+
+    sos = lowpass_sos(8000.0, 1000.0, 8, True)
+    y = x[0].copy()
+    sosfilt_inplace(sos, y, reverse=True)
+    assert np.array_equal(y, sosfilt(sos, x[0, ::-1])[::-1])
+
+
+def test_common_filter_bank():
+    fs = 48000
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((4, 2000))
+
+    bank = FilterBank.fractional_octave(fs, [63, 500, 4000], fraction=3)
+    assert FilterBank.fractional_octave(fs, [63, 500, 4000], fraction=3).sos is bank.sos
+    y = bank.filter(x)
+    assert y.shape == (3, 4, 2000)
+    assert np.array_equal(bank.filter(x, nthreads=2), bank.filter(x, nthreads=1))
+    for fc, band in zip([63, 500, 4000], y):
+        sos = butter(2, [fc/2**(1/6), fc*2**(1/6)], btype='band', fs=fs, output='sos')
+        assert np.array_equal(band, sosfilt(sos, x))
+
+    bank = FilterBank(fs, [(125, 250), (250, 500)], order=8)
+    assert bank.filter(x[0]).shape == (2, 2000)
+    assert np.array_equal(bank.filter(x[0])[1], bank.filter(x)[1, 0])
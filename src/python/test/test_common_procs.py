@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import subprocess
+import sys
+
+import numpy as np
+
+from pffdtd.common.procs import cost_chunks
+
+
+def test_cost_chunks():
+    costs = np.array([1.0, 50.0, 2.0, 3.0, 1.0, 40.0, 1.0, 2.0])
+    chunks, chunk_costs = cost_chunks(costs, 4)
+
+    # every task exactly once, largest first
+    assert np.array_equal(np.sort(np.concatenate(chunks)), np.arange(costs.size))
+    assert np.array_equal(chunks[0], [1])
+    assert np.array_equal(chunks[1], [5])
+    assert np.allclose(chunk_costs, [np.sum(costs[chunk]) for chunk in chunks])
+    assert np.all(np.diff(chunk_costs[:2]) <= 0)
+
+
+# forked workers, in a fresh interpreter (forking after numba/TBB parallel
+# kernels ran in this process can hang)
+TASK_QUEUE_SCRIPT = '''
+import os
+
+import numpy as np
+
+from pffdtd.common.procs import run_task_queue
+
+
+def square(i):
+    return i*i, os.getpid()
+
+
+def fail(i):
+    if i == 3:
+        raise ValueError('task failed')
+    return i
+
+
+# results in order of args_list, tasks started by decreasing cost
+args_list = [(i,) for i in range(10)]
+results, stats = run_task_queue(square, args_list, 3, costs=np.arange(10.0))
+assert [r for r, _ in results] == [i*i for i in range(10)]
+assert len(stats) == 3 and sum(s['tasks'] for s in stats) == 10
+assert len({pid for _, pid in results} - {os.getpid()}) >= 1
+
+# on_result gets every result, results aren't kept
+received = {}
+results, _ = run_task_queue(square, args_list, 2, on_result=lambda i, r: received.__setitem__(i, r[0]))
+assert results == [None]*10
+assert received == {i: i*i for i in range(10)}
+
+# a failing worker raises, instead of waiting forever
+try:
+    run_task_queue(fail, args_list, 2, poll_interval=0.1)
+except RuntimeError as e:
+    assert 'failed with exit code' in str(e)
+else:
+    raise AssertionError('no RuntimeError')
+'''
+
+
+def test_run_task_queue():
+    subprocess.run([sys.executable, '-c', TASK_QUEUE_SCRIPT], check=True, timeout=120)
@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+
+from pffdtd.absorption.admittance import convert_Sabs_to_Yn, write_freq_ind_mat_from_Yn
+from pffdtd.sim3d.container import SIM_CONTAINER_FILE, SIM_GROUPS, SimData, pack_sim_dir, unpack_sim_dir
+from pffdtd.sim3d.engine import EnginePython3D
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.setup import sim_setup_3d
+
+
+def setup_room(root_dir, fcc):
+    room = RoomModelBuilder(2.0, 1.6, 1.8)
+    room.add_source('S1', [0.5, 0.6, 0.9])
+    room.add_receiver('R1', [1.3, 1.1, 1.0])
+    room.add_box('Box', [0.5, 0.4, 0.45], [0.9, 0.6, 0.0])
+    room.build(root_dir/'model.json')
+    write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(0.1), root_dir/'mat.h5')
+    sim_setup_3d(
+        model_json_file=root_dir/'model.json',
+        mat_folder=root_dir,
+        mat_files_dict={'Ceiling': 'mat.h5', 'Floor': 'mat.h5', 'Walls': 'mat.h5', 'Box': 'mat.h5'},
+        duration=0.01,
+        fcc_flag=fcc,
+        fmax=800,
+        PPW=7.7,
+        insig_type='impulse',
+        save_folder=root_dir/'cpu',
+        save_folder_gpu=root_dir/'gpu',
+        draw_vox=False,
+        Nprocs=1,
+    )
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_sim3d_container(tmp_path, fcc):
+    setup_room(tmp_path, fcc)
+
+    for folder in ('cpu', 'gpu'):  # gpu: sorted bn_ixyz (delta-encoded)
+        shutil.copytree(tmp_path/folder, tmp_path/f'{folder}_packed')
+        pack_sim_dir(tmp_path/f'{folder}_packed', remove=True)
+        assert not (tmp_path/f'{folder}_packed'/'vox_out.h5').exists()
+
+        with SimData(tmp_path/folder) as files, SimData(tmp_path/f'{folder}_packed') as packed:
+            assert packed.is_container and not files.is_container
+            for group in SIM_GROUPS:
+                assert packed.keys(group) == files.keys(group)
+                for name in files.keys(group):
+                    a, b = files.read(group, name), packed.read(group, name)
+                    assert a.dtype == b.dtype and np.array_equal(a, b)
+
+        # back to separate files (same datasets as before packing)
+        unpack_sim_dir(tmp_path/f'{folder}_packed', remove=True)
+        assert not (tmp_path/f'{folder}_packed'/SIM_CONTAINER_FILE).exists()
+        for group in SIM_GROUPS:
+            with h5py.File(tmp_path/folder/f'{group}.h5', 'r') as a, h5py.File(tmp_path/f'{folder}_packed'/f'{group}.h5', 'r') as b:
+                for name in a.keys():
+                    assert np.array_equal(a[name][()], b[name][()])
+
+    pack_sim_dir(tmp_path/'cpu_packed')
+    with h5py.File(tmp_path/'cpu_packed'/SIM_CONTAINER_FILE, 'r') as h5f:
+        assert h5f['vox_out/adj_bn'].attrs['encoding'] == 'bits'
+        assert h5f['vox_out/bn_ixyz'].dtype.itemsize < 8
+
+    files = EnginePython3D(tmp_path/'cpu', nthreads=1)
+    packed = EnginePython3D(tmp_path/'cpu_packed', nthreads=1)
+    for name in ('adj_bn', 'bn_ixyz', 'bnl_ixyz', 'mat_bnl', 'ssaf_bnl', 'in_ixyz', 'out_ixyz', 'in_sigs', 'DEF', 'Mb'):
+        assert np.array_equal(getattr(files, name), getattr(packed, name))
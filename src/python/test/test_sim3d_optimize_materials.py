@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import json
+
+import numpy as np
+
+from pffdtd.sim3d.optimize_materials import optimize_materials, sabine_t60
+from pffdtd.sim3d.setup import load_setup3d_classes
+
+SIM_FILE = '''
+from pathlib import Path
+
+from pffdtd.absorption.admittance import convert_Sabs_to_Yn, write_freq_ind_mat_from_Yn
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.setup import Setup3D
+
+
+class SmallRoom(Setup3D):
+    model_file = 'model.json'
+    mat_folder = 'materials'
+    source_index = 1
+    source_signal = 'impulse'
+    diff_source = True
+    materials = {'Ceiling': 'hard.h5', 'Floor': 'hard.h5', 'Walls': 'soft.h5'}
+    duration = 0.3
+    fcc = False
+    ppw = 7.7
+    fmax = 500.0
+
+    def generate_materials(self):
+        write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(0.1), Path(self.mat_folder) / 'hard.h5')
+        write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(0.5), Path(self.mat_folder) / 'soft.h5')
+
+    def generate_model(self, constants):
+        room = RoomModelBuilder(1.6, 1.4, 1.2)
+        room.add_source('S1', [0.4, 0.5, 0.6])
+        room.add_receiver('R1', [1.1, 0.9, 0.7])
+        room.build(self.model_file)
+'''
+
+
+def test_sim3d_optimize_materials(tmp_path):
+    (tmp_path/'room.py').write_text(SIM_FILE)
+    sim_class, = load_setup3d_classes(tmp_path/'room.py')
+    cache_dir = tmp_path/'cache'
+
+    out_file = tmp_path/'optimize.json'
+    confirmed = optimize_materials(sim_class, ['Walls'], target=0.1, cache_dir=cache_dir, Ntrials=3, Nconfirm=1,
+                                   fmin=100, surrogate_fmax=400.0, seed=1, out_file=out_file)
+    assert len(confirmed) == 1
+    assert np.isfinite(confirmed[0]['cost'])
+    assert confirmed[0]['materials']['Floor'] == 'hard.h5'
+    assert json.loads(out_file.read_text())['candidates'] == confirmed
+
+    # surrogate trials share one voxelization, confirmation at full resolution adds one
+    assert len(list((cache_dir/'voxelize').iterdir())) == 2
+
+    # Sabine estimate: more absorption, shorter T60
+    geometry_dir = next((cache_dir/'geometry').iterdir())
+    materials_dir = next(d for d in (cache_dir/'materials').iterdir() if (d/'soft.h5').exists())
+    freqs = [125.0, 250.0]
+    hard = sabine_t60(geometry_dir, materials_dir, {mat: 'hard.h5' for mat in sim_class.materials}, freqs)
+    soft = sabine_t60(geometry_dir, materials_dir, {mat: 'soft.h5' for mat in sim_class.materials}, freqs)
+    assert np.all(soft < hard)
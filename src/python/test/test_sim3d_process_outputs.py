@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import h5py
+import numpy as np
+
+from pffdtd.absorption.admittance import convert_Sabs_to_Yn, write_freq_ind_mat_from_Yn
+from pffdtd.common.filter import apply_lowcut, apply_lowpass
+from pffdtd.sim3d.engine import EnginePython3D
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.process_outputs import ProcessOutputs
+from pffdtd.sim3d.setup import sim_setup_3d
+
+
+def test_sim3d_process_outputs(tmp_path):
+    room = RoomModelBuilder(1.6, 1.4, 1.2)
+    room.add_source('S1', [0.4, 0.5, 0.6])
+    for i in range(5):
+        room.add_receiver(f'R{i+1}', [0.6+0.1*i, 0.8, 0.3+0.1*i])
+    room.build(tmp_path/'model.json')
+    write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(0.1), tmp_path/'mat.h5')
+    sim_setup_3d(
+        model_json_file=tmp_path/'model.json',
+        mat_folder=tmp_path,
+        mat_files_dict={'Ceiling': 'mat.h5', 'Floor': 'mat.h5', 'Walls': 'mat.h5'},
+        duration=0.02,
+        fcc_flag=False,
+        fmax=800,
+        PPW=7.7,
+        insig_type='impulse',
+        save_folder=tmp_path/'cpu',
+        save_folder_gpu=None,
+        draw_vox=False,
+        Nprocs=1,
+    )
+    engine = EnginePython3D(tmp_path/'cpu', nthreads=1)
+    engine.run_all(1)
+    engine.save_outputs()
+
+    # reference: all receivers at once
+    po = ProcessOutputs(tmp_path/'cpu', Nchunk=2, nthreads=2)
+    with h5py.File(tmp_path/'cpu'/'sim_outs.h5', 'r') as h5f:
+        u_out = h5f['u_out'][...]
+    r_out = np.sum((u_out*po.out_alpha.flat[:][:, None]).reshape((*po.out_alpha.shape, -1)), axis=1)
+    expected = apply_lowcut(r_out, po.Fs, 10.0, 4, po.diff)
+    expected = apply_lowpass(expected, po.Fs, 800.0, 8, True)
+
+    # receiver groups on a thread pool, in-place filters
+    po.process(fcut_lowcut=10.0, order_lowcut=4, resample_fs=None, fcut_lowpass=800.0)
+    assert len(po.groups) == 3
+    assert np.array_equal(po.r_out_f, expected)
+    with h5py.File(tmp_path/'cpu'/'sim_outs.h5', 'r') as h5f:
+        assert np.array_equal(h5f['r_out'][...], r_out)
+
+    # polyphase resampler close to resampy
+    po.process(fcut_lowcut=10.0, order_lowcut=4, resample_fs=48e3)
+    kaiser = po.r_out_f
+    po.process(fcut_lowcut=10.0, order_lowcut=4, resample_fs=48e3, resampler='polyphase')
+    assert po.Fs_f == 48e3
+    assert abs(po.Nt_f-kaiser.shape[-1]) <= 1
+    N = min(po.Nt_f, kaiser.shape[-1])
+    assert np.max(np.abs(po.r_out_f[:, :N]-kaiser[:, :N])) < 1e-2*np.max(np.abs(kaiser))
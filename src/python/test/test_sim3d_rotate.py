@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import h5py
+import numpy as np
+import pytest
+
+from pffdtd.sim3d.rotate import copy_sim_data, fold_fcc_sim_data, rotate, save_gpu_sim_data, sort_sim_data
+
+
+def write_sim_data(sim_dir, fcc):
+    rng = np.random.default_rng(0)
+    Nx, Ny, Nz = 10, 14, 12
+    NN = 12 if fcc else 6
+    Nb, Ns, Nr, Nt = 500, 2, 3, 4
+
+    ixyz = np.arange(Nx*Ny*Nz)
+    if fcc:
+        ixyz = ixyz[np.sum(np.unravel_index(ixyz, (Nx, Ny, Nz)), axis=0) % 2 == 0]
+    ixyz = rng.permutation(ixyz)
+
+    sim_dir.mkdir()
+    with h5py.File(sim_dir/'vox_out.h5', 'w') as h5f:
+        h5f.create_dataset('bn_ixyz', data=ixyz[:Nb])
+        h5f.create_dataset('adj_bn', data=rng.random((Nb, NN)) > 0.5)
+        h5f.create_dataset('mat_bn', data=rng.integers(-1, 3, Nb).astype(np.int8))
+        h5f.create_dataset('saf_bn', data=rng.random(Nb))
+        h5f.create_dataset('xv', data=np.arange(Nx)*0.1)
+        h5f.create_dataset('yv', data=np.arange(Ny)*0.1)
+        h5f.create_dataset('zv', data=np.arange(Nz)*0.1)
+        h5f.create_dataset('h', data=np.float64(0.1))
+        h5f.create_dataset('Nx', data=np.int64(Nx))
+        h5f.create_dataset('Ny', data=np.int64(Ny))
+        h5f.create_dataset('Nz', data=np.int64(Nz))
+        h5f.create_dataset('Nb', data=np.int64(Nb))
+    with h5py.File(sim_dir/'signals.h5', 'w') as h5f:
+        h5f.create_dataset('in_ixyz', data=ixyz[Nb:Nb+Ns])
+        h5f.create_dataset('in_sigs', data=rng.random((Ns, Nt)))
+        h5f.create_dataset('out_ixyz', data=ixyz[Nb+Ns:Nb+Ns+Nr])
+        h5f.create_dataset('out_alpha', data=rng.random((Nr, 8)))
+        h5f.create_dataset('out_reorder', data=np.arange(Nr))
+        h5f.create_dataset('Ns', data=np.int64(Ns))
+        h5f.create_dataset('Nr', data=np.int64(Nr))
+    with h5py.File(sim_dir/'constants.h5', 'w') as h5f:
+        h5f.create_dataset('fcc_flag', data=np.int8(fcc))
+    with h5py.File(sim_dir/'cart_grid.h5', 'w') as h5f:
+        h5f.create_dataset('xv', data=np.arange(Nx)*0.1)
+        h5f.create_dataset('yv', data=np.arange(Ny)*0.1)
+        h5f.create_dataset('zv', data=np.arange(Nz)*0.1)
+        h5f.create_dataset('h', data=np.float64(0.1))
+
+
+def assert_same_sim_data(dir_a, dir_b):
+    for file in ('vox_out.h5', 'signals.h5', 'constants.h5'):
+        with h5py.File(dir_a/file, 'r') as a, h5py.File(dir_b/file, 'r') as b:
+            assert set(a.keys()) == set(b.keys())
+            for name in a.keys():
+                assert np.array_equal(a[name][()], b[name][()])
+
+
+def prepare_gpu_data(sim_dir, fcc, **kwargs):
+    rotate(sim_dir, **kwargs)
+    if fcc:
+        fold_fcc_sim_data(sim_dir, **kwargs)
+    sort_sim_data(sim_dir, **kwargs)
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_sim3d_rotate_chunked(tmp_path, fcc):
+    write_sim_data(tmp_path/'in_memory', fcc)
+    write_sim_data(tmp_path/'chunked', fcc)
+
+    prepare_gpu_data(tmp_path/'in_memory', fcc)
+    prepare_gpu_data(tmp_path/'chunked', fcc, chunk_size=37)  # external merge sort of 14 runs
+
+    assert not (tmp_path/'chunked'/'sort_runs.h5').exists()
+    assert_same_sim_data(tmp_path/'in_memory', tmp_path/'chunked')
+
+    with h5py.File(tmp_path/'chunked'/'vox_out.h5', 'r') as h5f:
+        assert np.all(np.diff(h5f['bn_ixyz'][...]) > 0)
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_sim3d_save_gpu_sim_data(tmp_path, fcc):
+    write_sim_data(tmp_path/'cpu', fcc)
+
+    copy_sim_data(tmp_path/'cpu', tmp_path/'steps')
+    prepare_gpu_data(tmp_path/'steps', fcc)
+
+    with h5py.File(tmp_path/'cpu'/'vox_out.h5', 'r') as h5f:
+        bn_data = [h5f[name][...] for name in ('bn_ixyz', 'adj_bn', 'mat_bn', 'saf_bn')]
+    save_gpu_sim_data(tmp_path/'cpu', tmp_path/'single_pass', *bn_data)
+
+    assert_same_sim_data(tmp_path/'steps', tmp_path/'single_pass')
@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+from pathlib import Path
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+from pffdtd.absorption.admittance import convert_Sabs_to_Yn, write_freq_ind_mat_from_Yn
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.setup import sim_setup_3d
+
+MATERIALS = {'Ceiling': 'mat.h5', 'Floor': 'mat.h5', 'Walls': 'mat.h5', 'Box': 'mat.h5'}
+
+
+def build_room(root_dir):
+    room = RoomModelBuilder(2.0, 1.6, 1.8)
+    room.add_source('S1', [0.5, 0.6, 0.9])
+    room.add_receiver('R1', [1.3, 1.1, 1.0])
+    room.add_box('Box', [0.5, 0.4, 0.45], [0.9, 0.6, 0.0])
+    room.build(root_dir/'model.json')
+    write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(0.1), root_dir/'mat.h5')
+
+
+def setup_room(root_dir, save_folder, **kwargs):
+    sim_setup_3d(
+        model_json_file=root_dir/'model.json',
+        mat_folder=root_dir,
+        mat_files_dict=MATERIALS,
+        duration=0.01,
+        fmax=800,
+        PPW=7.7,
+        insig_type='impulse',
+        save_folder=save_folder,
+        Nprocs=1,
+        **kwargs,
+    )
+
+
+# through the Setup3D entry point (default draw_vox=True, default Nprocs), in a
+# fresh interpreter (forking after numba/TBB parallel kernels ran in this process can hang)
+SETUP3D_SCRIPT = '''
+import sys
+from pathlib import Path
+
+from pffdtd.sim3d.setup import Setup3D, run_setup3d_for_class
+
+root_dir = Path(sys.argv[1])
+
+
+class StreamedRoom(Setup3D):
+    model_file = str(root_dir/'model.json')
+    mat_folder = str(root_dir)
+    materials = {'Ceiling': 'mat.h5', 'Floor': 'mat.h5', 'Walls': 'mat.h5', 'Box': 'mat.h5'}
+    source_index = 1
+    source_signal = 'impulse'
+    duration = 0.01
+    fcc = False
+    ppw = 7.7
+    fmax = 800
+    save_folder = str(root_dir/'stream')
+    save_folder_gpu = None
+    vox_stream = True
+
+
+run_setup3d_for_class(StreamedRoom)
+'''
+
+
+def test_sim3d_setup_vox_stream(tmp_path):
+    build_room(tmp_path)
+    subprocess.run([sys.executable, '-c', SETUP3D_SCRIPT, str(tmp_path)],
+                   cwd=Path(__file__).parents[1], check=True, timeout=600)
+    setup_room(tmp_path, tmp_path/'full', diff_source=True)
+
+    with h5py.File(tmp_path/'stream'/'vox_out.h5', 'r') as stream, h5py.File(tmp_path/'full'/'vox_out.h5', 'r') as full:
+        assert stream['Nb'][()] == full['Nb'][()]
+        ia = np.argsort(stream['bn_ixyz'][...])
+        ib = np.argsort(full['bn_ixyz'][...])
+        assert np.array_equal(stream['bn_ixyz'][...][ia], full['bn_ixyz'][...][ib])
+        assert np.array_equal(stream['adj_bn'][...][ia], full['adj_bn'][...][ib])
+
+
+def test_sim3d_setup_vox_stream_options(tmp_path):
+    build_room(tmp_path)
+    with pytest.raises(ValueError, match='vox_method'):
+        setup_room(tmp_path, tmp_path/'sim', vox_stream=True, vox_method='scanline')
+    with pytest.raises(ValueError, match='vox_cache_folder'):
+        setup_room(tmp_path, tmp_path/'sim', vox_stream=True, vox_cache_folder=tmp_path/'cache')
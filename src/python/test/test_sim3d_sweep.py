@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+from pffdtd.sim3d.setup import load_setup3d_classes
+from pffdtd.sim3d.sweep import Sweep
+
+SIM_FILE = '''
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from pffdtd.absorption.admittance import convert_Sabs_to_Yn, write_freq_ind_mat_from_Yn
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.setup import Setup3D
+
+
+class SmallRoom(Setup3D):
+    model_file = 'model.json'
+    mat_folder = 'materials'
+    source_index = 1
+    source_signal = 'impulse'
+    diff_source = True
+    materials = {'Ceiling': 'mat.h5', 'Floor': 'mat.h5', 'Walls': 'mat.h5'}
+    duration = 0.01
+    fcc = False
+    ppw = 7.7
+    fmax = 500.0
+    absorption = 0.1
+    sweep_params = {'absorption': 'materials'}
+
+    def generate_materials(self):
+        write_freq_ind_mat_from_Yn(convert_Sabs_to_Yn(self.absorption), Path(self.mat_folder) / 'mat.h5')
+
+    def generate_model(self, constants):
+        room = RoomModelBuilder(1.6, 1.4, 1.2)
+        room.add_source('S1', [0.4, 0.5, 0.6])
+        room.add_source('S2', [1.1, 0.8, 0.7])
+        room.add_receiver('R1', [0.8, 1.0, 0.5])
+        room.build(self.model_file)
+
+    def analyze(self, sim_dir):
+        with h5py.File(Path(sim_dir) / 'sim_outs_processed.h5', 'r') as h5f:
+            return {'peak': float(np.max(np.abs(h5f['r_out_f'][...])))}
+'''
+
+
+def test_sim3d_sweep(tmp_path):
+    (tmp_path/'room.py').write_text(SIM_FILE)
+    sim_class, = load_setup3d_classes(tmp_path/'room.py')
+    cache_dir = tmp_path/'cache'
+
+    # sources share geometry and voxelization, materials only come in at signals
+    sweep = Sweep(sim_class, {'source_index': [1, 2], 'absorption': [0.1, 0.2]}, cache_dir)
+    results = sweep.run()
+    assert len(results) == 4
+    assert sweep.Ncached == 0
+    for stage, count in [('materials', 2), ('geometry', 1), ('voxelize', 1), ('signals', 4), ('analysis', 4)]:
+        assert len(list((cache_dir/stage).iterdir())) == count
+
+    peaks = [json.loads((Path(result['analysis'])/'analysis.json').read_text())['peak'] for result in results]
+    assert np.all(np.isfinite(peaks)) and len(set(peaks)) == 4
+
+    # same variants again: everything from cache
+    again = Sweep(sim_class, {'source_index': [1, 2], 'absorption': [0.1, 0.2]}, cache_dir)
+    assert again.run() == results
+    assert again.Ncached == len(again.nodes)
+
+    # new fmax: only the default-fmax variant is cached
+    more = Sweep(sim_class, {'fmax': [500.0, 450.0]}, cache_dir, until='voxelize')
+    more.run()
+    assert more.Ncached == 3
+    assert len(list((cache_dir/'voxelize').iterdir())) == 2
+
+    # compression changes the voxelization output (and all later stages)
+    packed = Sweep(sim_class, {'compress': [0, 1]}, cache_dir, until='signals')
+    packed.run()
+    assert packed.Ncached == 4
+    assert len(list((cache_dir/'voxelize').iterdir())) == 3
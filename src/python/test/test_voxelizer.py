@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: MIT
+# SPDX-FileCopyrightText: 2024 Tobias Hienzsch
+
+from pathlib import Path
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+
+from pffdtd.sim3d.model_builder import RoomModelBuilder
+from pffdtd.sim3d.room_geometry import RoomGeometry
+from pffdtd.voxelizer.cart_grid import CartGrid
+from pffdtd.voxelizer.vox_grid import VoxGrid
+from pffdtd.voxelizer.vox_scene import VoxScene
+
+
+def build_room(model_file, couch_position):
+    room = RoomModelBuilder(2.5, 2.0, 2.2)
+    room.add_source('S1', [0.5, 0.5, 1.2])
+    room.add_receiver('R1', [1.5, 2.0, 1.2])
+    room.add_box('Couch', [0.6, 0.4, 0.45], couch_position)
+    room.add_box('Desk', [0.5, 0.3, 0.7], [1.3, 1.9, 0.0])
+    room.build(model_file)
+
+
+def voxelize(model_file, fcc, Nprocs=1, **kwargs):
+    room_geo = RoomGeometry(model_file, az_el=[5.0, 3.0])
+    cart_grid = CartGrid(h=0.06, offset=3.5, bmin=room_geo.bmin, bmax=room_geo.bmax, fcc=fcc)
+    vox_grid = VoxGrid(room_geo, cart_grid, Nh=6)
+    vox_grid.fill(Nprocs=Nprocs)
+    vox_scene = VoxScene(room_geo, cart_grid, vox_grid, fcc=fcc)
+    vox_scene.calc_adj(Nprocs=Nprocs, **kwargs)
+    return vox_scene
+
+
+def assert_same_voxelization(a, b):
+    ia = np.argsort(a.bn_ixyz)
+    ib = np.argsort(b.bn_ixyz)
+    assert np.array_equal(a.bn_ixyz[ia], b.bn_ixyz[ib])
+    assert np.array_equal(a.adj_bn[ia], b.adj_bn[ib])
+    assert np.array_equal(a.mat_bn[ia], b.mat_bn[ib])
+    assert np.allclose(a.saf_bn[ia], b.saf_bn[ib])
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_voxelizer_incremental_cache(tmp_path, fcc):
+    model_file = tmp_path/'model.json'
+    cache_folder = tmp_path/'cache'
+
+    build_room(model_file, [0.2, 0.3, 0.0])
+    first = voxelize(model_file, fcc, cache_folder=cache_folder)
+    assert first.cache_hits == 0
+
+    # move one object, rest of scene stays the same
+    build_room(model_file, [0.9, 0.4, 0.0])
+    incremental = voxelize(model_file, fcc, cache_folder=cache_folder)
+    full = voxelize(model_file, fcc)
+
+    # some voxels reused, those touched by the moved object re-processed
+    assert 0 < incremental.cache_hits < len(incremental.vox_grid.nonempty_idx)
+    assert full.cache_hits == 0
+    assert_same_voxelization(incremental, full)
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_voxelizer_scanline(tmp_path, fcc):
+    model_file = tmp_path/'model.json'
+    build_room(model_file, [0.2, 0.3, 0.0])
+
+    scanline = voxelize(model_file, fcc, method='scanline')
+    voxel = voxelize(model_file, fcc, method='voxel')
+
+    assert_same_voxelization(scanline, voxel)
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_voxelizer_check_adj_full(tmp_path, fcc):
+    model_file = tmp_path/'model.json'
+    build_room(model_file, [0.2, 0.3, 0.0])
+
+    vox_scene = voxelize(model_file, fcc)
+    vox_scene.check_adj_full(Nprocs=1)
+
+    # break reciprocity of one boundary node
+    i, k = np.argwhere(~vox_scene.adj_bn)[0]
+    vox_scene.adj_bn[i, k] = True
+    with pytest.raises(AssertionError, match='non-reciprocal'):
+        vox_scene.check_adj_full(Nprocs=1)
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_voxelizer_stream(tmp_path, fcc):
+    model_file = tmp_path/'model.json'
+    build_room(model_file, [0.2, 0.3, 0.0])
+
+    voxel = voxelize(model_file, fcc)
+
+    room_geo = RoomGeometry(model_file, az_el=[5.0, 3.0])
+    cart_grid = CartGrid(h=0.06, offset=3.5, bmin=room_geo.bmin, bmax=room_geo.bmax, fcc=fcc)
+    vox_grid = VoxGrid(room_geo, cart_grid, Nh=6)
+    vox_grid.fill(Nprocs=1)
+    stream = VoxScene(room_geo, cart_grid, vox_grid, fcc=fcc)
+    stream.calc_adj_stream(tmp_path/'vox', Nprocs=1)
+    with h5py.File(tmp_path/'vox'/'vox_out.h5', 'r') as h5f:
+        assert h5f['Nb'][()] == voxel.bn_ixyz.size
+        for name in ('bn_ixyz', 'adj_bn', 'mat_bn', 'saf_bn'):
+            setattr(stream, name, h5f[name][...])
+
+    assert_same_voxelization(stream, voxel)
+    stream.check_adj_stream(tmp_path/'vox', Nprocs=1, chunk_size=1000)
+
+    # break reciprocity of one boundary node
+    with h5py.File(tmp_path/'vox'/'vox_out.h5', 'r+') as h5f:
+        i, k = np.argwhere(~h5f['adj_bn'][...])[0]
+        h5f['adj_bn'][i, k] = True
+    with pytest.raises(AssertionError, match='non-reciprocal'):
+        stream.check_adj_stream(tmp_path/'vox', Nprocs=1, chunk_size=1000)
+
+
+# multi-process voxelization, in a fresh interpreter (forking after numba/TBB
+# parallel kernels ran in this process can hang)
+MULTIPROCESS_SCRIPT = '''
+import sys
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from pffdtd.sim3d.room_geometry import RoomGeometry
+from pffdtd.voxelizer.cart_grid import CartGrid
+from pffdtd.voxelizer.vox_grid import VoxGrid
+from pffdtd.voxelizer.vox_scene import VoxScene
+from test.test_voxelizer import build_room, voxelize
+
+tmp_path, fcc, Nprocs = Path(sys.argv[1]), sys.argv[2] == 'fcc', 3
+model_file = tmp_path/'model.json'
+
+
+def save(name, vox_scene):
+    np.savez(tmp_path/f'{name}.npz', **{key: getattr(vox_scene, key) for key in ('bn_ixyz', 'adj_bn', 'mat_bn', 'saf_bn')})
+
+
+build_room(model_file, [0.2, 0.3, 0.0])
+for method in ('voxel', 'scanline'):
+    vox_scene = voxelize(model_file, fcc, Nprocs=Nprocs, method=method)
+    vox_scene.check_adj_full(Nprocs=Nprocs)
+    save(method, vox_scene)
+
+room_geo = RoomGeometry(model_file, az_el=[5.0, 3.0])
+cart_grid = CartGrid(h=0.06, offset=3.5, bmin=room_geo.bmin, bmax=room_geo.bmax, fcc=fcc)
+vox_grid = VoxGrid(room_geo, cart_grid, Nh=6)
+vox_grid.fill(Nprocs=Nprocs)
+stream = VoxScene(room_geo, cart_grid, vox_grid, fcc=fcc)
+stream.calc_adj_stream(tmp_path/'vox', Nprocs=Nprocs)
+stream.check_adj_stream(tmp_path/'vox', Nprocs=Nprocs)
+with h5py.File(tmp_path/'vox'/'vox_out.h5', 'r') as h5f:
+    for name in ('bn_ixyz', 'adj_bn', 'mat_bn', 'saf_bn'):
+        setattr(stream, name, h5f[name][...])
+save('stream', stream)
+
+voxelize(model_file, fcc, Nprocs=Nprocs, cache_folder=tmp_path/'cache')
+build_room(model_file, [0.9, 0.4, 0.0])
+save('cache', voxelize(model_file, fcc, Nprocs=Nprocs, cache_folder=tmp_path/'cache'))
+'''
+
+
+@pytest.mark.parametrize('fcc', [False, True])
+def test_voxelizer_multiprocess(tmp_path, fcc):
+    root = Path(__file__).parents[1]
+    subprocess.run([sys.executable, '-c', MULTIPROCESS_SCRIPT, str(tmp_path), 'fcc' if fcc else 'cart'],
+                   cwd=root, check=True, timeout=600)
+
+    def load(name):
+        return SimpleNamespace(**np.load(tmp_path/f'{name}.npz'))
+
+    # serial reference (before and after moving the couch)
+    model_file = tmp_path/'serial.json'
+    build_room(model_file, [0.2, 0.3, 0.0])
+    serial = voxelize(model_file, fcc)
+    for name in ('voxel', 'scanline', 'stream'):
+        assert_same_voxelization(load(name), serial)
+
+    build_room(model_file, [0.9, 0.4, 0.0])
+    assert_same_voxelization(load('cache'), voxelize(model_file, fcc))